@@ -0,0 +1,63 @@
+# taaraxtak
+#
+# benchmarks
+# gini.py - time to compute Gini coefficients: one row at a time (as we first did),
+# with `gini`, and in batches with `gini_rows`.
+#
+# run from the repository root with
+#   python3 -m benchmarks.gini [rows]
+# (a row per (day, market); 10 years of 7 markets by default.)
+
+import sys
+import time
+import statistics
+import numpy as np
+
+import src.w3techs.utils as utils
+
+
+ROWS = 10 * 365 * 7
+# a column per country
+COLUMNS = len(utils.prop_net_users)
+REPEATS = 5
+
+
+def reference_gini(array: np.array) -> float:
+    '''`gini` as we first wrote it (from https://github.com/oliviaguest/gini/).'''
+    array = array.flatten()
+    if np.amin(array) < 0:
+        array -= np.amin(array)
+    array += 0.0000001
+    array = np.sort(array)
+    index = np.arange(1, array.shape[0]+1)
+    n = array.shape[0]
+    return ((np.sum((2 * index - n - 1) * array)) / (n * np.sum(array)))
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else ROWS
+    rng = np.random.default_rng(0)
+    # mostly zeros, as most countries have none of a market
+    matrix = rng.random((n, COLUMNS)) * (rng.random((n, COLUMNS)) < 0.1)
+    ranked = np.sort(matrix, axis=1)
+    print(f'{n} rows of {COLUMNS}')
+    kernels = {
+        # (it changes its input, so it gets a copy)
+        'reference, row by row': lambda: [reference_gini(row.copy()) for row in matrix],
+        'gini, row by row': lambda: [utils.gini(row) for row in matrix],
+        'gini_rows': lambda: utils.gini_rows(matrix),
+        'gini_rows, presorted': lambda: utils.gini_rows(ranked, presorted=True),
+    }
+    expected = np.array(kernels['reference, row by row']())
+    for name, kernel in kernels.items():
+        assert(np.allclose(kernel(), expected))
+        times = []
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            kernel()
+            times.append(time.perf_counter() - start)
+        print(f'{name:<24} {statistics.median(times) * 1000:10.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
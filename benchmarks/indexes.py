@@ -0,0 +1,117 @@
+# taaraxtak
+#
+# benchmarks
+# indexes.py - how long our hot queries take on big tables,
+# with no indexes, with indexes, and with indexes on monthly partitions.
+#
+# run from the repository root with
+#   python3 -m benchmarks.indexes [rows]
+# (rows per table, 10 million by default - populating takes a few minutes.)
+
+import sys
+import time
+import statistics
+import pandas as pd
+import psycopg2
+import testing.postgresql
+
+import src.ooni.types as ooni_types
+import src.ooni.utils as ooni_utils
+import src.w3techs.types as w3techs_types
+import src.w3techs.utils as w3techs_utils
+
+
+ROWS = 10_000_000
+HOSTNAMES = 100_000
+REPEATS = 20
+# rows are spread over two years
+START = '2020-01-01 00:00:00+00'
+SPAN = "interval '2 years'"
+
+
+def populate(cur, conn, n: int):
+    cur.execute(f'''
+    INSERT INTO ooni_web_connectivity_test
+    SELECT 'dns', 'RU', 'https://example-' || (i % {HOSTNAMES}) || '.nl/', true, false,
+           'report-' || i, 'NL', 'NL',
+           timestamptz '{START}' + {SPAN} * (i::float / {n})
+    FROM generate_series(1, {n}) AS i
+    ''')
+    cur.execute(f'''
+    INSERT INTO ip_hostname_mapping
+    SELECT 'example-' || (i % {HOSTNAMES}) || '.nl', '8.8.8.8',
+           timestamptz '{START}' + {SPAN} * (i::float / {n})
+    FROM generate_series(1, {n}) AS i
+    ''')
+    cur.execute(f'''
+    INSERT INTO provider_marketshare
+    SELECT 'provider-' || (i % 50), NULL, 'US', 'all',
+           (ARRAY['ssl-certificate', 'web-hosting', 'dns-server', 'reverse-proxy'])[i % 4 + 1],
+           0.01, timestamptz '{START}' + {SPAN} * (i::float / {n})
+    FROM generate_series(1, {n}) AS i
+    ''')
+    conn.commit()
+    cur.execute('ANALYZE')
+    conn.commit()
+
+
+def drop_indexes(cur, conn):
+    cur.execute('DROP INDEX ooni_web_connectivity_test_time')
+    cur.execute('DROP INDEX ip_hostname_mapping_hostname_time')
+    cur.execute('DROP INDEX provider_marketshare_market_scope_time')
+    conn.commit()
+
+
+def one_day(cur):
+    cur.execute('''
+    SELECT count(*) FROM ooni_web_connectivity_test
+    WHERE measurement_start_time BETWEEN '2021-06-01' AND '2021-06-02'
+    ''')
+    return cur.fetchone()
+
+
+QUERIES = {
+    'get_latest_reading_time': ooni_utils.get_latest_reading_time,
+    'retrieve_ip': lambda cur: ooni_utils.retrieve_ip(cur, 'example-4242.nl'),
+    'fetch_rows': lambda cur: w3techs_utils.fetch_rows(
+        cur, 'all', 'web-hosting', pd.Timestamp('2021-06-01')),
+    'one day of OONI tests': one_day,
+}
+
+
+def time_queries(cur, stage: str):
+    for name, query in QUERIES.items():
+        times = []
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            query(cur)
+            times.append(time.perf_counter() - start)
+        print(f'{stage:<22} {name:<24} {statistics.median(times) * 1000:10.2f}ms')
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else ROWS
+    with testing.postgresql.Postgresql() as postgresql:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        ooni_types.migrate(cur, conn)
+        w3techs_types.migrate(cur, conn)
+        drop_indexes(cur, conn)
+        populate(cur, conn, n)
+        print(f'{n} rows per table')
+
+        time_queries(cur, 'no indexes')
+
+        ooni_types.create_indexes(cur)
+        w3techs_types.create_indexes(cur)
+        cur.execute('ANALYZE')
+        time_queries(cur, 'indexes')
+
+        ooni_types.partition_tables(cur, conn)
+        w3techs_types.partition_tables(cur, conn)
+        cur.execute('ANALYZE')
+        time_queries(cur, 'indexes + partitions')
+
+
+if __name__ == '__main__':
+    main()
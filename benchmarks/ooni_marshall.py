@@ -0,0 +1,63 @@
+# taaraxtak
+#
+# benchmarks
+# ooni_marshall.py - time to marshall OONI measurements (once their hostnames are resolved),
+# on each of `ooni_executors`, with a few chunk sizes -
+# and, for comparison, one `OONIWebConnectivityTest` at a time.
+#
+# run from the repository root with
+#   python3 -m benchmarks.ooni_marshall [measurements]
+
+import sys
+import time
+import statistics
+
+import src.ooni.utils as utils
+import src.ooni.types as ooni_types
+import src.shared.types as shared_types
+import src.shared.utils as shared_utils
+
+
+MEASUREMENTS = 20000
+CHUNK_SIZES = [100, 500, 2500]
+REPEATS = 3
+WORKERS = 4
+
+
+def make_pairs(n: int):
+    resolution = utils.HostnameResolution('212.78.221.95', shared_types.Alpha2('NL'), shared_types.Alpha2('NL'))
+    return [({
+        'probe_cc': 'RU',
+        'input': f'https://example-{i}.nl/',
+        'anomaly': True,
+        'confirmed': False,
+        'report_id': f'report-{i}',
+        'measurement_start_time': '2021-06-01T00:00:00Z',
+        'scores': {'analysis': {'blocking_type': 'dns'}},
+    }, resolution) for i in range(n)]
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else MEASUREMENTS
+    pairs = make_pairs(n)
+    print(f'{n} measurements, {WORKERS} workers')
+    start = time.perf_counter()
+    now = shared_utils.now()
+    ooni_types.OONIWebConnectivityTestFrame.from_tests([utils.marshall_measurement(m, r, now) for m, r in pairs])
+    print(f'{"per-test":<8} {"-":>6}  {(time.perf_counter() - start) * 1000:10.2f}ms')
+    start = time.perf_counter()
+    utils.marshall_chunks([pairs], workers=1)
+    print(f'{"serial":<8} {"-":>6}  {(time.perf_counter() - start) * 1000:10.2f}ms')
+    for executor in utils.ooni_executors:
+        for chunk_size in CHUNK_SIZES:
+            chunks = [pairs[i:i + chunk_size] for i in range(0, n, chunk_size)]
+            times = []
+            for _ in range(REPEATS):
+                start = time.perf_counter()
+                utils.marshall_chunks(chunks, executor, WORKERS)
+                times.append(time.perf_counter() - start)
+            print(f'{executor:<8} {chunk_size:>6}  {statistics.median(times) * 1000:10.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
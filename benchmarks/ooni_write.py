@@ -0,0 +1,74 @@
+# taaraxtak
+#
+# benchmarks
+# ooni_write.py - rows per second writing OONIWebConnectivityTests,
+# row by row vs. in bulk.
+#
+# run from the repository root with
+#   python3 -m benchmarks.ooni_write
+
+import time
+import pandas as pd
+import psycopg2
+import testing.postgresql
+
+import src.ooni.types as ooni_types
+import src.shared.types as shared_types
+
+
+SIZES = [1000, 10000, 100000]
+
+
+def make_tests(n: int):
+    t = pd.Timestamp('2021-06-01 12:00:00+00:00')
+    return [
+        ooni_types.OONIWebConnectivityTest(
+            'dns',
+            shared_types.Alpha2('RU'),
+            f'https://example-{i}.nl/',
+            True,
+            False,
+            f'report-{i}',
+            shared_types.Alpha2('NL'),
+            shared_types.Alpha2('NL'),
+            t)
+        for i in range(n)
+    ]
+
+
+def row_by_row(cur, conn, tests):
+    for t in tests:
+        t.write_to_db(cur, conn, commit=False)
+    conn.commit()
+
+
+def bulk(method):
+    def write(cur, conn, tests):
+        ooni_types.OONIWebConnectivityTest.write_many(cur, tests, method=method)
+        conn.commit()
+    return write
+
+
+def main():
+    writers = {
+        'row by row': row_by_row,
+        'execute_values': bulk('values'),
+        'COPY': bulk('copy'),
+    }
+    with testing.postgresql.Postgresql() as postgresql:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        ooni_types.migrate(cur, conn)
+        for n in SIZES:
+            tests = make_tests(n)
+            for name, write in writers.items():
+                cur.execute('TRUNCATE ooni_web_connectivity_test')
+                conn.commit()
+                start = time.perf_counter()
+                write(cur, conn, tests)
+                elapsed = time.perf_counter() - start
+                print(f'{n:>7} rows  {name:<15} {elapsed:8.3f}s  {n / elapsed:>10.0f} rows/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+# taaraxtak
+#
+# benchmarks
+# record_memory.py - bytes per record held in memory: our (slotted) record types,
+# the same records with a `__dict__` each (as they used to be), and as columns.
+# Also, time to validate a batch of tests, looking up the current time per test vs. once.
+#
+# run from the repository root with
+#   python3 -m benchmarks.record_memory [records]
+
+import sys
+import time
+import tracemalloc
+import pandas as pd
+
+import src.ooni.types as ooni_types
+import src.shared.types as shared_types
+import src.shared.utils as shared_utils
+import src.w3techs.types as w3techs_types
+
+
+RECORDS = 100000
+
+
+def dict_record(columns):
+    '''
+    A record type with a `__dict__`, like our types before `__slots__`.
+    (A class per type, as python shares the keys of its instances' dicts.)
+    '''
+    class DictRecord():
+        def __init__(self, row):
+            for name, value in zip(columns, row):
+                setattr(self, name, value)
+    return DictRecord
+
+
+def ooni_row(i: int) -> tuple:
+    return ('dns', shared_types.Alpha2('RU'), f'https://example-{i}.nl/', True, False, f'report-{i}',
+            shared_types.Alpha2('NL'), None, pd.Timestamp('2021-06-01 12:00:00+00:00'))
+
+
+def w3techs_row(i: int) -> tuple:
+    return (f'provider-{i}', None, shared_types.Alpha2('US'), 'all', 'web-hosting', 0.01,
+            pd.Timestamp('2021-06-01 12:00:00+00:00'))
+
+
+def bytes_per_record(make, n: int) -> float:
+    '''How much memory `make(n)` holds on to, per record.'''
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    records = make(n)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del records
+    return (after - before) / n
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else RECORDS
+    # the field values themselves, shared by every layout (so only the records are measured)
+    ooni_rows = [ooni_row(i) for i in range(n)]
+    ooni_tests = ooni_types.OONIWebConnectivityTest.from_rows(ooni_rows)
+    OONIDictRecord = dict_record(ooni_types.OONIWebConnectivityTest.columns)
+    w3techs_rows = [w3techs_row(i) for i in range(n)]
+    W3TechsDictRecord = dict_record(w3techs_types.ProviderMarketshare.columns)
+    layouts = {
+        'OONIWebConnectivityTest': {
+            'with __dict__': lambda n: [OONIDictRecord(t.to_row()) for t in ooni_tests[:n]],
+            '__slots__': lambda n: ooni_types.OONIWebConnectivityTest.from_rows(ooni_rows[:n]),
+            'frame': lambda n: ooni_types.OONIWebConnectivityTestFrame.from_tests(ooni_tests[:n]),
+        },
+        'ProviderMarketshare': {
+            'with __dict__': lambda n: [W3TechsDictRecord(r) for r in w3techs_rows[:n]],
+            '__slots__': lambda n: [w3techs_types.ProviderMarketshare(*r) for r in w3techs_rows[:n]],
+        },
+    }
+    print(f'{n} records')
+    for record, makers in layouts.items():
+        for layout, make in makers.items():
+            print(f'{record:<24} {layout:<14} {bytes_per_record(make, n):8.1f} bytes/record')
+
+    # validating a batch
+    start = time.perf_counter()
+    [ooni_types.OONIWebConnectivityTest(*row) for row in ooni_rows]
+    per_test = time.perf_counter() - start
+    start = time.perf_counter()
+    ooni_types.OONIWebConnectivityTest.from_rows(ooni_rows, now=shared_utils.now())
+    once = time.perf_counter() - start
+    print(f'validating, now per test {per_test * 1000:10.2f}ms')
+    print(f'validating, now once     {once * 1000:10.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
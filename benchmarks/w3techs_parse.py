@@ -0,0 +1,37 @@
+# taaraxtak
+#
+# benchmarks
+# w3techs_parse.py - time to turn a W3Techs page into a DataFrame,
+# with each of `table_parsers`.
+#
+# run from the repository root with
+#   python3 -m benchmarks.w3techs_parse
+
+import time
+import statistics
+
+import src.w3techs.utils as utils
+
+
+PAGES = {
+    'single table': ('test/w3techs-html/ex-single-table.html', False),
+    'double table': ('test/w3techs-html/ex-double-table.html', True),
+}
+REPEATS = 50
+
+
+def main():
+    for page, (pth, double_table) in PAGES.items():
+        with open(pth) as f:
+            html = f.read()
+        for parser in utils.table_parsers:
+            times = []
+            for _ in range(REPEATS):
+                start = time.perf_counter()
+                utils.extract_table(html, double_table=double_table, parser=parser)
+                times.append(time.perf_counter() - start)
+            print(f'{page:<13} {parser:<12} {statistics.median(times) * 1000:8.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
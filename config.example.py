@@ -9,6 +9,18 @@ config = {
         "database": "my-database",
     },
     "tld_cache_dir": "/home/my-user/",
+    # optional: IP-to-country database (defaults to the one in src/ooni/analysis/)
+    # "geoip_database": "/home/my-user/dbip-country-lite-2021-06.mmdb",
+    # optional: where to cache HTTP responses (defaults to ~/.cache/taaraxtak/http; None turns caching off),
+    # and how big the cache may grow, in megabytes (defaults to 256)
+    # "http_cache_directory": "/home/my-user/.cache/taaraxtak/http",
+    # "http_cache_max_mb": 256,
+    # optional: how OONI measurements are marshalled: on a "thread" pool (the default), a "process" pool
+    # or as "asyncio" tasks; with how many workers (1, the default, uses no pool),
+    # and how many measurements to a chunk
+    # "ooni_executor": "thread",
+    # "ooni_workers": 4,
+    # "ooni_chunk_size": 500,
     "logging": {
         "level": logging.DEBUG,
         "handler": "terminal"
@@ -1,6 +1,9 @@
 from config import config
+import argparse
 import logging
-import sys
+import pandas as pd
+import psycopg2
+from datetime import timedelta
 from funcy import partial
 
 from src.shared.utils import configure_logging, run_threaded
@@ -15,18 +18,76 @@ logger = logging.getLogger("taaraxtak:collect")
 # connect to the db
 postgres_config = config['postgres']
 
-if len(sys.argv) != 2:
-    logging.error('You must provide an argument for which job to run')
+
+def utc_timestamp(s: str) -> pd.Timestamp:
+    t = pd.Timestamp(s)
+    if t.tzinfo is None:
+        return t.tz_localize('UTC')
+    return t.tz_convert('UTC')
+
+
+def migrate(postgres_config: dict, partition: bool = False):
+    '''
+    Create or update every table. Safe to run more than once.
+    '''
+    import src.ooni.types as ooni_types
+    import src.w3techs.types as w3techs_types
+    conn = psycopg2.connect(**postgres_config)
+    cur = conn.cursor()
+    for component, types in [('w3techs', w3techs_types), ('ooni', ooni_types)]:
+        applied = types.migrate(cur, conn)
+        logger.info(f'{component}: applied migrations {applied}' if applied else f'{component}: up to date')
+        if partition:
+            types.partition_tables(cur, conn)
+    conn.close()
+
+
+parser = argparse.ArgumentParser(description='Run a taaraxtak job.')
+parser.add_argument('command', help='which job to run: w3techs, ooni, ooni-backfill, recompute-gini or migrate')
+parser.add_argument('--since', '--from', dest='since', type=utc_timestamp,
+                    help='ooni-backfill, recompute-gini: start of the time range (UTC unless given)')
+parser.add_argument('--until', '--to', dest='until', type=utc_timestamp,
+                    help='ooni-backfill, recompute-gini: end of the time range (defaults to now)')
+parser.add_argument('--window-hours', type=float,
+                    help='ooni-backfill: hours of measurements fetched per window')
+parser.add_argument('--workers', type=int,
+                    help='ooni-backfill: how many windows to fetch at once; '
+                    'recompute-gini: how many processes to use')
+parser.add_argument('--partition', action='store_true',
+                    help='migrate: also partition the measurement tables by month (or add next months\' partitions)')
+args = parser.parse_args()
+
+command = args.command
+collect = None
+if command == 'w3techs':
+    from src.w3techs.collect import collect
+elif command == 'ooni':
+    from src.ooni.collect import collect
+elif command == 'ooni-backfill':
+    from src.ooni.collect import backfill
+    if args.since is None:
+        parser.error('ooni-backfill requires --since')
+    until = args.until if args.until is not None else pd.Timestamp.now(tz='UTC')
+    kwargs = {}
+    if args.window_hours is not None:
+        kwargs['window'] = timedelta(hours=args.window_hours)
+    if args.workers is not None:
+        kwargs['workers'] = args.workers
+    collect = partial(backfill, since=args.since, until=until, **kwargs)
+elif command == 'recompute-gini':
+    from src.w3techs.collect import recompute_gini
+    if args.since is None:
+        parser.error('recompute-gini requires --since')
+    until = args.until if args.until is not None else pd.Timestamp.now(tz='UTC')
+    kwargs = {}
+    if args.workers is not None:
+        kwargs['workers'] = args.workers
+    collect = partial(recompute_gini, since=args.since, until=until, **kwargs)
+
+if command == 'migrate':
+    migrate(postgres_config, partition=args.partition)
+elif collect is not None:
+    do_command = partial(collect, postgres_config)
+    run_threaded(do_command)
 else:
-    command = sys.argv[1]
-    collect = None
-    if command == 'w3techs':
-        from src.w3techs.collect import collect
-    elif command == 'ooni':
-        from src.ooni.collect import collect
-
-    if collect is not None:
-        do_command = partial(collect, postgres_config)
-        run_threaded(do_command)
-    else:
-        logging.error(f"Command {command} not found")
+    logging.error(f"Command {command} not found")
@@ -8,16 +8,34 @@
 
 import logging
 import psycopg2
+import pandas as pd
+from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from typing import Tuple
+from psycopg2.extensions import connection
+from psycopg2.extensions import cursor
 
 import src.ooni.utils as utils
+import src.ooni.types as ooni_types
+import src.shared.utils as shared_utils
+import src.shared.schema as schema
 
 
 logger = logging.getLogger("src.ooni.collect")
 
 
+# how much time each backfill window covers
+BACKFILL_WINDOW = timedelta(hours=6)
+# how many backfill windows we fetch at once
+BACKFILL_WORKERS = 4
+
+
 def collect(postgres_config: dict):
     '''
     Collect OONI data and write them to the database.
+
+    Raises `schema.SchemaOutOfDate` if the database needs `python3 run.py migrate` first.
     '''
     logger.info('Beginning OONI.')
 
@@ -25,6 +43,7 @@ def collect(postgres_config: dict):
         conn = psycopg2.connect(**postgres_config)
         cur = conn.cursor()
         logger.debug('Connected to database.')
+        ooni_types.check_schema(cur)
 
         # get most recent time represented in the DB
         maybe_t = utils.get_latest_reading_time(cur)
@@ -32,20 +51,120 @@ def collect(postgres_config: dict):
         if maybe_t is None:
             # query recent measurements (i.e., seed the DB)
             logger.info('Querying recent measurements.')
-            ms = utils.query_recent_measurements()
+            pages = utils.recent_measurement_pages()
         # if there is a measurement
         else:
             # query all the results since that measurmeent
             logger.debug(f'Querying results after {maybe_t}.')
-            ms = utils.query_measurements_after(maybe_t)
-        # marshall them into our format (validating htem in the process)
-        logger.debug(f'Retrieved {len(ms)} results.')
-        ingested = utils.ingest_api_measurements(ms, postgres_config)
-        logger.debug(f'Ingested {len(ingested)} results.')
-        # and write them to the database
-        utils.write_to_db(cur, conn, ingested)
-        logger.info(f'Wrote {len(ingested)} results to database.')
+            pages = utils.measurement_pages_after(maybe_t)
+        # ingest and write one page at a time, as they arrive
+        written = 0
+        timer = shared_utils.StageTimer()
+        for ms in pages:
+            # marshall them into our format (validating htem in the process)
+            logger.debug(f'Retrieved {len(ms)} results.')
+            ingested = utils.ingest_api_measurements(ms, postgres_config, timer=timer)
+            logger.debug(f'Ingested {len(ingested)} results.')
+            # and write them to the database
+            with timer.stage('write'):
+                utils.write_to_db(cur, conn, ingested)
+            written += len(ingested)
+        logger.info(f'Wrote {written} results to database ({timer}).')
 
         logger.info('OONI complete.')
+    except schema.SchemaOutOfDate:
+        # every run would fail the same way until someone migrates, so don't just log it
+        raise
     except Exception as e:
         logger.error(f'Error collecting OONI data {e}')
+
+
+def backfill_window(pool: shared_utils.ConnectionPool, postgres_config: dict,
+                    rate_limiter: shared_utils.RateLimiter,
+                    window: Tuple[pd.Timestamp, pd.Timestamp]) -> int:
+    '''
+    Ingest every measurement in one window, and checkpoint the window.
+    Either all of it is written (with its checkpoint), or none of it is.
+
+    The ingestion watermark is left alone: windows finish in any order, so `backfill`
+    only moves it once the windows before it are done, too.
+    '''
+    start, end = window
+    query = utils.measurements_between_query(start, end)
+    written = 0
+    timer = shared_utils.StageTimer()
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        for ms in utils.iter_api_pages(query, rate_limiter=rate_limiter, strict=True):
+            ingested = utils.ingest_api_measurements(ms, postgres_config, timer=timer)
+            with timer.stage('write'):
+                ingested.write_many(cur)
+            written += len(ingested)
+        ooni_types.OONIBackfillCheckpoint(start, end, written, shared_utils.now()).write_to_db(cur, conn, commit=False)
+        conn.commit()
+        cur.close()
+    logger.debug(f'Backfilled {start} to {end} ({timer}).')
+    return written
+
+
+def advance_watermark_after_backfill(cur: cursor, conn: connection,
+                                     since: pd.Timestamp, until: pd.Timestamp, window: timedelta):
+    '''
+    Move the ingestion watermark up to the end of the windows from `since` that are all backfilled
+    (so incremental collection resumes after them) - as long as there's no gap between it and `since`.
+    '''
+    completed = utils.completed_backfill_windows(cur, since, until)
+    through = utils.backfilled_through(utils.backfill_windows(since, until, window), completed)
+    watermark = utils.get_latest_reading_time(cur)
+    if through is None or (watermark is not None and watermark < since):
+        return
+    logger.info(f'Backfilled everything up to {through}.')
+    utils.advance_watermark(cur, conn, through)
+    conn.commit()
+
+
+def backfill(postgres_config: dict, since: pd.Timestamp, until: pd.Timestamp,
+             window: timedelta = BACKFILL_WINDOW, workers: int = BACKFILL_WORKERS):
+    '''
+    Collect all OONI data between `since` and `until`.
+
+    The range is split into windows, which are fetched concurrently (sharing one
+    request rate). Each window is checkpointed in the database once it's written,
+    so running this again skips the windows that are already done. Once they're all
+    done (up to a window that failed), the ingestion watermark moves past them.
+
+    Raises `schema.SchemaOutOfDate` if the database needs `python3 run.py migrate` first.
+    '''
+    logger.info(f'Beginning OONI backfill from {since} to {until}.')
+    pool = shared_utils.ConnectionPool(postgres_config, maxconn=workers)
+    try:
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            # backfills can run against an older database: make sure it's been migrated
+            ooni_types.check_schema(cur)
+            completed = utils.completed_backfill_windows(cur, since, until)
+            cur.close()
+        windows = [w for w in utils.backfill_windows(since, until, window)
+                   if not utils.is_backfilled(w, completed)]
+        logger.info(f'{len(windows)} window(s) left to backfill.')
+        rate_limiter = shared_utils.RateLimiter(utils.OONI_SLEEP_PAGINATE)
+        failed = 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(backfill_window, pool, postgres_config, rate_limiter, w): w
+                       for w in windows}
+            for future in as_completed(futures):
+                start, end = futures[future]
+                try:
+                    logger.info(f'Backfilled {future.result()} results from {start} to {end}.')
+                except Exception as e:
+                    failed += 1
+                    logger.error(f'Error backfilling OONI data from {start} to {end}: {e}')
+        if failed:
+            logger.warning(f'{failed} window(s) failed. Run the backfill again to retry them.')
+        with pool.connection() as conn:
+            cur = conn.cursor()
+            advance_watermark_after_backfill(cur, conn, since, until, window)
+            cur.close()
+        logger.info('OONI backfill complete.')
+    finally:
+        pool.close()
@@ -3,8 +3,8 @@
 # 2021
 #
 # ooni
-# create-tables.py - defines the Postgres tables.
-# (see file by the same name in repository's root).
+# types.py - defines the Postgres tables, and their migrations.
+# (run them with `python3 run.py migrate`.)
 
 import logging
 import pandas as pd
@@ -12,15 +12,35 @@ from IPy import IP
 
 import src.shared.utils as shared_utils
 import src.shared.types as shared_types
+import src.shared.schema as schema
 
 from psycopg2.extensions import cursor
 from psycopg2.extensions import connection
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+
+def is_public_ip(ip) -> bool:
+    '''
+    Whether `ip` is a valid, public IP (without raising for anything else).
+    '''
+    try:
+        return IP(ip).iptype() == 'PUBLIC'
+    except (ValueError, TypeError):
+        return False
+
+
+def are_optional_alpha2s(values: pd.Series) -> pd.Series:
+    return values.isna() | (shared_utils.str_lengths(values) == 2)
 
 
 #
 # Cacheing IP
 #
-class IPHostnameMapping:
+class IPHostnameMapping(shared_types.BatchValidated):
+    __slots__ = ('ip', 'hostname', 'time')
+
     def __init__(
         self,
         ip: str,
@@ -38,19 +58,27 @@ class IPHostnameMapping:
         assert(type(time) == pd.Timestamp)
         self.time = time
 
-    def create_table(
-            self,
-            cur: cursor,
-            conn: connection):
-        cmd = """
-          CREATE TABLE ip_hostname_mapping (
-             hostname                  VARCHAR NOT NULL,
-             ip                        VARCHAR NOT NULL,
-             time                      TIMESTAMPTZ NOT NULL
-          )
-        """
-        cur.execute(cmd)
-        conn.commit()
+    columns = ('hostname', 'ip', 'time')
+    checks = [
+        ("hostname isn't a non-empty string", lambda df: shared_utils.are_nonempty_strs(df['hostname'])),
+        ("ip isn't a public IP", lambda df: df['ip'].map(is_public_ip)),
+        ("time isn't a time", lambda df: shared_utils.are_times(df['time'])),
+    ]
+
+    @classmethod
+    def validate_batch(cls, df: pd.DataFrame) -> shared_types.ValidatedBatch:
+        accepted, rejected = super().validate_batch(df)
+        # like `__init__`, save each IP as a (normalized) string
+        accepted = accepted.assign(ip=accepted['ip'].map(lambda ip: IP(ip).strNormal()))
+        return shared_types.ValidatedBatch(accepted, rejected)
+
+    ddl = """
+      CREATE TABLE IF NOT EXISTS ip_hostname_mapping (
+         hostname                  VARCHAR NOT NULL,
+         ip                        VARCHAR NOT NULL,
+         time                      TIMESTAMPTZ NOT NULL
+      )
+    """
 
     def write_to_db(
             self,
@@ -75,7 +103,7 @@ class IPHostnameMapping:
         return f'{self.time: self.hostname->self.ip}'
 
 
-class OONIWebConnectivityTest():
+class OONIWebConnectivityTest(shared_types.BatchValidated):
     '''
     Class to capture results of an OONI web connectivity test.
       - https://ooni.org/nettest/web-connectivity/
@@ -83,7 +111,16 @@ class OONIWebConnectivityTest():
 
     This is where validation happens.
     TODO - Check for SQL injection attacks.
+
+    To validate many tests, use `from_rows`, which only looks up the current time once -
+    or, to keep the valid ones when some aren't, `validate_batch`, which does it a column at a time.
     '''
+    # no `__dict__` per test (see benchmarks/record_memory.py)
+    __slots__ = (
+        'blocking_type', 'probe_alpha2', 'input_url', 'anomaly', 'confirmed', 'report_id',
+        'input_ip_alpha2', 'tld_jurisdiction_alpha2', 'measurement_start_time',
+    )
+
     def __init__(
            self,
            blocking_type: str,
@@ -94,7 +131,8 @@ class OONIWebConnectivityTest():
            report_id: str,
            input_ip_alpha2: shared_types.Alpha2,
            tld_jurisdiction_alpha2: shared_types.Alpha2,
-           measurement_start_time: pd.Timestamp
+           measurement_start_time: pd.Timestamp,
+           now: Optional[pd.Timestamp] = None,
     ):
         # we only want stuff where blocking actually happened
         assert(blocking_type is not False)
@@ -119,7 +157,7 @@ class OONIWebConnectivityTest():
         assert((type(input_ip_alpha2) == shared_types.Alpha2) or
                (input_ip_alpha2 is None))
         if input_ip_alpha2 is None:
-            self.input_ip_alpha2 = None
+            self.input_ip_alpha2: Optional[str] = None
         else:
             self.input_ip_alpha2 = str(input_ip_alpha2)
 
@@ -127,40 +165,38 @@ class OONIWebConnectivityTest():
         assert((type(tld_jurisdiction_alpha2) == shared_types.Alpha2) or
                (tld_jurisdiction_alpha2 is None))
         if tld_jurisdiction_alpha2 is None:
-            self.tld_jurisdiction_alpha2 = None
+            self.tld_jurisdiction_alpha2: Optional[str] = None
         else:
             self.tld_jurisdiction_alpha2 = str(tld_jurisdiction_alpha2)
 
         assert(type(measurement_start_time) == pd.Timestamp)
+        if now is None:
+            now = shared_utils.now()
         # if the timestamp is in the future...
-        if shared_utils.is_in_future(measurement_start_time):
+        if shared_utils.is_in_future(measurement_start_time, now):
             logging.debug(f'Time is in future: {measurement_start_time}. Setting time to now.')
             # set the time to now.
-            self.measurement_start_time = shared_utils.now()
+            self.measurement_start_time = now
         # otherwise
         else:
             # set it to whenever it was reported
             self.measurement_start_time = measurement_start_time
 
-    def create_table(
-            self,
-            cur: cursor,
-            conn: connection):
-        cmd = """
-          CREATE TABLE ooni_web_connectivity_test (
-             blocking_type             VARCHAR,
-             probe_alpha2              CHAR(2) NOT NULL,
-             input_url                 VARCHAR NOT NULL,
-             anomaly                   BOOLEAN NOT NULL,
-             confirmed                 BOOLEAN NOT NULL,
-             report_id                 VARCHAR NOT NULL,
-             input_ip_alpha2           CHAR(2),
-             tld_jurisdiction_alpha2   CHAR(2),
-             measurement_start_time    TIMESTAMPTZ NOT NULL
-          )
-        """
-        cur.execute(cmd)
-        conn.commit()
+    ddl = """
+      CREATE TABLE IF NOT EXISTS ooni_web_connectivity_test (
+         blocking_type             VARCHAR,
+         probe_alpha2              CHAR(2) NOT NULL,
+         input_url                 VARCHAR NOT NULL,
+         anomaly                   BOOLEAN NOT NULL,
+         confirmed                 BOOLEAN NOT NULL,
+         report_id                 VARCHAR NOT NULL,
+         input_ip_alpha2           CHAR(2),
+         tld_jurisdiction_alpha2   CHAR(2),
+         measurement_start_time    TIMESTAMPTZ NOT NULL,
+         CONSTRAINT ooni_web_connectivity_test_natural_key
+            UNIQUE (report_id, input_url, measurement_start_time)
+      )
+    """
 
     def write_to_db(
             self,
@@ -175,6 +211,7 @@ class OONIWebConnectivityTest():
             input_ip_alpha2, tld_jurisdiction_alpha2, measurement_start_time)
             VALUES
             (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT DO NOTHING
             """, (self.blocking_type,
                   self.probe_alpha2,
                   self.input_url,
@@ -188,6 +225,93 @@ class OONIWebConnectivityTest():
             return conn.commit()
         return
 
+    # columns of `ooni_web_connectivity_test`, in the order of `to_row`
+    columns = (
+        'blocking_type', 'probe_alpha2', 'input_url', 'anomaly', 'confirmed', 'report_id',
+        'input_ip_alpha2', 'tld_jurisdiction_alpha2', 'measurement_start_time',
+    )
+
+    # the rules of `__init__`, for `validate_batch`
+    checks = [
+        # we only want stuff where blocking actually happened
+        ('blocking_type is False', lambda df: df['blocking_type'].map(lambda b: b is not False)),
+        ("probe_alpha2 isn't an alpha2", lambda df: shared_utils.str_lengths(df['probe_alpha2']) == 2),
+        ("input_url isn't a non-empty string", lambda df: shared_utils.are_nonempty_strs(df['input_url'])),
+        ("anomaly isn't a bool", lambda df: shared_utils.are_bools(df['anomaly'])),
+        ("confirmed isn't a bool", lambda df: shared_utils.are_bools(df['confirmed'])),
+        ("report_id isn't a non-empty string", lambda df: shared_utils.are_nonempty_strs(df['report_id'])),
+        ("input_ip_alpha2 isn't an alpha2", lambda df: are_optional_alpha2s(df['input_ip_alpha2'])),
+        ("tld_jurisdiction_alpha2 isn't an alpha2", lambda df: are_optional_alpha2s(df['tld_jurisdiction_alpha2'])),
+        ("measurement_start_time isn't a time", lambda df: shared_utils.are_times(df['measurement_start_time'])),
+    ]
+
+    @classmethod
+    def validate_batch(
+            cls,
+            df: pd.DataFrame,
+            now: Optional[pd.Timestamp] = None,
+    ) -> shared_types.ValidatedBatch:
+        '''
+        Validate a batch of tests, with a column per field (alpha2s as strings), a column at a time.
+        Tests that break a rule are rejected, with the reason; like `__init__`,
+        the accepted tests' start times in the future are set to `now` (by default, the current time).
+        '''
+        accepted, rejected = super().validate_batch(df)
+        if now is None:
+            now = shared_utils.now()
+        times = pd.to_datetime(accepted['measurement_start_time'], utc=True)
+        in_future = times > now
+        if in_future.any():
+            logging.debug(f'{in_future.sum()} times are in future. Setting them to now.')
+        accepted = accepted.assign(measurement_start_time=times.mask(in_future, now)) \
+                           .astype({'anomaly': bool, 'confirmed': bool})
+        return shared_types.ValidatedBatch(accepted, rejected)
+
+    @classmethod
+    def from_rows(
+            cls,
+            rows: Iterable[tuple],
+            now: Optional[pd.Timestamp] = None,
+    ) -> List['OONIWebConnectivityTest']:
+        '''
+        Validate many tests at once, given as tuples of `__init__`'s arguments.
+        They're all checked against the same `now` (by default, the current time), which we only look up once.
+        '''
+        if now is None:
+            now = shared_utils.now()
+        return [cls(blocking_type, probe_alpha2, input_url, anomaly, confirmed, report_id,
+                    input_ip_alpha2, tld_jurisdiction_alpha2, measurement_start_time, now=now)
+                for (blocking_type, probe_alpha2, input_url, anomaly, confirmed, report_id,
+                     input_ip_alpha2, tld_jurisdiction_alpha2, measurement_start_time) in rows]
+
+    def to_row(self) -> tuple:
+        return (self.blocking_type,
+                self.probe_alpha2,
+                self.input_url,
+                self.anomaly,
+                self.confirmed,
+                self.report_id,
+                self.input_ip_alpha2,
+                self.tld_jurisdiction_alpha2,
+                self.measurement_start_time)
+
+    @classmethod
+    def write_many(
+            cls,
+            cur: cursor,
+            rows: Iterable['OONIWebConnectivityTest'],
+            method='copy',
+    ):
+        '''
+        Write many tests at once: with one `COPY`,
+        or with multi-row `INSERT`s if `method='values'`.
+        Tests we already have (by report, input URL and start time) are skipped.
+        Doesn't commit.
+        '''
+        shared_utils.write_rows(cur, 'ooni_web_connectivity_test', cls.columns,
+                                (r.to_row() for r in rows), method=method,
+                                skip_conflicts=True)
+
     def __str__(self):
         # TODO make DRY with write_to_db?
         # TODO do this in general?
@@ -198,17 +322,293 @@ class OONIWebConnectivityTest():
         return self.__str__()
 
 
-def create_tables(cur: cursor, conn: connection):
-    IPHostnameMapping('198.35.26.96', 'wikipedia.org', shared_utils.now()).create_table(cur, conn)
-    # dummy data
-    OONIWebConnectivityTest(
-        'example',
-        shared_types.Alpha2('US'),
-        'example',
-        False,
-        False,
-        'example',
-        shared_types.Alpha2('US'),
-        shared_types.Alpha2('US'),
-        pd.Timestamp('2000-01-01 21:41:37+00:00')
-    ).create_table(cur, conn)
+class OONIWebConnectivityTestFrame():
+    '''
+    Many `OONIWebConnectivityTest`s as one DataFrame, with a column per field
+    (so they can be handed between processes, and written, without a Python object per test).
+
+    Each test is validated by `OONIWebConnectivityTest` before it gets here;
+    this only checks the columns. Missing alpha2s are None.
+    Iterating over it gives a named tuple per test, with the same fields.
+    '''
+    def __init__(self, df: pd.DataFrame):
+        assert(list(df.columns) == list(OONIWebConnectivityTest.columns))
+
+        assert(shared_utils.are_nonempty_strs(df['input_url']).all())
+
+        assert(shared_utils.are_nonempty_strs(df['report_id']).all())
+
+        assert((shared_utils.str_lengths(df['probe_alpha2']) == 2).all())
+
+        assert(pd.api.types.is_datetime64_any_dtype(df['measurement_start_time']))
+        assert(df['measurement_start_time'].notna().all())
+
+        self.df = df
+
+    @classmethod
+    def from_tests(cls, tests: Iterable[OONIWebConnectivityTest]) -> 'OONIWebConnectivityTestFrame':
+        df = pd.DataFrame.from_records([t.to_row() for t in tests], columns=OONIWebConnectivityTest.columns)
+        df['measurement_start_time'] = pd.to_datetime(df['measurement_start_time'], utc=True)
+        return cls(df)
+
+    @classmethod
+    def concat(cls, frames: Iterable['OONIWebConnectivityTestFrame']) -> 'OONIWebConnectivityTestFrame':
+        dfs = [frame.df for frame in frames]
+        if not dfs:
+            return cls.from_tests([])
+        return cls(pd.concat(dfs, ignore_index=True))
+
+    def rows(self) -> Iterable[tuple]:
+        '''Rows in the order of `OONIWebConnectivityTest.columns`, with None for missing values.'''
+        df = self.df.astype(object)
+        return df.where(df.notna(), None).itertuples(index=False, name=None)
+
+    def newest(self) -> Optional[pd.Timestamp]:
+        '''The latest `measurement_start_time`, or None if there are no tests.'''
+        if len(self.df) == 0:
+            return None
+        return self.df['measurement_start_time'].max()
+
+    def write_many(
+            self,
+            cur: cursor,
+            method='copy',
+    ):
+        '''
+        Write every test at once, like `OONIWebConnectivityTest.write_many`.
+        Doesn't commit.
+        '''
+        shared_utils.write_rows(cur, 'ooni_web_connectivity_test', OONIWebConnectivityTest.columns,
+                                self.rows(), method=method, skip_conflicts=True)
+
+    def __iter__(self):
+        return self.df.itertuples(index=False, name='OONIWebConnectivityTestRow')
+
+    def __len__(self):
+        return len(self.df)
+
+    def __str__(self):
+        return str(self.df)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class OONIBackfillCheckpoint(shared_types.BatchValidated):
+    '''
+    Records that a backfill window [window_start, window_end) was fully ingested.
+    '''
+    __slots__ = ('window_start', 'window_end', 'measurements', 'completed_at')
+
+    def __init__(
+        self,
+        window_start: pd.Timestamp,
+        window_end: pd.Timestamp,
+        measurements: int,
+        completed_at: pd.Timestamp,
+    ):
+        assert(type(window_start) == pd.Timestamp)
+        assert(type(window_end) == pd.Timestamp)
+        assert(window_start < window_end)
+        self.window_start = window_start
+        self.window_end = window_end
+
+        assert(type(measurements) == int)
+        assert(measurements >= 0)
+        self.measurements = measurements
+
+        assert(type(completed_at) == pd.Timestamp)
+        self.completed_at = completed_at
+
+    columns = ('window_start', 'window_end', 'measurements', 'completed_at')
+    checks = [
+        ("window_start isn't a time", lambda df: shared_utils.are_times(df['window_start'])),
+        ("window_end isn't a time", lambda df: shared_utils.are_times(df['window_end'])),
+        ("window_start isn't before window_end",
+         lambda df: shared_utils.parse_times(df['window_start']) < shared_utils.parse_times(df['window_end'])),
+        ("measurements isn't a count", lambda df: shared_utils.are_counts(df['measurements'])),
+        ("completed_at isn't a time", lambda df: shared_utils.are_times(df['completed_at'])),
+    ]
+
+    ddl = """
+      CREATE TABLE IF NOT EXISTS ooni_backfill_checkpoint (
+         window_start              TIMESTAMPTZ NOT NULL,
+         window_end                TIMESTAMPTZ NOT NULL,
+         measurements              INTEGER NOT NULL,
+         completed_at              TIMESTAMPTZ NOT NULL
+      )
+    """
+
+    def write_to_db(
+            self,
+            cur: cursor,
+            conn: connection,
+            commit=True,
+    ):
+        cur.execute(
+            """
+            INSERT INTO ooni_backfill_checkpoint
+            (window_start, window_end, measurements, completed_at)
+            VALUES
+            (%s, %s, %s, %s)
+            """, (self.window_start,
+                  self.window_end,
+                  self.measurements,
+                  self.completed_at))
+        if commit:
+            return conn.commit()
+        return
+
+    def __str__(self):
+        return f'{self.window_start} - {self.window_end}: {self.measurements} measurements ({self.completed_at})'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+#
+# Migrations
+#
+# Append new ones to `migrations`; never edit one that's been released.
+# Every `CREATE` is `IF NOT EXISTS`, so databases from before `schema_version`
+# are brought up to date by the same migrations as new ones.
+# Each migration has its own SQL, so changing a type's `ddl` (which describes the table
+# as the migrations leave it) never changes a migration.
+#
+def create_base_tables(cur: cursor):
+    '''
+    Migration: the original OONI tables.
+    '''
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS ip_hostname_mapping (
+         hostname                  VARCHAR NOT NULL,
+         ip                        VARCHAR NOT NULL,
+         time                      TIMESTAMPTZ NOT NULL
+      )
+    """)
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS ooni_web_connectivity_test (
+         blocking_type             VARCHAR,
+         probe_alpha2              CHAR(2) NOT NULL,
+         input_url                 VARCHAR NOT NULL,
+         anomaly                   BOOLEAN NOT NULL,
+         confirmed                 BOOLEAN NOT NULL,
+         report_id                 VARCHAR NOT NULL,
+         input_ip_alpha2           CHAR(2),
+         tld_jurisdiction_alpha2   CHAR(2),
+         measurement_start_time    TIMESTAMPTZ NOT NULL
+      )
+    """)
+
+
+def add_natural_key(cur: cursor):
+    '''
+    Migration: make (report_id, input_url, measurement_start_time) unique in
+    `ooni_web_connectivity_test`, deleting all but one copy of duplicated rows first.
+    Does nothing if the table already has the constraint.
+    '''
+    cur.execute("""
+      SELECT 1 FROM pg_constraint
+      WHERE conname = 'ooni_web_connectivity_test_natural_key'
+      AND conrelid = 'ooni_web_connectivity_test'::regclass
+    """)
+    if cur.fetchone():
+        return
+    cur.execute("""
+      DELETE FROM ooni_web_connectivity_test
+      WHERE ctid IN (
+        SELECT ctid FROM (
+          SELECT ctid, row_number() OVER (
+            PARTITION BY report_id, input_url, measurement_start_time
+            ORDER BY ctid
+          ) AS copy_number
+          FROM ooni_web_connectivity_test
+        ) copies
+        WHERE copy_number > 1
+      )
+    """)
+    logging.info(f'Deleted {cur.rowcount} duplicate OONI measurements.')
+    cur.execute("""
+      ALTER TABLE ooni_web_connectivity_test
+      ADD CONSTRAINT ooni_web_connectivity_test_natural_key
+      UNIQUE (report_id, input_url, measurement_start_time)
+    """)
+
+
+def create_backfill_table(cur: cursor):
+    '''
+    Migration: checkpoints for `run.py ooni-backfill`.
+    '''
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS ooni_backfill_checkpoint (
+         window_start              TIMESTAMPTZ NOT NULL,
+         window_end                TIMESTAMPTZ NOT NULL,
+         measurements              INTEGER NOT NULL,
+         completed_at              TIMESTAMPTZ NOT NULL
+      )
+    """)
+
+
+def create_indexes(cur: cursor):
+    '''
+    Migration: index the columns we look OONI data up by.
+    '''
+    # latest measurement (`get_latest_reading_time`) and time windows in Grafana
+    cur.execute("""
+      CREATE INDEX IF NOT EXISTS ooni_web_connectivity_test_time
+      ON ooni_web_connectivity_test (measurement_start_time)
+    """)
+    # most recent IP of a hostname (`retrieve_ip`, `retrieve_ips`)
+    cur.execute("""
+      CREATE INDEX IF NOT EXISTS ip_hostname_mapping_hostname_time
+      ON ip_hostname_mapping (hostname, time DESC)
+    """)
+
+
+def seed_watermark(cur: cursor):
+    '''
+    Migration: start OONI's ingestion watermark at the newest measurement we have.
+    '''
+    cur.execute("""
+      INSERT INTO ingestion_watermark (collector, watermark, updated_at)
+      SELECT 'ooni', max(measurement_start_time), now() FROM ooni_web_connectivity_test
+      HAVING max(measurement_start_time) IS NOT NULL
+      ON CONFLICT (collector) DO NOTHING
+    """)
+
+
+migrations = [
+    schema.Migration(1, 'create ip_hostname_mapping, ooni_web_connectivity_test', create_base_tables),
+    schema.Migration(2, 'natural key for ooni_web_connectivity_test', add_natural_key),
+    schema.Migration(3, 'create ooni_backfill_checkpoint', create_backfill_table),
+    schema.Migration(4, 'indexes for lookups by time and hostname', create_indexes),
+    schema.Migration(5, 'seed the ooni ingestion watermark', seed_watermark),
+]
+
+
+def migrate(cur: cursor, conn: connection) -> List[int]:
+    '''
+    Bring the OONI tables (and the shared ones) up to date. Returns the versions applied.
+    '''
+    shared_types.migrate(cur, conn)
+    return schema.migrate(cur, conn, 'ooni', migrations)
+
+
+def check_schema(cur: cursor) -> None:
+    '''
+    Raise `schema.SchemaOutOfDate` if the OONI tables (or the shared ones) need migrating.
+    '''
+    shared_types.check_schema(cur)
+    schema.check_schema_version(cur, 'ooni', migrations)
+
+
+def partition_tables(cur: cursor, conn: connection):
+    '''
+    Optional: partition `ooni_web_connectivity_test` by month (after `migrate`).
+    Run it again every so often to add partitions for the coming months.
+    '''
+    schema.partition_by_month(
+        cur, conn, 'ooni_web_connectivity_test', 'measurement_start_time',
+        unique={'ooni_web_connectivity_test_natural_key': 'report_id, input_url, measurement_start_time'})
+    create_indexes(cur)
+    conn.commit()
@@ -1,26 +1,40 @@
+import asyncio
 import logging
+import threading
 import requests
 from time import sleep
 from datetime import datetime
 import socket
 import urllib.parse
 import geoip2.database
+from maxminddb import MODE_MMAP
 import pandas as pd
+from typing import NamedTuple
 from typing import Tuple
 from datetime import timedelta
 import tldextract
 import idna
-import psycopg2
-from multiprocessing import Pool
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.util import Finalize
 from os import path
+from os import getpid
 
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
 from typing import List
+from typing import cast
 from IPy import IP
 from funcy import partial
 
 from config import config
 
 import src.shared.utils as shared_utils
+import src.shared.http_cache as http_cache
 
 # types
 from psycopg2.extensions import cursor
@@ -45,59 +59,107 @@ logger = logging.getLogger("src.ooni.utils")
 #
 
 
-def api_query(query: str, results=[], queries=1, max_queries=None) -> list:
-    '''Recursively query the API, up to `max_queries`. (If `max_queries=None`, we
-    will paginate through the results as long as they run).
+OONI_API_BASE_URL = 'https://api.ooni.io/api/v1/'
+
+
+def iter_api_pages(query: str, max_queries: Optional[int] = None,
+                   session: Optional[requests.Session] = None,
+                   rate_limiter: Optional[shared_utils.RateLimiter] = None,
+                   strict: bool = False,
+                   cache: Optional[http_cache.HTTPCache] = None) -> Iterator[list]:
+    '''
+    Query the API, yielding each page of results as it arrives, for up to `max_queries`
+    pages. (If `max_queries=None`, we will paginate through the results as long as they run).
+
+    Pages are fetched over one `requests.Session` (pass `session` to share one),
+    through the HTTP cache (`cache`, or by default `http_cache.get_http_cache()`).
+    Pass a `rate_limiter` to share a request rate with other threads.
+    If we have an error, we stop; if `strict`, we raise it.
     '''
-    base_url = 'https://api.ooni.io/api/v1/'
-    query = '{!s}{!s}'.format(base_url, query)
+    my_session = session if session is not None else requests.Session()
+    queries = 0
     try:
-        resp = requests.get(query).json()
-        results = results + resp['results']
-        next_url = resp['metadata']['next_url']
-        if max_queries is not None and queries > max_queries:
-            return results
-        if next_url:
-            # sleep so as to not overwhelm the endpoint
-            sleep(OONI_SLEEP_PAGINATE)
+        while query:
+            if rate_limiter is not None:
+                rate_limiter.wait()
+            resp = http_cache.cached_get(my_session, f'{OONI_API_BASE_URL}{query}', cache=cache).json()
+            queries += 1
+            yield resp['results']
+            next_url = resp['metadata']['next_url']
+            if (max_queries is not None and queries >= max_queries) or not next_url:
+                return
+            if rate_limiter is None:
+                # sleep so as to not overwhelm the endpoint
+                sleep(OONI_SLEEP_PAGINATE)
             # remove base url to perfrom the query
-            next_url = next_url.split('api/v1/')[1]
-            return api_query(next_url, results, queries + 1, max_queries)
-        return results
+            query = next_url.split('api/v1/')[1]
     except Exception as inst:
-        # if we have an error,
+        if strict:
+            raise
+        # if we have an error, stop here.
+        # (the caller keeps whatever pages it's already been given)
         logger.warning("Error querying API: {!s}".format(inst))
-        # just return what we've collected
-        # (at worst, `results` will be `[]`)
-        return results
+    finally:
+        if session is None:
+            my_session.close()
+
+
+def api_query(query: str, max_queries: Optional[int] = None, **kwargs) -> list:
+    '''Query the API, up to `max_queries` pages. (If `max_queries=None`, we
+    will paginate through the results as long as they run).
+    If we have an error, we just return what we've collected.
+    '''
+    results: list = []
+    for page in iter_api_pages(query, max_queries=max_queries, **kwargs):
+        results.extend(page)
+    return results
 
 
 BASE_QUERY = 'measurements?test_name=web_connectivity&anomaly=true&order_by=test_start_time&limit=1000'
 
 
+def recent_measurement_pages(max_queries=5, **kwargs) -> Iterator[list]:
+    '''Pages of recent measurements (newest first), up to specified maximum number of queries.'''
+    return iter_api_pages(BASE_QUERY, max_queries=max_queries, **kwargs)
+
+
 def query_recent_measurements(max_queries=5) -> list:
     '''Queries all recent measurements, up to specified maximum number of queries.'''
     return api_query(BASE_QUERY, max_queries=max_queries)
 
 
-def query_measurements_after(time: datetime, **kwargs) -> list:
-    '''Queries all measurements after time.'''
-    def fmt_dt(t: datetime):
-        return t.strftime("%Y-%m-%dT%H:%M:%S")
+def fmt_api_dt(t: datetime) -> str:
     # format timezone-aware date into UTC fo querying
-    utc_dt = shared_utils.to_utc(time)
+    return shared_utils.to_utc(t).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def measurements_after_query(time: datetime) -> str:
     # format it into the query url
-    dt_str = fmt_dt(utc_dt)
-    query_str = BASE_QUERY + f'&since={dt_str}'
+    dt_str = fmt_api_dt(time)
+    # oldest first, so that every page we've written is a safe place to resume from
+    return BASE_QUERY + f'&since={dt_str}&order=asc'
+
+
+def measurements_between_query(since: datetime, until: datetime) -> str:
+    return BASE_QUERY + f'&since={fmt_api_dt(since)}&until={fmt_api_dt(until)}&order=asc'
+
+
+def measurement_pages_after(time: datetime, **kwargs) -> Iterator[list]:
+    '''Pages of all measurements after time, oldest first.'''
+    return iter_api_pages(measurements_after_query(time), **kwargs)
+
+
+def query_measurements_after(time: datetime, **kwargs) -> list:
+    '''Queries all measurements after time.'''
     # issue the query
-    return api_query(query_str, **kwargs)
+    return api_query(measurements_after_query(time), **kwargs)
 
 
 def get_blocking_type(measurement) -> Optional[str]:
     '''Get blocking type, if available.'''
     try:
         return measurement['scores']['analysis']['blocking_type']
-    except KeyError:
+    except (KeyError, TypeError):
         return None
 
 #
@@ -113,78 +175,303 @@ def get_hostname(url: str) -> str:
     return netloc
 
 
+def get_measurement_hostname(measurement: dict) -> Optional[str]:
+    '''
+    The hostname of a measurement's input URL, or None if it hasn't got one
+    (it'll be rejected when it's validated).
+    '''
+    url = measurement.get('input')
+    if not (isinstance(url, str) and url):
+        return None
+    try:
+        return get_hostname(url) or None
+    except ValueError:
+        # e.g. a port that isn't a number
+        return None
+
+
+# how long we remember that a hostname doesn't exist (NXDOMAIN)
+# or resolves to an IP that isn't public
+DNS_NEGATIVE_EXPIRY = timedelta(hours=1)
+# hostnames we know not to resolve to a public IP -> True
+dns_negative_cache = shared_utils.LRUCache(maxsize=20000)
+
+# getaddrinfo errors that mean the hostname has no address
+NO_ADDRESS_ERRORS = {getattr(socket, e) for e in ('EAI_NONAME', 'EAI_NODATA', 'EAI_ADDRFAMILY')
+                     if hasattr(socket, e)}
+
+# how many DNS lookups `resolve_many` keeps in flight at once
+DNS_CONCURRENCY = 64
+# how many seconds `resolve_many` waits for any one lookup
+DNS_TIMEOUT = 5.0
+
+
+def remember_no_public_ip(hostname: str) -> None:
+    dns_negative_cache.put(hostname, True, shared_utils.now() + DNS_NEGATIVE_EXPIRY)
+
+
 def fetch_ip_from_hostname(hostname: str) -> Optional[str]:
+    if hostname in dns_negative_cache:
+        return None
     try:
         ip = socket.gethostbyname(hostname)
         # make sure it's an IP
         parsed_ip = IP(ip)
         # make sure that IP is a public one
+        if parsed_ip.iptype() != 'PUBLIC':
+            remember_no_public_ip(hostname)
         assert(parsed_ip.iptype() == 'PUBLIC')
         # if all good, return it
         return ip
     except Exception as inst:
+        if isinstance(inst, socket.gaierror) and inst.errno in NO_ADDRESS_ERRORS:
+            remember_no_public_ip(hostname)
         logger.warning(f"Error looking up IP of hostname {hostname}: {inst}")
         return None
 
+
+# a DNS lookup: hostname -> its IPv4 addresses
+Lookup = Callable[[str], Awaitable[List[str]]]
+
+
+def getaddrinfo_lookup(executor: Executor) -> Lookup:
+    '''
+    A `Lookup` that uses the system resolver (`getaddrinfo`) on `executor`.
+    '''
+    async def lookup(hostname: str) -> List[str]:
+        loop = asyncio.get_event_loop()
+        infos = await loop.run_in_executor(
+            executor, partial(socket.getaddrinfo, hostname, None, socket.AF_INET, socket.SOCK_STREAM))
+        return [info[4][0] for info in infos]
+    return lookup
+
+
+async def resolve_many_async(hostnames: List[str], lookup: Lookup,
+                             concurrency: int = DNS_CONCURRENCY,
+                             timeout: float = DNS_TIMEOUT) -> Dict[str, Optional[str]]:
+    '''
+    Look up a public IP for each hostname, with at most `concurrency` lookups in flight.
+    Hostnames that don't exist, or have no public IP, are remembered in `dns_negative_cache`.
+
+    A lookup we've stopped waiting on (after `timeout` seconds) keeps its place in flight
+    until it actually finishes, so a lookup never waits behind it - and its timeout
+    only starts once it's running. Lookups still in flight when we're done are cancelled.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    lookups: List[asyncio.Future] = []
+
+    async def resolve(hostname: str) -> Optional[str]:
+        if hostname in dns_negative_cache:
+            return None
+        await semaphore.acquire()
+        looking_up = asyncio.ensure_future(lookup(hostname))
+        looking_up.add_done_callback(lambda _: semaphore.release())
+        lookups.append(looking_up)
+        # (unlike `wait_for`, this doesn't cancel the lookup when it times out)
+        done, _ = await asyncio.wait([looking_up], timeout=timeout)
+        if not done:
+            logger.warning(f"Timed out looking up IP of hostname {hostname}")
+            return None
+        try:
+            ips = looking_up.result()
+        except Exception as inst:
+            if isinstance(inst, socket.gaierror) and inst.errno in NO_ADDRESS_ERRORS:
+                remember_no_public_ip(hostname)
+            logger.warning(f"Error looking up IP of hostname {hostname}: {inst}")
+            return None
+        try:
+            return next(ip for ip in ips if ooni_types.is_public_ip(ip))
+        except (StopIteration, ValueError):
+            logger.warning(f"No public IP for hostname {hostname}: {ips}")
+            remember_no_public_ip(hostname)
+            return None
+
+    try:
+        ips = await asyncio.gather(*[resolve(h) for h in hostnames])
+    finally:
+        for looking_up in lookups:
+            looking_up.cancel()
+        # (and collect any errors of lookups that timed out)
+        await asyncio.gather(*lookups, return_exceptions=True)
+    return dict(zip(hostnames, ips))
+
+
+def resolve_many(hostnames: List[str], lookup: Optional[Lookup] = None,
+                 concurrency: int = DNS_CONCURRENCY,
+                 timeout: float = DNS_TIMEOUT) -> Dict[str, Optional[str]]:
+    '''
+    Concurrently look up a public IP for each distinct hostname (see `resolve_many_async`).
+    By default, uses the system resolver; pass `lookup` to use another one.
+
+    The system resolver's lookups run on a thread each, which we can't interrupt:
+    before returning, we wait for any that timed out to give up (which `getaddrinfo` does
+    after its own timeout), so no threads are left behind.
+    '''
+    hostnames = list(set(hostnames))
+    if len(hostnames) == 0:
+        return {}
+    # (at most `concurrency` lookups are ever in flight, so each gets a thread right away)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        if lookup is None:
+            lookup = getaddrinfo_lookup(executor)
+        return shared_utils.run_until_complete(resolve_many_async(hostnames, lookup, concurrency, timeout))
+
+
 #
 # Get location from IP
 #
 
 
+# IP-to-country database. Set `geoip_database` in config.py to use a newer monthly dump.
+GEOIP_DATABASE = config.get(
+    'geoip_database',
+    path.join(path.dirname(__file__), 'analysis', 'dbip-country-lite-2021-05.mmdb'))
+
+# this process's GeoIP reader (see `get_geoip_reader`)
+_geoip_reader: Optional[geoip2.database.Reader] = None
+
+
+def get_geoip_reader() -> geoip2.database.Reader:
+    '''
+    Get the process-wide GeoIP reader, opening it on first use.
+
+    The database is memory-mapped, so a reader opened before forking
+    is shared with any processes forked from this one.
+    '''
+    global _geoip_reader
+    if _geoip_reader is None:
+        _geoip_reader = geoip2.database.Reader(GEOIP_DATABASE, mode=MODE_MMAP)
+    return _geoip_reader
+
+
 def ip_to_alpha2(ip: str) -> Optional[shared_types.Alpha2]:
-    dirname = path.dirname(__file__)
-    pth = path.join(dirname, 'analysis', 'dbip-country-lite-2021-05.mmdb' )
-    with geoip2.database.Reader(pth) as reader:
-        try:
-            response = reader.country(ip)
-            return shared_types.Alpha2(response.country.iso_code)
-        except Exception as inst:
-            # if we have an error,
-            logger.warning(f"Error looking up country code of IP {ip}: {inst}")
-            return None
+    reader = get_geoip_reader()
+    try:
+        response = reader.country(ip)
+        return shared_types.Alpha2(response.country.iso_code)
+    except Exception as inst:
+        # if we have an error,
+        logger.warning(f"Error looking up country code of IP {ip}: {inst}")
+        return None
+
+
+def ips_to_alpha2(ips: List[str]) -> List[Optional[shared_types.Alpha2]]:
+    '''Look up the countries of many IPs. Repeated IPs are only looked up once.'''
+    by_ip = {ip: ip_to_alpha2(ip) for ip in set(ips)}
+    return [by_ip[ip] for ip in ips]
 
 
 #
 # Cacheing IP to hostname mappings
 #
+# We cache in two tiers: an in-memory LRU (`ip_cache`) in front of
+# the `ip_hostname_mapping` table.
+#
+
+# how long an IP we looked up stays valid
+IP_CACHE_EXPIRY = timedelta(days=1)
+# how long we remember that a hostname has no (public) IP
+IP_CACHE_NEGATIVE_EXPIRY = timedelta(hours=1)
+
+# hostname -> IP (or None, if the hostname has no IP)
+ip_cache = shared_utils.LRUCache(maxsize=20000)
+
+# `ip_cache` value for hostnames we know the table has no fresh IP for
+NOT_IN_DB = 'not-in-db'
+# `ip_cache.get` default, for hostnames we haven't cached
+MISSING = 'missing'
+
+
+def cache_ip(hostname: str, ip: Optional[str], time: datetime) -> None:
+    '''Remember, in memory, the IP `hostname` had at `time`.'''
+    if ip is None:
+        expires = shared_utils.to_utc(time) + IP_CACHE_NEGATIVE_EXPIRY
+    else:
+        expires = shared_utils.to_utc(time) + IP_CACHE_EXPIRY
+    ip_cache.put(hostname, ip, expires)
+
+
+def is_fresh(time: datetime, cache_expiry: timedelta = IP_CACHE_EXPIRY) -> bool:
+    return (shared_utils.now() - cache_expiry) <= shared_utils.to_utc(time)
+
 
 def retrieve_ip(cur: cursor, hostname: str) -> Optional[Tuple[datetime, str]]:
-    cur.execute(f'''
+    cur.execute('''
     SELECT time, ip from ip_hostname_mapping
-    WHERE hostname='{hostname}'
+    WHERE hostname=%s
     ORDER BY time DESC
-    ''')
+    LIMIT 1
+    ''', (hostname,))
     return cur.fetchone()
 
 
+def retrieve_ips(cur: cursor, hostnames: List[str]) -> Dict[str, Tuple[datetime, str]]:
+    '''
+    Like `retrieve_ip`, for many hostnames in one query.
+    Returns the most recent (time, ip) of each hostname that has one.
+    '''
+    cur.execute('''
+    SELECT DISTINCT ON (hostname) hostname, time, ip from ip_hostname_mapping
+    WHERE hostname = ANY(%s)
+    ORDER BY hostname, time DESC
+    ''', (list(hostnames),))
+    return {hostname: (time, ip) for hostname, time, ip in cur.fetchall()}
+
+
 def retrieve_cached_ip(cur: cursor, hostname: str,
-                       cache_expiry: timedelta = timedelta(days=1)):
+                       cache_expiry: timedelta = IP_CACHE_EXPIRY):
     # if we have a result in our DB
     time_ip_tuple = retrieve_ip(cur, hostname)
     if time_ip_tuple:
         time, ip = time_ip_tuple
         # and that result is fresh enough
-        is_expired = (shared_utils.now() - cache_expiry) > shared_utils.to_utc(time)
-        if not is_expired:
+        if is_fresh(time, cache_expiry):
             # return it
             return ip
     return None
 
 
+def prefetch_ips(cur: cursor, hostnames: List[str]) -> None:
+    '''
+    Load fresh IPs for `hostnames` from the table into `ip_cache`, with one query.
+    Afterwards, `lookup_ip` won't query the table for any of these hostnames.
+    '''
+    uncached = [h for h in set(hostnames) if h not in ip_cache]
+    if len(uncached) == 0:
+        return
+    retrieved = retrieve_ips(cur, uncached)
+    t = shared_utils.now()
+    for hostname in uncached:
+        time_ip_tuple = retrieved.get(hostname)
+        if time_ip_tuple and is_fresh(time_ip_tuple[0]):
+            cache_ip(hostname, time_ip_tuple[1], time_ip_tuple[0])
+        else:
+            # we'll have to fetch this one
+            ip_cache.put(hostname, NOT_IN_DB, t + IP_CACHE_NEGATIVE_EXPIRY)
+
+
 def lookup_ip(cur: cursor, conn: connection, hostname: str) -> Optional[str]:
     '''
-    Looks up an IP address from a hostname in the cache.
-    If the IP address was recorded more than `cache_expiry` ago, it'll fetch a new IP
+    Looks up an IP address from a hostname in the cache (memory, then database).
+    If the IP address was recorded more than `IP_CACHE_EXPIRY` ago, it'll fetch a new IP
     '''
-    maybe_ip: Optional[str] = retrieve_cached_ip(cur, hostname)
-    if maybe_ip:
+    maybe_ip = ip_cache.get(hostname, MISSING)
+    if maybe_ip == MISSING:
+        time_ip_tuple = retrieve_ip(cur, hostname)
+        if time_ip_tuple and is_fresh(time_ip_tuple[0]):
+            time, ip = time_ip_tuple
+            cache_ip(hostname, ip, time)
+            return ip
+    elif maybe_ip != NOT_IN_DB:
         return maybe_ip
     # otherwise
     # fetch IP with a query
+    t = shared_utils.now()
     maybe_ip = fetch_ip_from_hostname(hostname)
+    cache_ip(hostname, maybe_ip, t)
     if maybe_ip:
         # write that mapping to the DB for the future
-        mapping = ooni_types.IPHostnameMapping(maybe_ip, hostname, shared_utils.now())
+        mapping = ooni_types.IPHostnameMapping(maybe_ip, hostname, t)
         mapping.write_to_db(cur, conn)
         # return the IP
         return maybe_ip
@@ -215,7 +502,13 @@ def get_tld_jurisdiction(url: str) -> Optional[shared_types.Alpha2]:
     Takes a URL and gets an Alpha 2
     representing the jurisdiction of the URL's top-level domain.
     '''
-    hostname = get_hostname(url)
+    return hostname_to_tld_jurisdiction(get_hostname(url))
+
+
+def hostname_to_tld_jurisdiction(hostname: str) -> Optional[shared_types.Alpha2]:
+    '''
+    Like `get_tld_jurisdiction`, for a hostname.
+    '''
     try:
         # sometimes, the hostname is just an IP
         # we can't get any TLD from that of course,
@@ -225,7 +518,11 @@ def get_tld_jurisdiction(url: str) -> Optional[shared_types.Alpha2]:
         pass
     # decode IDNA (internationalized) hostnames
     # e.g. http://xn--80aaifmgl1achx.xn--p1ai/
-    decoded_hostname = idna.decode(hostname)
+    try:
+        decoded_hostname = idna.decode(hostname)
+    except idna.IDNAError:
+        logger.warning(f'Cannot decode hostname {hostname}')
+        return None
     tld = extract_tld(decoded_hostname)
     # get last item in url
     # e.g., '.com.br' should be '.br'
@@ -236,39 +533,134 @@ def get_tld_jurisdiction(url: str) -> Optional[shared_types.Alpha2]:
     cc = shared_utils.get_country(cc_tld_str)
     if cc is not None:
         return shared_types.Alpha2(cc)
-    logger.warning(f'No TLD jurisidiction found for {url}')
+    logger.warning(f'No TLD jurisidiction found for {hostname}')
     return None
 
 
 #
 # Querying and ingesting measurements
 #
+# `ingestion_watermark`'s name for OONI ingestion (incremental and backfill alike)
+WATERMARK_COLLECTOR = 'ooni'
+
+
 def get_latest_reading_time(cur: cursor) -> Optional[datetime]:
-    '''Get time of most recent measurement in database'''
-    try:
-        cur.execute('SELECT measurement_start_time from ooni_web_connectivity_test ORDER BY measurement_start_time DESC')
-        return cur.fetchone()[0]
-    except TypeError:
+    '''
+    Get time of most recent measurement in database:
+    OONI's ingestion watermark, or the newest row if there's no watermark yet.
+    '''
+    watermark = shared_types.IngestionWatermark.read(cur, WATERMARK_COLLECTOR)
+    if watermark is not None:
+        return watermark.watermark
+    cur.execute('SELECT measurement_start_time from ooni_web_connectivity_test ORDER BY measurement_start_time DESC LIMIT 1')
+    row = cur.fetchone()
+    if row is None:
         logger.info('No recent measurement found!')
         return None
+    return row[0]
+
+
+def advance_watermark(cur: cursor, conn: connection, time: pd.Timestamp) -> None:
+    '''
+    Move OONI's ingestion watermark up to `time`, in the current transaction.
+    '''
+    shared_types.IngestionWatermark(WATERMARK_COLLECTOR, time, shared_utils.now()).write_to_db(cur, conn, commit=False)
+
+
+#
+# Database connections for ingestion
+#
+
+# this process's connection pool (see `get_connection_pool`)
+_connection_pool: Optional[shared_utils.ConnectionPool] = None
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool(postgres_config: dict) -> shared_utils.ConnectionPool:
+    '''
+    Get this process's long-lived connection pool, opening it on first use.
+    The pool is closed when the process exits normally.
+    '''
+    global _connection_pool
+    with _connection_pool_lock:
+        # a pool inherited from our parent (via fork) shares its sockets; leave it be.
+        if _connection_pool is not None and _connection_pool.pid == getpid():
+            if not _connection_pool.closed and _connection_pool.postgres_config == postgres_config:
+                return _connection_pool
+            _connection_pool.close()
+        _connection_pool = shared_utils.ConnectionPool(postgres_config)
+        Finalize(_connection_pool, _connection_pool.close, exitpriority=10)
+        return _connection_pool
+
+
+class HostnameResolution(NamedTuple):
+    '''Everything we look up about an input URL's hostname.'''
+    ip: Optional[str]
+    ip_alpha2: Optional[shared_types.Alpha2]
+    tld_jurisdiction_alpha2: Optional[shared_types.Alpha2]
+
 
+# for measurements without a hostname
+UNRESOLVED = HostnameResolution(None, None, None)
 
-def ingest_api_measurement(postgres_config: dict, measurement: dict) -> ooni_types.OONIWebConnectivityTest:
+
+def resolve_hostnames(hostnames: List[str], postgres_config: dict) -> Dict[str, HostnameResolution]:
+    '''
+    Resolve each distinct hostname once.
+
+    IPs come from `ip_cache` or the `ip_hostname_mapping` table when they're fresh there.
+    The rest are looked up all at once with `resolve_many`, and recorded in the table.
     '''
-    Marshall from API format to our type.
+    hostnames = list(set(hostnames))
+    pool = get_connection_pool(postgres_config)
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        # load every cached IP we'll need in one query
+        prefetch_ips(cur, hostnames)
+        cur.close()
+    ips = {hostname: ip_cache.get(hostname, MISSING) for hostname in hostnames}
+    to_fetch = [hostname for hostname, ip in ips.items() if ip in (MISSING, NOT_IN_DB)]
+    t = shared_utils.now()
+    # (we don't hold on to a connection while we wait on DNS)
+    fetched = resolve_many(to_fetch)
+    with pool.connection() as conn:
+        cur = conn.cursor()
+        for hostname, maybe_ip in fetched.items():
+            ips[hostname] = maybe_ip
+            if maybe_ip:
+                cache_ip(hostname, maybe_ip, t)
+                mapping = ooni_types.IPHostnameMapping(maybe_ip, hostname, t)
+                mapping.write_to_db(cur, conn, commit=False)
+        conn.commit()
+        cur.close()
+    failed = len([ip for ip in fetched.values() if ip is None])
+    logger.info(f'Resolved {len(hostnames)} hostnames: {len(hostnames) - len(to_fetch)} cached, ' +
+                f'{len(to_fetch)} looked up ({failed} without an IP).')
+    logger.debug(f'IP cache: {ip_cache.stats()}, database: {pool.stats()}')
+    # where those IPs are
+    found = [ip for ip in ips.values() if ip]
+    ip_alpha2s = dict(zip(found, ips_to_alpha2(found)))
+    return {
+        hostname: HostnameResolution(
+            ip,
+            ip_alpha2s.get(ip),
+            hostname_to_tld_jurisdiction(hostname))
+        for hostname, ip in ips.items()
+    }
+
+
+def marshall_measurement(measurement: dict, resolution: HostnameResolution,
+                         now: Optional[pd.Timestamp] = None) -> ooni_types.OONIWebConnectivityTest:
+    '''
+    Marshall from API format to our type, given what we resolved about its input's hostname.
+    (Pass `now` when marshalling many, to look up the current time once.)
     '''
-    # make a connection and cursor (for this thread)
-    # connection = psycopg2.connect(**config['postgres'])
-    connection = psycopg2.connect(**postgres_config)
-    cursor = connection.cursor()
     blocking_type = get_blocking_type(measurement)
     probe_alpha2 = shared_types.Alpha2(measurement['probe_cc'])
     input_url = measurement['input']
     anomaly = measurement['anomaly']
     confirmed = measurement['confirmed']
     report_id = measurement['report_id']
-    input_ip_alpha2 = url_to_alpha2(cursor, connection, input_url)
-    tld_jurisdiction_alpha2 = get_tld_jurisdiction(input_url)
     measurement_start_time = pd.Timestamp(measurement['measurement_start_time'])
     return ooni_types.OONIWebConnectivityTest(
         blocking_type,
@@ -277,19 +669,195 @@ def ingest_api_measurement(postgres_config: dict, measurement: dict) -> ooni_typ
         anomaly,
         confirmed,
         report_id,
-        input_ip_alpha2,
-        tld_jurisdiction_alpha2,
-        measurement_start_time
+        resolution.ip_alpha2,
+        resolution.tld_jurisdiction_alpha2,
+        measurement_start_time,
+        now=now,
     )
 
 
-def ingest_api_measurements(measurements: List[dict], postgres_config: dict) -> List[ooni_types.OONIWebConnectivityTest]:
-    my_ingest = partial(ingest_api_measurement, postgres_config)
-    with Pool() as p:
-        return p.map(my_ingest, measurements)
+# how `ingest_api_measurements` marshalls measurements into our type, once their hostnames are resolved
+# (unless the caller says otherwise, these come from the config, when it's called):
+# in a 'thread' pool, a 'process' pool, or as 'asyncio' tasks (on a thread pool) (`ooni_executor`),
+ooni_executors = ['thread', 'process', 'asyncio']
+DEFAULT_OONI_EXECUTOR = 'thread'
+# with how many chunks marshalled at once (`ooni_workers`). Marshalling is light, GIL-bound work: for pages of
+# API results, one worker (i.e., no pool at all) is fastest (see benchmarks/ooni_marshall.py).
+DEFAULT_OONI_WORKERS = 1
+# and how many measurements are in each chunk (`ooni_chunk_size`).
+DEFAULT_OONI_CHUNK_SIZE = 500
+
+# measurements to marshall, each with what we resolved about its input's hostname
+Chunk = List[Tuple[dict, HostnameResolution]]
+# a chunk's valid tests, and the rest of its measurements, each with the reason it was rejected
+MarshalledChunk = Tuple[ooni_types.OONIWebConnectivityTestFrame, pd.DataFrame]
 
 
-def write_to_db(cur: cursor, conn: connection, connectivity_tests: List[ooni_types.OONIWebConnectivityTest]) -> None:
-    for t in connectivity_tests:
-        t.write_to_db(cur, conn, commit=False)
-    conn.commit()
+def optional_str(maybe_alpha2: Optional[shared_types.Alpha2]) -> Optional[str]:
+    return None if maybe_alpha2 is None else str(maybe_alpha2)
+
+
+def measurement_fields(measurement: dict, resolution: HostnameResolution) -> tuple:
+    '''
+    A measurement's fields, in the order of `OONIWebConnectivityTest.columns`, as they come
+    (missing ones are None). Nothing is validated yet.
+    '''
+    return (get_blocking_type(measurement),
+            measurement.get('probe_cc'),
+            measurement.get('input'),
+            measurement.get('anomaly'),
+            measurement.get('confirmed'),
+            measurement.get('report_id'),
+            optional_str(resolution.ip_alpha2),
+            optional_str(resolution.tld_jurisdiction_alpha2),
+            measurement.get('measurement_start_time'))
+
+
+def marshall_chunk(chunk: Chunk) -> MarshalledChunk:
+    '''
+    Marshall (and validate) a chunk of measurements a column at a time (`OONIWebConnectivityTest.validate_batch`),
+    returning the valid ones as columns (which are much cheaper to send back from another process than
+    a list of objects), and the rest with why they were rejected, indexed by their place in the chunk.
+    '''
+    df = pd.DataFrame.from_records([measurement_fields(m, resolution) for m, resolution in chunk],
+                                   columns=ooni_types.OONIWebConnectivityTest.columns)
+    times = shared_utils.parse_times(df['measurement_start_time'])
+    if times.notna().all():
+        df['measurement_start_time'] = times
+    else:
+        # keep what we couldn't parse, for the rejected report
+        df['measurement_start_time'] = times.astype(object).where(times.notna(), df['measurement_start_time'])
+    accepted, rejected = ooni_types.OONIWebConnectivityTest.validate_batch(df)
+    return ooni_types.OONIWebConnectivityTestFrame(accepted.reset_index(drop=True)), rejected
+
+
+async def marshall_chunks_async(chunks: List[Chunk], executor: Executor) -> List[MarshalledChunk]:
+    loop = asyncio.get_event_loop()
+    return await asyncio.gather(*[loop.run_in_executor(executor, marshall_chunk, chunk) for chunk in chunks])
+
+
+def marshall_chunks(chunks: List[Chunk], executor: Optional[str] = None,
+                    workers: Optional[int] = None) -> List[MarshalledChunk]:
+    '''
+    `marshall_chunk` each of `chunks` on `executor` (one of `ooni_executors`), keeping their order.
+    `executor` and `workers` default to the config's `ooni_executor` and `ooni_workers`.
+    '''
+    if executor is None:
+        executor = cast(str, config.get('ooni_executor', DEFAULT_OONI_EXECUTOR))
+    if workers is None:
+        workers = cast(int, config.get('ooni_workers', DEFAULT_OONI_WORKERS))
+    if executor not in ooni_executors:
+        raise ValueError(f'Unknown executor {executor}')
+    # not worth starting workers for
+    if len(chunks) <= 1 or workers <= 1:
+        return [marshall_chunk(chunk) for chunk in chunks]
+    if executor == 'process':
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(marshall_chunk, chunks))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        if executor == 'asyncio':
+            return shared_utils.run_until_complete(marshall_chunks_async(chunks, pool))
+        return list(pool.map(marshall_chunk, chunks))
+
+
+def ingest_api_measurements(measurements: List[dict], postgres_config: dict,
+                            executor: Optional[str] = None,
+                            workers: Optional[int] = None,
+                            chunk_size: Optional[int] = None,
+                            timer: Optional[shared_utils.StageTimer] = None) -> ooni_types.OONIWebConnectivityTestFrame:
+    '''
+    Marshall many measurements from API format to our type.
+
+    Many measurements share an input URL, so we first resolve each distinct hostname
+    once, then join those resolutions back onto the measurements, and marshall them
+    in chunks of `chunk_size` (by default, the config's `ooni_chunk_size`) on `executor` (see `marshall_chunks`).
+    The time spent in each stage is added to `timer`.
+
+    Measurements that don't validate are logged and left out, so one bad measurement
+    doesn't cost us the rest of the batch.
+    '''
+    if chunk_size is None:
+        chunk_size = cast(int, config.get('ooni_chunk_size', DEFAULT_OONI_CHUNK_SIZE))
+    assert(chunk_size > 0)
+    timer = timer if timer is not None else shared_utils.StageTimer()
+    with timer.stage('resolve'):
+        hostnames = [get_measurement_hostname(m) for m in measurements]
+        resolutions = resolve_hostnames([h for h in hostnames if h is not None], postgres_config)
+        logger.debug(f'Resolved {len(resolutions)} distinct hostnames for {len(measurements)} measurements.')
+    with timer.stage('marshall'):
+        pairs = [(m, UNRESOLVED if hostname is None else resolutions.get(hostname, UNRESOLVED))
+                 for m, hostname in zip(measurements, hostnames)]
+        chunks = [pairs[i:i + chunk_size] for i in range(0, len(pairs), chunk_size)]
+        marshalled = marshall_chunks(chunks, executor, workers)
+        ingested = ooni_types.OONIWebConnectivityTestFrame.concat([frame for frame, _ in marshalled])
+    # (index the rejected measurements by their place in `measurements`)
+    rejected = [r.set_axis(r.index + i * chunk_size) for i, (_, r) in enumerate(marshalled) if len(r)]
+    if rejected:
+        report = pd.concat(rejected)
+        logger.warning(f'Rejected {len(report)} of {len(measurements)} measurements: ' +
+                       shared_types.describe_rejected(report))
+        logger.debug(f'Rejected measurements:\n{report[["report_id", "input_url", "reason"]]}')
+    logger.debug(f'Ingested {len(ingested)} measurements in {len(chunks)} chunk(s) ({timer}).')
+    return ingested
+
+
+def write_to_db(cur: cursor, conn: connection, connectivity_tests: Iterable[ooni_types.OONIWebConnectivityTest],
+                commit: bool = True) -> None:
+    '''
+    Write tests (an `OONIWebConnectivityTestFrame`, or `OONIWebConnectivityTest`s),
+    and advance the ingestion watermark past them, in one transaction.
+    '''
+    if not isinstance(connectivity_tests, ooni_types.OONIWebConnectivityTestFrame):
+        connectivity_tests = ooni_types.OONIWebConnectivityTestFrame.from_tests(connectivity_tests)
+    connectivity_tests.write_many(cur)
+    newest = connectivity_tests.newest()
+    if newest is not None:
+        advance_watermark(cur, conn, newest)
+    if commit:
+        conn.commit()
+
+
+#
+# Backfilling
+#
+def backfill_windows(since: pd.Timestamp, until: pd.Timestamp,
+                     window: timedelta) -> List[Tuple[pd.Timestamp, pd.Timestamp]]:
+    '''Split [since, until) into consecutive windows of length `window` (the last may be shorter).'''
+    assert(since < until)
+    windows = []
+    start = since
+    while start < until:
+        end = min(start + window, until)
+        windows.append((start, end))
+        start = end
+    return windows
+
+
+def completed_backfill_windows(cur: cursor, since: pd.Timestamp,
+                               until: pd.Timestamp) -> List[Tuple[datetime, datetime]]:
+    '''Checkpointed windows that overlap [since, until).'''
+    cur.execute('''
+    SELECT window_start, window_end from ooni_backfill_checkpoint
+    WHERE window_start < %s AND window_end > %s
+    ''', (until, since))
+    return cur.fetchall()
+
+
+def is_backfilled(window: Tuple[pd.Timestamp, pd.Timestamp],
+                  completed: List[Tuple[datetime, datetime]]) -> bool:
+    start, end = window
+    return any((done_start <= start) and (end <= done_end) for done_start, done_end in completed)
+
+
+def backfilled_through(windows: List[Tuple[pd.Timestamp, pd.Timestamp]],
+                       completed: List[Tuple[datetime, datetime]]) -> Optional[pd.Timestamp]:
+    '''
+    The end of the run of `windows` (in order) that are all in `completed`,
+    or None if the first one isn't.
+    '''
+    through = None
+    for window in windows:
+        if not is_backfilled(window, completed):
+            break
+        through = window[1]
+    return through
@@ -0,0 +1,212 @@
+# taaraxtak
+#
+# shared
+# http_cache.py - an on-disk cache of HTTP responses, for conditional requests.
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import requests
+
+from config import config
+from os import path
+from typing import Optional
+from typing import cast
+
+
+logger = logging.getLogger("src.shared.http_cache")
+
+# where responses are cached (set `http_cache_directory` to None in config.py to turn caching off)
+HTTP_CACHE_DIRECTORY = cast(Optional[str], config.get(
+    'http_cache_directory', path.expanduser(path.join('~', '.cache', 'taaraxtak', 'http'))))
+# how big the cache may grow, compressed
+HTTP_CACHE_MAX_BYTES = cast(int, config.get('http_cache_max_mb', 256)) * 2**20
+
+
+def content_hash(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+class CachedResponse():
+    '''
+    The parts of a `requests.Response` we use, whether it came from the network or the cache.
+    '''
+    def __init__(self, url: str, status_code: int, content: bytes, encoding: Optional[str], not_modified: bool):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding
+        # True if the server told us our cached copy is still current
+        self.not_modified = not_modified
+        self.content_hash = content_hash(content)
+
+    @property
+    def text(self) -> str:
+        return self.content.decode(self.encoding or 'utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class HTTPCache():
+    '''
+    Caches responses that carry an `ETag` or `Last-Modified` on disk (gzipped),
+    and revalidates them with conditional requests: if the server answers
+    `304 Not Modified`, we use our copy instead of downloading it again.
+    Nothing is ever served without asking the server first.
+
+    When the cache grows past `max_bytes`, the least recently used responses are evicted.
+    '''
+    def __init__(self, directory: str, max_bytes: int = HTTP_CACHE_MAX_BYTES):
+        assert(max_bytes > 0)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._bytes = sum(size for _, _, size in self._entries())
+
+    def _path(self, url: str, kind: str) -> str:
+        return path.join(self.directory, f'{content_hash(url.encode())}.{kind}')
+
+    def _entries(self):
+        '''(key, last used, bytes) of every cached response.'''
+        sizes: dict = {}
+        used: dict = {}
+        for name in os.listdir(self.directory):
+            key, _, kind = name.partition('.')
+            if kind not in ('meta', 'body'):
+                continue
+            try:
+                st = os.stat(path.join(self.directory, name))
+            except FileNotFoundError:
+                continue
+            sizes[key] = sizes.get(key, 0) + st.st_size
+            if kind == 'meta':
+                used[key] = st.st_mtime
+        return [(key, used.get(key, 0), size) for key, size in sizes.items()]
+
+    def _write(self, pth: str, data: bytes) -> None:
+        # write-then-rename, so readers never see half a file
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, pth)
+
+    def _load(self, url: str) -> Optional[dict]:
+        try:
+            with open(self._path(url, 'meta')) as f:
+                meta = json.load(f)
+            with open(self._path(url, 'body'), 'rb') as f:
+                meta['content'] = gzip.decompress(f.read())
+        except (FileNotFoundError, ValueError, OSError):
+            return None
+        if meta.get('url') != url:
+            return None
+        return meta
+
+    def _size(self, url: str) -> int:
+        '''Bytes on disk for `url`'s cached response (0 if there's none).'''
+        size = 0
+        for kind in ('meta', 'body'):
+            try:
+                size += os.stat(self._path(url, kind)).st_size
+            except FileNotFoundError:
+                pass
+        return size
+
+    def _store(self, url: str, resp: requests.Response) -> None:
+        body = gzip.compress(resp.content)
+        meta = json.dumps({
+            'url': url,
+            'etag': resp.headers.get('ETag'),
+            'last_modified': resp.headers.get('Last-Modified'),
+            'encoding': resp.encoding,
+        }).encode()
+        with self._lock:
+            # (this replaces whatever we had for `url`)
+            replaced = self._size(url)
+            self._write(self._path(url, 'body'), body)
+            self._write(self._path(url, 'meta'), meta)
+            self._bytes += len(body) + len(meta) - replaced
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self) -> None:
+        '''Delete least recently used responses until we're well under `max_bytes`. Call with the lock.'''
+        entries = sorted(self._entries(), key=lambda e: e[1])
+        total = sum(size for _, _, size in entries)
+        for key, _, size in entries:
+            if total <= 0.9 * self.max_bytes:
+                break
+            for kind in ('meta', 'body'):
+                try:
+                    os.remove(path.join(self.directory, f'{key}.{kind}'))
+                except FileNotFoundError:
+                    pass
+            total -= size
+        logger.debug(f'Evicted HTTP cache down to {total} bytes.')
+        self._bytes = total
+
+    def get(self, session: requests.Session, url: str, **kwargs) -> CachedResponse:
+        '''
+        `session.get(url, **kwargs)`, revalidating our cached copy if we have one.
+        Raises for error statuses, like `requests.Response.raise_for_status`.
+        '''
+        cached = self._load(url)
+        request_headers = kwargs.pop('headers', None)
+        headers = dict(request_headers or {})
+        if cached is not None:
+            if cached['etag']:
+                headers['If-None-Match'] = cached['etag']
+            if cached['last_modified']:
+                headers['If-Modified-Since'] = cached['last_modified']
+        resp = session.get(url, headers=headers, **kwargs)
+        if resp.status_code == 304 and cached is not None:
+            # mark it as recently used
+            try:
+                os.utime(self._path(url, 'meta'))
+            except FileNotFoundError:
+                # evicted since we loaded it: a miss after all
+                return self.get(session, url, headers=request_headers, **kwargs)
+            return CachedResponse(url, 200, cached['content'], cached['encoding'], not_modified=True)
+        resp.raise_for_status()
+        cacheable = ('ETag' in resp.headers or 'Last-Modified' in resp.headers) and \
+            'no-store' not in resp.headers.get('Cache-Control', '')
+        if cacheable:
+            self._store(url, resp)
+        return CachedResponse(url, resp.status_code, resp.content, resp.encoding, not_modified=False)
+
+
+# this process's cache (see `get_http_cache`)
+_http_cache: Optional[HTTPCache] = None
+_http_cache_lock = threading.Lock()
+
+
+def get_http_cache() -> Optional[HTTPCache]:
+    '''
+    The cache in `HTTP_CACHE_DIRECTORY`, or None if caching is turned off.
+    '''
+    global _http_cache
+    if HTTP_CACHE_DIRECTORY is None:
+        return None
+    with _http_cache_lock:
+        if _http_cache is None:
+            _http_cache = HTTPCache(HTTP_CACHE_DIRECTORY)
+        return _http_cache
+
+
+def cached_get(session: requests.Session, url: str, cache: Optional[HTTPCache] = None, **kwargs) -> CachedResponse:
+    '''
+    GET `url` through `cache` (or, by default, `get_http_cache()`), or straight from the network if there's none.
+    '''
+    if cache is None:
+        cache = get_http_cache()
+    if cache is not None:
+        return cache.get(session, url, **kwargs)
+    resp = session.get(url, **kwargs)
+    resp.raise_for_status()
+    return CachedResponse(url, resp.status_code, resp.content, resp.encoding, not_modified=False)
@@ -0,0 +1,221 @@
+# taaraxtak
+#
+# shared
+# schema.py - versioned migrations,
+# and helpers for changing the layout of existing tables.
+
+import logging
+import pandas as pd
+
+from psycopg2.extensions import cursor
+from psycopg2.extensions import connection
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+
+logger = logging.getLogger("src.shared.schema")
+
+
+#
+# Versioned migrations
+#
+class Migration(NamedTuple):
+    '''
+    One step in a component's schema history.
+    `apply` runs in the migration's transaction, and must not commit.
+    '''
+    version: int
+    description: str
+    apply: Callable[[cursor], None]
+
+
+SCHEMA_VERSION_DDL = '''
+  CREATE TABLE IF NOT EXISTS schema_version (
+     component                 VARCHAR NOT NULL,
+     version                   INTEGER NOT NULL,
+     description               VARCHAR NOT NULL,
+     applied_at                TIMESTAMPTZ NOT NULL DEFAULT now(),
+     PRIMARY KEY (component, version)
+  )
+'''
+
+
+def schema_version(cur: cursor, component: str) -> int:
+    '''The latest migration applied to `component`, or 0 if none has been.'''
+    cur.execute('SELECT coalesce(max(version), 0) FROM schema_version WHERE component = %s', (component,))
+    return cur.fetchone()[0]
+
+
+class SchemaOutOfDate(Exception):
+    '''A component's tables are behind its migrations.'''
+
+
+def check_schema_version(cur: cursor, component: str, migrations: List[Migration]) -> None:
+    '''
+    Raise `SchemaOutOfDate` unless every one of `component`'s `migrations` has been applied.
+    Jobs check this, rather than migrating on the side: schema changes only run through `run.py migrate`.
+    '''
+    cur.execute("SELECT to_regclass('schema_version')")
+    current = schema_version(cur, component) if cur.fetchone()[0] is not None else 0
+    latest = migrations[-1].version
+    if current < latest:
+        raise SchemaOutOfDate(f'The {component} tables are at version {current}, but need version {latest}. '
+                              'Run `python3 run.py migrate` first.')
+
+
+def migrate(cur: cursor, conn: connection, component: str, migrations: List[Migration]) -> List[int]:
+    '''
+    Apply the `migrations` of `component` that haven't been applied yet, in order.
+    Each one is applied, and recorded in `schema_version`, in its own transaction.
+    Returns the versions applied; running it again applies nothing.
+    '''
+    versions = [m.version for m in migrations]
+    assert(versions == sorted(set(versions)))
+    cur.execute(SCHEMA_VERSION_DDL)
+    conn.commit()
+    # one migrator per component at a time
+    cur.execute('SELECT pg_advisory_lock(hashtext(%s))', (f'schema_version:{component}',))
+    applied = []
+    try:
+        current = schema_version(cur, component)
+        for migration in migrations:
+            if migration.version <= current:
+                continue
+            logger.info(f'Migrating {component} to version {migration.version}: {migration.description}')
+            try:
+                migration.apply(cur)
+                cur.execute('''
+                INSERT INTO schema_version (component, version, description)
+                VALUES (%s, %s, %s)
+                ''', (component, migration.version, migration.description))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(migration.version)
+    finally:
+        cur.execute('SELECT pg_advisory_unlock(hashtext(%s))', (f'schema_version:{component}',))
+        conn.commit()
+    return applied
+
+
+def table_layout(cur: cursor, table: str, namespace: str = 'public') -> Tuple[list, list]:
+    '''
+    What `table` looks like: its columns (name, type, nullable, default) and its
+    primary key and unique constraints (type, columns), each sorted, whatever their names.
+    '''
+    cur.execute('''
+    SELECT column_name, data_type, is_nullable, column_default FROM information_schema.columns
+    WHERE table_schema = %s AND table_name = %s
+    ORDER BY column_name
+    ''', (namespace, table))
+    columns = cur.fetchall()
+    cur.execute('''
+    SELECT c.contype::text, array_agg(a.attname::text ORDER BY a.attname)
+    FROM pg_constraint c
+    JOIN pg_class t ON t.oid = c.conrelid
+    JOIN pg_namespace n ON n.oid = t.relnamespace
+    JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = ANY(c.conkey)
+    WHERE n.nspname = %s AND t.relname = %s AND c.contype IN ('p', 'u')
+    GROUP BY c.oid, c.contype
+    ORDER BY 1, 2
+    ''', (namespace, table))
+    return columns, cur.fetchall()
+
+
+#
+# Partitioning
+#
+# how many months past the present `partition_by_month` makes partitions for
+MONTHS_AHEAD = 12
+
+
+def is_partitioned(cur: cursor, table: str) -> bool:
+    cur.execute('''
+    SELECT 1 FROM pg_partitioned_table p
+    JOIN pg_class c ON c.oid = p.partrelid
+    WHERE c.relname = %s
+    ''', (table,))
+    return cur.fetchone() is not None
+
+
+def month_starts(first: pd.Timestamp, last: pd.Timestamp) -> List[pd.Timestamp]:
+    '''The first instant (UTC) of each month from `first`'s month through `last`'s.'''
+    first = first.tz_convert('UTC').tz_localize(None).to_period('M').to_timestamp()
+    last = last.tz_convert('UTC').tz_localize(None).to_period('M').to_timestamp()
+    return [t.tz_localize('UTC') for t in pd.date_range(first, last, freq='MS')]
+
+
+def partition_name(table: str, month: pd.Timestamp) -> str:
+    return f'{table}_{month.strftime("%Y_%m")}'
+
+
+def create_monthly_partitions(cur: cursor, table: str, time_column: str,
+                              first: pd.Timestamp, last: pd.Timestamp) -> None:
+    '''
+    Make sure partitioned `table` has a partition for each month from `first` through `last`.
+    Months whose rows already landed in the default partition are left there.
+    '''
+    for month in month_starts(first, last):
+        name = partition_name(table, month)
+        next_month = month + pd.offsets.MonthBegin(1)
+        cur.execute('SELECT to_regclass(%s)', (name,))
+        if cur.fetchone()[0] is not None:
+            continue
+        cur.execute(f'''
+        SELECT 1 FROM {table}_default
+        WHERE {time_column} >= %s AND {time_column} < %s
+        LIMIT 1
+        ''', (month, next_month))
+        if cur.fetchone():
+            logger.warning(f'Rows for {month:%Y-%m} are in {table}_default; not partitioning that month.')
+            continue
+        cur.execute(f'''
+        CREATE TABLE {name} PARTITION OF {table}
+        FOR VALUES FROM (%s) TO (%s)
+        ''', (month, next_month))
+
+
+def partition_by_month(cur: cursor, conn: connection, table: str, time_column: str,
+                       unique: Optional[Dict[str, str]] = None,
+                       months_ahead: int = MONTHS_AHEAD) -> None:
+    '''
+    Range-partition `table` by month on `time_column`, in one transaction.
+
+    The rows are copied into a new, partitioned table, which takes the original's name;
+    the original (and its indexes) get an `_unpartitioned` suffix. Drop it once you're happy.
+    `unique` maps the names of `UNIQUE` constraints to re-create to their SQL column lists
+    (which must include `time_column`). Other indexes have to be re-created by the caller.
+
+    If `table` is already partitioned, this only adds partitions up to `months_ahead`
+    months from now, so it's safe (and useful) to run it regularly.
+    '''
+    now = pd.Timestamp.now(tz='UTC')
+    if is_partitioned(cur, table):
+        create_monthly_partitions(cur, table, time_column, now, now + pd.DateOffset(months=months_ahead))
+        conn.commit()
+        return
+    logger.info(f'Partitioning {table} by month.')
+    cur.execute(f'SELECT min({time_column}) FROM {table}')
+    first = cur.fetchone()[0]
+    first = now if first is None else pd.Timestamp(first)
+    cur.execute(f'ALTER TABLE {table} RENAME TO {table}_unpartitioned')
+    # free up the index (and constraint) names for the new table
+    cur.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', (f'{table}_unpartitioned',))
+    for (index,) in cur.fetchall():
+        cur.execute(f'ALTER INDEX {index} RENAME TO {index}_unpartitioned')
+    cur.execute(f'''
+    CREATE TABLE {table} (LIKE {table}_unpartitioned INCLUDING DEFAULTS)
+    PARTITION BY RANGE ({time_column})
+    ''')
+    for name, columns in (unique or {}).items():
+        cur.execute(f'ALTER TABLE {table} ADD CONSTRAINT {name} UNIQUE ({columns})')
+    cur.execute(f'CREATE TABLE {table}_default PARTITION OF {table} DEFAULT')
+    create_monthly_partitions(cur, table, time_column, first, now + pd.DateOffset(months=months_ahead))
+    cur.execute(f'INSERT INTO {table} SELECT * FROM {table}_unpartitioned')
+    conn.commit()
+    logger.info(f'Partitioned {table}. The original table is now {table}_unpartitioned.')
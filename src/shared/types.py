@@ -1,10 +1,82 @@
+import pandas as pd
+
 import src.shared.utils as shared_utils
+import src.shared.schema as schema
+
+from psycopg2.extensions import cursor
+from psycopg2.extensions import connection
+from typing import Callable
+from typing import List
+from typing import NamedTuple
+from typing import Optional
+from typing import Tuple
+
+
+#
+# Validating batches
+#
+# A rule of a type, for a whole batch at once: why a row breaks it,
+# and a function of the batch's columns giving which rows follow it (as booleans).
+Check = Tuple[str, Callable[[pd.DataFrame], pd.Series]]
+
+
+class ValidatedBatch(NamedTuple):
+    '''
+    A batch, split by `validate_batch`: the rows that follow every rule,
+    and the rows that don't, with a `reason` column saying which rule each broke.
+    '''
+    accepted: pd.DataFrame
+    rejected: pd.DataFrame
+
+
+def validate_batch(df: pd.DataFrame, columns: Tuple[str, ...], checks: List[Check]) -> ValidatedBatch:
+    '''
+    Validate a batch of records (a column per field, in the order of `columns`) a whole column at a time.
+    A row that breaks one of `checks` is rejected on its own, with the first rule it broke,
+    instead of failing the whole batch. Both parts keep `df`'s index.
+    '''
+    assert(list(df.columns) == list(columns))
+    reasons = pd.Series(None, index=df.index, dtype=object)
+    for reason, check in checks:
+        # (anything but True - e.g. a missing value - breaks the rule)
+        broken = ~check(df).eq(True)
+        reasons = reasons.mask(reasons.isna() & broken, reason)
+    is_rejected = reasons.notna()
+    return ValidatedBatch(df[~is_rejected], df[is_rejected].assign(reason=reasons[is_rejected]))
+
+
+def describe_rejected(rejected: pd.DataFrame) -> str:
+    '''
+    How many rows were rejected for each reason, e.g. "2 (input_url isn't a non-empty string), 1 (...)".
+    '''
+    return ', '.join(f'{n} ({reason})' for reason, n in rejected['reason'].value_counts().items())
+
+
+class BatchValidated():
+    '''
+    A type that validates batches as well as single records: `validate_batch` applies its `checks`
+    (the same rules its `__init__` asserts) to a DataFrame with a column per field in `columns`.
+    '''
+    __slots__ = ()
+    columns: Tuple[str, ...] = ()
+    checks: List[Check] = []
+
+    @classmethod
+    def validate_batch(cls, df: pd.DataFrame) -> ValidatedBatch:
+        return validate_batch(df, cls.columns, cls.checks)
 
 
-class Alpha2 ():
+class Alpha2 (BatchValidated):
     '''
     Represents an ISO alpha-2 country code.
     '''
+    __slots__ = ('country_code',)
+
+    columns = ('country_code',)
+    checks = [
+        ("country_code isn't two characters", lambda df: shared_utils.str_lengths(df['country_code']) == 2),
+    ]
+
     def __init__(self,
                  country_code: str):
         assert(shared_utils.is_nonempty_str(country_code))
@@ -12,7 +84,129 @@ class Alpha2 ():
         self.country_code = country_code
 
     def __str__(self):
-        return f'{self.country_code}'
+        return self.country_code
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class IngestionWatermark (BatchValidated):
+    '''
+    How far a collector has got: the time of the newest data it has written,
+    and when it last wrote some. `updated_at - watermark` is its ingestion lag.
+
+    Write it in the same transaction as the data, so the two can't disagree.
+    '''
+    __slots__ = ('collector', 'watermark', 'updated_at')
+
+    columns = ('collector', 'watermark', 'updated_at')
+    checks = [
+        ("collector isn't a non-empty string", lambda df: shared_utils.are_nonempty_strs(df['collector'])),
+        ("watermark isn't a time", lambda df: shared_utils.are_times(df['watermark'])),
+        ("updated_at isn't a time", lambda df: shared_utils.are_times(df['updated_at'])),
+    ]
+
+    def __init__(self,
+                 collector: str,
+                 watermark: pd.Timestamp,
+                 updated_at: pd.Timestamp):
+        assert(shared_utils.is_nonempty_str(collector))
+        self.collector = collector
+
+        assert(type(watermark) == pd.Timestamp)
+        self.watermark = watermark
+
+        assert(type(updated_at) == pd.Timestamp)
+        self.updated_at = updated_at
+
+    ddl = '''
+    CREATE TABLE IF NOT EXISTS ingestion_watermark (
+    collector           VARCHAR PRIMARY KEY,
+    watermark           TIMESTAMPTZ NOT NULL,
+    updated_at          TIMESTAMPTZ NOT NULL
+    )
+    '''
+
+    def write_to_db(
+            self,
+            cur: cursor,
+            conn: connection,
+            commit=True,
+    ):
+        '''
+        Move the collector's watermark up to `self.watermark` (never back).
+        '''
+        cur.execute(
+            """
+            INSERT INTO ingestion_watermark
+            (collector, watermark, updated_at)
+            VALUES
+            (%s, %s, %s)
+            ON CONFLICT (collector) DO UPDATE SET
+            watermark = GREATEST(ingestion_watermark.watermark, EXCLUDED.watermark),
+            updated_at = EXCLUDED.updated_at
+            """, (self.collector,
+                  self.watermark,
+                  self.updated_at))
+        if commit:
+            return conn.commit()
+        return
+
+    @classmethod
+    def read(
+            cls,
+            cur: cursor,
+            collector: str,
+    ) -> Optional['IngestionWatermark']:
+        cur.execute(
+            """
+            SELECT watermark, updated_at FROM ingestion_watermark
+            WHERE collector = %s
+            """, (collector,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        return cls(collector, pd.Timestamp(row[0]), pd.Timestamp(row[1]))
+
+    def __str__(self):
+        return f'{self.collector}: {self.watermark} (at {self.updated_at})'
 
     def __repr__(self):
         return self.__str__()
+
+
+#
+# Migrations
+#
+# Tables every data source uses. Each source's `migrate` runs these first.
+#
+def create_watermark_table(cur: cursor):
+    '''
+    Migration: ingestion watermarks.
+    '''
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS ingestion_watermark (
+      collector           VARCHAR PRIMARY KEY,
+      watermark           TIMESTAMPTZ NOT NULL,
+      updated_at          TIMESTAMPTZ NOT NULL
+      )
+    """)
+
+
+migrations = [
+    schema.Migration(1, 'create ingestion_watermark', create_watermark_table),
+]
+
+
+def migrate(cur: cursor, conn: connection) -> List[int]:
+    '''
+    Bring the shared tables up to date. Returns the versions applied.
+    '''
+    return schema.migrate(cur, conn, 'shared', migrations)
+
+
+def check_schema(cur: cursor) -> None:
+    '''
+    Raise `schema.SchemaOutOfDate` if the shared tables need migrating.
+    '''
+    schema.check_schema_version(cur, 'shared', migrations)
@@ -1,3 +1,6 @@
+import os
+import time
+import asyncio
 from os import path
 import pandas as pd
 import logging
@@ -5,8 +8,24 @@ from os.path import join
 import pytz
 from datetime import datetime
 import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+import psycopg2.pool
+import psycopg2.extras
+import csv
+import io
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from typing import Any
+from typing import Hashable
+from typing import Iterable
+from typing import Iterator
 from typing import Optional
+from typing import Sequence
+from psycopg2.extensions import connection
+from psycopg2.extensions import cursor
 
 from config import config
 import coloredlogs
@@ -18,8 +37,11 @@ def now() -> pd.Timestamp:
     return pd.Timestamp.utcnow()
 
 
-def is_in_future(timestamp: pd.Timestamp) -> bool:
-    return timestamp > now()
+def is_in_future(timestamp: pd.Timestamp, current: Optional[pd.Timestamp] = None) -> bool:
+    '''
+    Whether `timestamp` is after `current` (by default, now).
+    '''
+    return timestamp > (current if current is not None else now())
 
 
 def to_utc(t: datetime) -> datetime:
@@ -36,6 +58,57 @@ def is_nonempty_str(my_str: str) -> bool:
     return False
 
 
+def str_lengths(my_strs: pd.Series) -> pd.Series:
+    '''
+    Length of each string in a column, or 0 for anything that isn't a string.
+    '''
+    if my_strs.dtype != object:
+        return pd.Series(0, index=my_strs.index)
+    # `.str.len()` is missing for anything that isn't a string
+    return my_strs.str.len().fillna(0).astype(int)
+
+
+def are_nonempty_strs(my_strs: pd.Series) -> pd.Series:
+    '''
+    `is_nonempty_str` for a whole column at once.
+    '''
+    return str_lengths(my_strs) > 0
+
+
+def are_bools(values: pd.Series) -> pd.Series:
+    '''
+    Which of a column are `bool`s (not just truthy).
+    '''
+    if pd.api.types.is_bool_dtype(values):
+        return pd.Series(True, index=values.index)
+    return values.map(lambda v: type(v) == bool)
+
+
+def are_counts(values: pd.Series) -> pd.Series:
+    '''
+    Which of a column are non-negative `int`s.
+    '''
+    if pd.api.types.is_integer_dtype(values):
+        return values >= 0
+    return values.map(lambda v: (type(v) == int) and (v >= 0))
+
+
+def are_times(values: pd.Series) -> pd.Series:
+    '''
+    Which of a column are times: the non-missing values of a datetime column, or `pd.Timestamp`s.
+    '''
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values.notna()
+    return values.map(lambda v: type(v) == pd.Timestamp)
+
+
+def parse_times(values: pd.Series) -> pd.Series:
+    '''
+    A column of times (in UTC), from strings or timestamps. Anything that isn't a time becomes `NaT`.
+    '''
+    return pd.to_datetime(values, utc=True, errors='coerce')
+
+
 #
 # Jurisdictions of providers
 #
@@ -62,6 +135,17 @@ def get_country(provider_name: str) -> Optional[str]:
         return None
 
 
+def get_countries(provider_names: pd.Series) -> pd.Series:
+    '''
+    `get_country` for a whole column at once: alpha2 codes, or None.
+    '''
+    alpha2s = provider_names.map(provider_countries)
+    unknown = provider_names[~provider_names.isin(provider_countries.keys())]
+    if len(unknown):
+        logging.info(f'Cannot find country for {", ".join(map(str, unknown))}')
+    return alpha2s.astype(object).where(str_lengths(alpha2s) == 2, None)
+
+
 def configure_logging():
     logging_config = config['logging']
     log_level = logging_config['level']
@@ -77,6 +161,304 @@ def configure_logging():
     logging.getLogger("filelock").setLevel(logging.ERROR)
 
 
+class RateLimiter():
+    '''
+    Spaces out calls to `wait`, across threads, by at least `interval` seconds.
+    '''
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def wait(self) -> None:
+        with self._lock:
+            current = time.monotonic()
+            slot = max(current, self._next)
+            self._next = slot + self.interval
+        if slot > current:
+            time.sleep(slot - current)
+
+
+class StageTimer():
+    '''
+    Adds up the wall-clock seconds spent in each stage of a job (across threads):
+
+        with timer.stage('resolve'):
+            ...
+    '''
+    def __init__(self):
+        self.seconds: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.seconds[name] = self.seconds.get(name, 0) + elapsed
+
+    def __str__(self):
+        return ', '.join(f'{name} {seconds:.2f}s' for name, seconds in self.seconds.items())
+
+
+#
+# HTTP
+#
+# responses worth retrying: rate limited, or the server (or a proxy) is struggling
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+def http_session(max_connections: int = 10, retries: int = 3, backoff: float = 1.0) -> requests.Session:
+    '''
+    A keep-alive session that holds up to `max_connections` connections per host,
+    and retries failed `GET`s up to `retries` times, waiting `backoff`, 2 * `backoff`,
+    4 * `backoff`... seconds in between.
+    '''
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
 def run_threaded(job_func):
     job_thread = threading.Thread(target=job_func)
     job_thread.start()
+
+
+def run_until_complete(coroutine):
+    '''
+    Run `coroutine` on a new event loop, and return its result
+    (like `asyncio.run`, which we can't use on Python 3.6).
+    '''
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+#
+# Caching
+#
+class LRUCache():
+    '''
+    A bounded in-memory cache.
+
+    Each entry is stored with the time it expires. When the cache is full,
+    the least recently used entry is evicted. Counts hits and misses.
+    '''
+    def __init__(self, maxsize: int):
+        assert(maxsize >= 1)
+        self.maxsize = maxsize
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if datetime.now(pytz.utc) < expires:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key: Hashable, value: Any, expires: datetime) -> None:
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, key: Hashable) -> bool:
+        '''Whether `key` has an unexpired entry. Doesn't count as a hit or miss.'''
+        entry = self._entries.get(key)
+        return (entry is not None) and (datetime.now(pytz.utc) < entry[1])
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+        self.reset_stats()
+
+    def reset_stats(self) -> None:
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+        }
+
+
+#
+# Database connections
+#
+class _CountingConnectionPool(psycopg2.pool.ThreadedConnectionPool):
+    '''
+    ThreadedConnectionPool that opens connections lazily, keeps all of them
+    open once returned, and counts how many it opens.
+    '''
+    def __init__(self, maxconn: int, **kwargs):
+        self.connections_opened = 0
+        super().__init__(0, maxconn, **kwargs)
+        # psycopg2 closes returned connections beyond `minconn`
+        self.minconn = maxconn
+
+    def _connect(self, key=None):
+        self.connections_opened += 1
+        return super()._connect(key)
+
+
+class ConnectionPool():
+    '''
+    A bounded pool of Postgres connections.
+
+    Connections are opened lazily, up to `maxconn`, and handed back to the pool
+    after each use. Checking out a connection blocks while all `maxconn` are in use.
+    Keeps counters so we can confirm connections are actually being reused.
+
+    A pool belongs to the process that created it: never use one after `fork`.
+    '''
+    def __init__(self, postgres_config: dict, maxconn: int = 1):
+        assert(maxconn >= 1)
+        self.pid = os.getpid()
+        self.postgres_config = postgres_config
+        self.maxconn = maxconn
+        self._pool = _CountingConnectionPool(maxconn, **postgres_config)
+        self._available = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self.checkouts = 0
+
+    @contextmanager
+    def connection(self) -> Iterator[connection]:
+        '''
+        Check out a connection for the duration of a `with` block.
+        Uncommitted work is rolled back if the block raises.
+        '''
+        with self._available:
+            conn = self._pool.getconn()
+            with self._lock:
+                self.checkouts += 1
+            try:
+                yield conn
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                self._pool.putconn(conn)
+
+    def stats(self) -> dict:
+        opened = self._pool.connections_opened
+        return {
+            'connections_opened': opened,
+            'checkouts': self.checkouts,
+            'reuses': self.checkouts - opened,
+        }
+
+    @property
+    def closed(self) -> bool:
+        return self._pool.closed
+
+    def close(self) -> None:
+        if not self._pool.closed:
+            self._pool.closeall()
+
+
+#
+# Bulk writes
+#
+
+# how `copy_rows` writes NULLs
+COPY_NULL = '\\N'
+
+
+def copy_rows(cur: cursor, table: str, columns: Sequence[str], rows: Iterable[tuple]) -> None:
+    '''
+    Stream `rows` into `table` with a single `COPY ... FROM STDIN`.
+    '''
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([COPY_NULL if v is None else v for v in row])
+    buf.seek(0)
+    cur.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')",
+        buf)
+
+
+def copy_rows_skipping_conflicts(cur: cursor, table: str, columns: Sequence[str], rows: Iterable[tuple]) -> None:
+    '''
+    Like `copy_rows`, but rows that violate a unique constraint of `table` are skipped.
+    (`COPY` can't skip them itself, so we copy into a temporary table first.)
+    '''
+    staging = f'{table}_staging'
+    cur.execute(f'CREATE TEMPORARY TABLE {staging} (LIKE {table} INCLUDING DEFAULTS)')
+    copy_rows(cur, staging, columns, rows)
+    cols = ', '.join(columns)
+    cur.execute(f'INSERT INTO {table} ({cols}) SELECT {cols} FROM {staging} ON CONFLICT DO NOTHING')
+    cur.execute(f'DROP TABLE {staging}')
+
+
+def insert_rows(cur: cursor, table: str, columns: Sequence[str], rows: Iterable[tuple],
+                page_size: int = 1000, skip_conflicts: bool = False) -> None:
+    '''
+    Insert `rows` into `table` with multi-row `INSERT`s of up to `page_size` rows.
+    '''
+    on_conflict = ' ON CONFLICT DO NOTHING' if skip_conflicts else ''
+    psycopg2.extras.execute_values(
+        cur,
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s{on_conflict}",
+        list(rows),
+        page_size=page_size)
+
+
+def write_rows(cur: cursor, table: str, columns: Sequence[str], rows: Iterable[tuple],
+               method: str = 'copy', skip_conflicts: bool = False) -> None:
+    '''
+    Bulk-write `rows` into `table`, with `COPY` (`method='copy'`)
+    or multi-row `INSERT`s (`method='values'`).
+    If `skip_conflicts`, rows that violate a unique constraint are skipped.
+    Doesn't commit.
+    '''
+    if method == 'copy' and skip_conflicts:
+        copy_rows_skipping_conflicts(cur, table, columns, rows)
+    elif method == 'copy':
+        copy_rows(cur, table, columns, rows)
+    elif method == 'values':
+        insert_rows(cur, table, columns, rows, skip_conflicts=skip_conflicts)
+    else:
+        raise ValueError(f'Unknown write method {method}')
+
+
+#
+# Bulk reads
+#
+
+def read_frame(cur: cursor, query: str, params: Optional[Sequence] = None, **kwargs) -> pd.DataFrame:
+    '''
+    The results of `query` as a DataFrame, streamed with a single `COPY ... TO STDOUT`
+    (much faster than `fetchall` for many rows). NULLs are NaN.
+    `kwargs` are passed to `pd.read_csv` (e.g. `dtype`).
+    '''
+    buf = io.StringIO()
+    query = cur.mogrify(query, params).decode()
+    cur.copy_expert(f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER, NULL '{COPY_NULL}')", buf)
+    buf.seek(0)
+    # only our NULLs are missing values (`NA` is Namibia)
+    return pd.read_csv(buf, na_values=[COPY_NULL], keep_default_na=False, **kwargs)
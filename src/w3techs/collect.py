@@ -6,20 +6,28 @@
 # collect.py - collects data and saves it in the db.
 # (see file by the same name in repository's root).
 
+import os
 import psycopg2
 import logging
 import pandas as pd
-from funcy import partial
-from datetime import datetime
+from datetime import timedelta
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import src.w3techs.utils as utils
+import src.shared.utils as shared_utils
+import src.shared.schema as schema
+import src.w3techs.types as w3techs_types
+from src.w3techs.types import W3TechsPage
+from src.w3techs.types import PopWeightedGini
 
 
 logger = logging.getLogger("src.w3techs.collect")
 
 
-import src.w3techs.utils as utils
-
 # sources we're scraping from
-w3techs_sources = {
+w3techs_sources: Dict[str, dict] = {
     'data-centers': {
         'url': "https://w3techs.com/technologies/overview/data_center",
     },
@@ -93,6 +101,13 @@ w3techs_sources = {
 }
 
 
+# the measurement scopes we collect: which websites W3Techs surveys (all of them, for now),
+# and what we append to each of `w3techs_sources`' URLs to get that scope's page.
+w3techs_scopes = {
+    'all': '',
+}
+
+
 # These are the markets we include to compute our Gini coefficients.
 # Their meaning and rationale are documented in w3techs/README.md
 included_markets = [
@@ -106,9 +121,16 @@ included_markets = [
 ]
 
 
+# if we ingested a market's page this recently, and it hasn't changed since, we skip it.
+# (less than a day, so that the daily run still records every market.)
+W3TECHS_REINGEST_AFTER = timedelta(hours=12)
+
+
 def collect(postgres_config: dict):
     '''
-    Collect W3Techs data and write them to the database.
+    Collect W3Techs data (for every market, in every measurement scope) and write them to the database.
+
+    Raises `schema.SchemaOutOfDate` if the database needs `python3 run.py migrate` first.
     '''
 
     logger.info('Beginning W3Techs.')
@@ -117,28 +139,76 @@ def collect(postgres_config: dict):
         conn = psycopg2.connect(**postgres_config)
         cur = conn.cursor()
         logger.debug('Connected to database.')
+        w3techs_types.check_schema(cur)
 
-        # Scrape W3Techs data
-        for market_name, dic in w3techs_sources.items():
-            logger.info(f'Scraping {market_name}')
-            # scrape table from W3techs
-            df = utils.scrape_w3techs_table(dic)
-            # extract Marketshare types from datable
-            extract = partial(utils.extract_from_row,
-                              market_name, pd.Timestamp(datetime.now()))
-            marketshares = df.apply(extract, axis=1)
-            # write all Marketshares to the cursor
-            for marketshare in marketshares:
-                marketshare.write_to_db(cur, conn, commit=False)
+        # one time for everything we collect in this run
+        now = shared_utils.now()
+        # pages we've just ingested
+        unchanged = W3TechsPage.hashes_since(cur, now - W3TECHS_REINGEST_AFTER)
+        # Scrape W3Techs data (every scope concurrently; each table arrives as soon as it's ready)
+        sources = utils.scoped_sources(w3techs_sources, w3techs_scopes)
+        for (scope, market_name), page_hash, df in utils.scrape_w3techs_tables(sources, unchanged=unchanged):
+            logger.info(f'Scraped {market_name} ({scope})')
+            # extract (and validate) marketshares from the table
+            marketshares = utils.extract_marketshares(market_name, now, df, measurement_scope=scope)
+            # write all Marketshares to the cursor at once
+            marketshares.write_many(cur)
+            # along with the page they came from
+            W3TechsPage(scope, market_name, page_hash, shared_utils.now()).write_to_db(cur, conn, commit=False)
             # commit all writes to db
             conn.commit()
 
-        # Compute gini coefficients
-        for market in included_markets:
-            logger.info(f'Computing gini for {market}')
-            pop_weighted_gini = utils.population_weighted_gini(cur, 'all', market, pd.Timestamp(datetime.now()))
-            pop_weighted_gini.write_to_db(cur, conn)
+        # Compute gini coefficients (for every scope and market at once)
+        logger.info(f'Computing gini for {", ".join(included_markets)} in {", ".join(w3techs_scopes)}')
+        ginis = utils.population_weighted_ginis(cur, list(w3techs_scopes), included_markets, now)
+        PopWeightedGini.write_many(cur, ginis)
+        conn.commit()
 
         logger.info('W3Techs complete.')
+    except schema.SchemaOutOfDate:
+        # every run would fail the same way until someone migrates, so don't just log it
+        raise
     except Exception as e:
         logger.error(f'Error collecting W3Techs data {e}')
+
+
+# how many processes recompute ginis at once
+RECOMPUTE_WORKERS = os.cpu_count() or 1
+
+
+def recompute_gini(postgres_config: dict, since: pd.Timestamp, until: pd.Timestamp,
+                   workers: int = RECOMPUTE_WORKERS, measurement_scopes: Optional[List[str]] = None):
+    '''
+    Recompute the population-weighted ginis of `included_markets` (in `measurement_scopes`,
+    by default all of `w3techs_scopes`) from `since` to `until`, from the marketshares we scraped
+    (e.g., after updating `prop_net_users.csv` or `providers_labeled.csv`).
+
+    There's one gini per market per day, as of that day's last scrape.
+    The ginis already in that range are replaced in one transaction,
+    so nobody sees a half-recomputed range (and if anything fails, nothing changes).
+    '''
+    if measurement_scopes is None:
+        measurement_scopes = list(w3techs_scopes)
+    logger.info(f'Recomputing ginis from {since} to {until}.')
+    conn = psycopg2.connect(**postgres_config)
+    try:
+        cur = conn.cursor()
+        # one read of every marketshare we need
+        history = utils.fetch_history(cur, measurement_scopes, included_markets, since - utils.GINI_WINDOW, until)
+        logger.info(f'Read {len(history)} marketshares.')
+        evaluations = utils.gini_evaluations(history, since, until)
+        ginis = utils.compute_ginis_parallel(history, evaluations, workers)
+        rows = [PopWeightedGini(g.measurement_scope, g.market, g.gini, g.time)
+                for g in ginis.itertuples(index=False)]
+        cur.execute('''
+            DELETE FROM pop_weighted_gini
+            WHERE measurement_scope = ANY(%s)
+            AND market = ANY(%s)
+            AND time >= %s AND time < %s
+        ''', (list(measurement_scopes), included_markets, since, until))
+        logger.info(f'Replacing {cur.rowcount} ginis with {len(rows)}.')
+        PopWeightedGini.write_many(cur, rows)
+        conn.commit()
+        logger.info('Gini recomputation complete.')
+    finally:
+        conn.close()
@@ -3,29 +3,52 @@
 # 2021
 #
 # w3techs
-# create-tables.py - defines the Postgres tables.
-# (see file by the same name in repository's root).
+# types.py - defines the Postgres tables, and their migrations.
+# (run them with `python3 run.py migrate`.)
 
 from psycopg2.extensions import cursor
 from psycopg2.extensions import connection
+from typing import Dict
+from typing import Iterable
+from typing import List
 from typing import Optional
+from typing import Tuple
 import src.shared.utils as shared_utils
 import src.shared.types as shared_types
+import src.shared.schema as schema
 
 import pandas as pd
 
 
 def is_float_0_1(my_float: float) -> bool:
-    return (type(my_float) == float) & (my_float >= 0) & (my_float <= 1)
+    '''
+    Whether `my_float` is a float (Python's or numpy's; not an int, a string or NaN) between 0 and 1.
+    '''
+    return pd.api.types.is_float(my_float) and (my_float >= 0) and (my_float <= 1)
+
+
+measurement_scopes = ['all', 'top_10k', 'top_1k']
+
 
 def validate_measurement_scope (s: str) -> bool:
-    return (
-        (s == 'all') or
-        (s == 'top_10k') or
-        (s == 'top_1k')
-    )
+    return s in measurement_scopes
+
+
+def are_floats_0_1(values: pd.Series) -> pd.Series:
+    '''
+    `is_float_0_1` for a whole column at once.
+    '''
+    if pd.api.types.is_float_dtype(values):
+        # (NaN isn't between anything)
+        return values.between(0, 1)
+    return values.map(is_float_0_1).astype(bool)
+
+
+def are_measurement_scopes(values: pd.Series) -> pd.Series:
+    return values.isin(measurement_scopes)
 
-class ProviderMarketshare():
+
+class ProviderMarketshare(shared_types.BatchValidated):
     '''
     Class for the table `provider marketshare`.
 
@@ -33,6 +56,9 @@ class ProviderMarketshare():
 
     TODO - Check for SQL injection attacks.
     '''
+    # no `__dict__` per marketshare (see benchmarks/record_memory.py)
+    __slots__ = ('name', 'url', 'jurisdiction_alpha2', 'measurement_scope', 'market', 'marketshare', 'time')
+
     def __init__(self,
                  name: str,
                  url: Optional[str],
@@ -69,23 +95,17 @@ class ProviderMarketshare():
         assert(type(time) == pd.Timestamp)
         self.time = time
 
-    def create_table(
-            self,
-            cur: cursor,
-            conn: connection):
-        cmd = '''
-        CREATE TABLE provider_marketshare (
-        name                VARCHAR NOT NULL,
-        url                 VARCHAR,
-        jurisdiction_alpha2 CHAR(2),
-        measurement_scope   VARCHAR NOT NULL,
-        market              VARCHAR NOT NULL,
-        marketshare         NUMERIC NOT NULL,
-        time                TIMESTAMPTZ NOT NULL DEFAULT now()
-        )
-        '''
-        cur.execute(cmd)
-        conn.commit()
+    ddl = '''
+    CREATE TABLE IF NOT EXISTS provider_marketshare (
+    name                VARCHAR NOT NULL,
+    url                 VARCHAR,
+    jurisdiction_alpha2 CHAR(2),
+    measurement_scope   VARCHAR NOT NULL,
+    market              VARCHAR NOT NULL,
+    marketshare         NUMERIC NOT NULL,
+    time                TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    '''
 
     def write_to_db(
             self,
@@ -110,6 +130,45 @@ class ProviderMarketshare():
             return conn.commit()
         return
 
+    # columns of `provider_marketshare`, in the order of `to_row`
+    columns = ('name', 'url', 'jurisdiction_alpha2', 'measurement_scope', 'market', 'marketshare', 'time')
+
+    # the rules of `__init__`, for `validate_batch`
+    checks = [
+        ("name isn't a non-empty string", lambda df: shared_utils.are_nonempty_strs(df['name'])),
+        ("url isn't a non-empty string", lambda df: df['url'].isna() | shared_utils.are_nonempty_strs(df['url'])),
+        ("jurisdiction_alpha2 isn't an alpha2",
+         lambda df: df['jurisdiction_alpha2'].isna() | (shared_utils.str_lengths(df['jurisdiction_alpha2']) == 2)),
+        ("measurement_scope isn't a measurement scope", lambda df: are_measurement_scopes(df['measurement_scope'])),
+        ("market isn't a non-empty string", lambda df: shared_utils.are_nonempty_strs(df['market'])),
+        ("marketshare isn't between 0 and 1", lambda df: are_floats_0_1(df['marketshare'])),
+        ("time isn't a time", lambda df: shared_utils.are_times(df['time'])),
+    ]
+
+    def to_row(self) -> tuple:
+        return (self.name,
+                self.url,
+                self.jurisdiction_alpha2,
+                self.measurement_scope,
+                self.market,
+                self.marketshare,
+                self.time)
+
+    @classmethod
+    def write_many(
+            cls,
+            cur: cursor,
+            rows: Iterable['ProviderMarketshare'],
+            method='copy',
+    ):
+        '''
+        Write many marketshares at once: with one `COPY`,
+        or with multi-row `INSERT`s if `method='values'`.
+        Doesn't commit.
+        '''
+        shared_utils.write_rows(cur, 'provider_marketshare', cls.columns,
+                                (r.to_row() for r in rows), method=method)
+
     def __str__(self):
         return f'{self.name} {self.url} {self.jurisdiction_alpha2} {self.measurement_scope}   {self.market} {self.marketshare} {self.time}'
 
@@ -117,7 +176,51 @@ class ProviderMarketshare():
         return self.__str__()
 
 
-class PopWeightedGini ():
+class ProviderMarketshareFrame():
+    '''
+    Many `ProviderMarketshare`s as one DataFrame, with a column per field.
+
+    This is where validation happens, a whole column at a time,
+    by the same rules as `ProviderMarketshare` (its `checks`): every row must follow them.
+    (To keep the rows that do, and drop the rest, use `ProviderMarketshare.validate_batch` first.)
+    Missing `url`s and `jurisdiction_alpha2`s are None.
+    '''
+    def __init__(self, df: pd.DataFrame):
+        assert(list(df.columns) == list(ProviderMarketshare.columns))
+        assert(df['marketshare'].dtype == float)
+        assert(pd.api.types.is_datetime64_any_dtype(df['time']))
+
+        assert(ProviderMarketshare.validate_batch(df).rejected.empty)
+
+        self.df = df
+
+    def rows(self) -> Iterable[tuple]:
+        '''Rows in the order of `ProviderMarketshare.columns`.'''
+        return self.df.itertuples(index=False, name=None)
+
+    def write_many(
+            self,
+            cur: cursor,
+            method='copy',
+    ):
+        '''
+        Write every marketshare at once, like `ProviderMarketshare.write_many`.
+        Doesn't commit.
+        '''
+        shared_utils.write_rows(cur, 'provider_marketshare', ProviderMarketshare.columns,
+                                self.rows(), method=method)
+
+    def __len__(self):
+        return len(self.df)
+
+    def __str__(self):
+        return str(self.df)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class PopWeightedGini (shared_types.BatchValidated):
     '''
     Class for the table `pop_weighted_gini`.
 
@@ -125,6 +228,8 @@ class PopWeightedGini ():
 
     TODO - Check for SQL injection attacks.
     '''
+    __slots__ = ('measurement_scope', 'market', 'gini', 'time')
+
     def __init__(self,
                  measurement_scope: str,
                  market: str,
@@ -137,26 +242,20 @@ class PopWeightedGini ():
         assert(validate_measurement_scope(measurement_scope))
         self.measurement_scope = measurement_scope
 
-        assert(is_float_0_1(float(gini)))
+        assert(is_float_0_1(gini))
         self.gini = gini
 
         assert(type(time) == pd.Timestamp)
         self.time = time
 
-    def create_table(
-            self,
-            cur: cursor,
-            conn: connection):
-        cmd = '''
-        CREATE TABLE pop_weighted_gini (
-        measurement_scope   VARCHAR NOT NULL,
-        market              VARCHAR NOT NULL,
-        gini                NUMERIC NOT NULL,
-        time                TIMESTAMPTZ NOT NULL DEFAULT now()
-        )
-        '''
-        cur.execute(cmd)
-        conn.commit()
+    ddl = '''
+    CREATE TABLE IF NOT EXISTS pop_weighted_gini (
+    measurement_scope   VARCHAR NOT NULL,
+    market              VARCHAR NOT NULL,
+    gini                NUMERIC NOT NULL,
+    time                TIMESTAMPTZ NOT NULL DEFAULT now()
+    )
+    '''
 
     def write_to_db(
             self,
@@ -175,6 +274,35 @@ class PopWeightedGini ():
             return conn.commit()
         return
 
+    # columns of `pop_weighted_gini`, in the order of `to_row`
+    columns = ('measurement_scope', 'market', 'gini', 'time')
+
+    # the rules of `__init__`, for `validate_batch`
+    checks = [
+        ("measurement_scope isn't a measurement scope", lambda df: are_measurement_scopes(df['measurement_scope'])),
+        ("market isn't a non-empty string", lambda df: shared_utils.are_nonempty_strs(df['market'])),
+        ("gini isn't between 0 and 1", lambda df: are_floats_0_1(df['gini'])),
+        ("time isn't a time", lambda df: shared_utils.are_times(df['time'])),
+    ]
+
+    def to_row(self) -> tuple:
+        return (self.measurement_scope, self.market, self.gini, self.time)
+
+    @classmethod
+    def write_many(
+            cls,
+            cur: cursor,
+            rows: Iterable['PopWeightedGini'],
+            method='copy',
+    ):
+        '''
+        Write many ginis at once: with one `COPY`,
+        or with a multi-row `INSERT` if `method='values'`.
+        Doesn't commit.
+        '''
+        shared_utils.write_rows(cur, 'pop_weighted_gini', cls.columns,
+                                (r.to_row() for r in rows), method=method)
+
     def __str__(self):
         return f'{self.measurement_scope} {self.market} {self.gini} {self.time}'
 
@@ -182,17 +310,197 @@ class PopWeightedGini ():
         return self.__str__()
 
 
-def create_tables(cur: cursor, conn: connection):
+class W3TechsPage (shared_types.BatchValidated):
+    '''
+    Class for the table `w3techs_page`: the content of the page
+    we last ingested for each (measurement scope, market), and when.
+    '''
+    __slots__ = ('measurement_scope', 'market', 'content_hash', 'ingested_at')
+
+    def __init__(self,
+                 measurement_scope: str,
+                 market: str,
+                 content_hash: str,
+                 ingested_at: pd.Timestamp):
+        assert(validate_measurement_scope(measurement_scope))
+        self.measurement_scope = measurement_scope
+
+        assert(shared_utils.is_nonempty_str(market))
+        self.market = market
+
+        # a sha256 hex digest
+        assert(shared_utils.is_nonempty_str(content_hash))
+        assert(len(content_hash) == 64)
+        self.content_hash = content_hash
+
+        assert(type(ingested_at) == pd.Timestamp)
+        self.ingested_at = ingested_at
+
+    columns = ('measurement_scope', 'market', 'content_hash', 'ingested_at')
+    checks = [
+        ("measurement_scope isn't a measurement scope", lambda df: are_measurement_scopes(df['measurement_scope'])),
+        ("market isn't a non-empty string", lambda df: shared_utils.are_nonempty_strs(df['market'])),
+        ("content_hash isn't a sha256 hex digest", lambda df: shared_utils.str_lengths(df['content_hash']) == 64),
+        ("ingested_at isn't a time", lambda df: shared_utils.are_times(df['ingested_at'])),
+    ]
+
+    ddl = '''
+    CREATE TABLE IF NOT EXISTS w3techs_page (
+    measurement_scope   VARCHAR NOT NULL DEFAULT 'all',
+    market              VARCHAR NOT NULL,
+    content_hash        CHAR(64) NOT NULL,
+    ingested_at         TIMESTAMPTZ NOT NULL,
+    PRIMARY KEY (measurement_scope, market)
+    )
+    '''
+
+    def write_to_db(
+            self,
+            cur: cursor,
+            conn: connection,
+            commit=True,
+    ):
+        cur.execute(
+            """
+            INSERT INTO w3techs_page
+            (measurement_scope, market, content_hash, ingested_at)
+            VALUES
+            (%s, %s, %s, %s)
+            ON CONFLICT (measurement_scope, market) DO UPDATE SET
+            content_hash = EXCLUDED.content_hash,
+            ingested_at = EXCLUDED.ingested_at
+            """, (self.measurement_scope, self.market, self.content_hash, self.ingested_at))
+        if commit:
+            return conn.commit()
+        return
+
+    @classmethod
+    def hashes_since(
+            cls,
+            cur: cursor,
+            since: pd.Timestamp,
+    ) -> Dict[Tuple[str, str], str]:
+        '''
+        The content hash of each (measurement scope, market)'s page, for pages ingested after `since`.
+        '''
+        cur.execute(
+            """
+            SELECT measurement_scope, market, content_hash FROM w3techs_page
+            WHERE ingested_at > %s
+            """, (since,))
+        return {(scope, market): content_hash for scope, market, content_hash in cur.fetchall()}
+
+    def __str__(self):
+        return f'{self.measurement_scope} {self.market} {self.content_hash} {self.ingested_at}'
+
+    def __repr__(self):
+        return self.__str__()
+
+
+#
+# Migrations
+#
+# Append new ones to `migrations`; never edit one that's been released.
+# Every `CREATE` is `IF NOT EXISTS`, so databases from before `schema_version`
+# are brought up to date by the same migrations as new ones.
+# Each migration has its own SQL, so changing a type's `ddl` (which describes the table
+# as the migrations leave it) never changes a migration.
+#
+def create_base_tables(cur: cursor):
+    '''
+    Migration: the original W3Techs tables.
+    '''
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS provider_marketshare (
+      name                VARCHAR NOT NULL,
+      url                 VARCHAR,
+      jurisdiction_alpha2 CHAR(2),
+      measurement_scope   VARCHAR NOT NULL,
+      market              VARCHAR NOT NULL,
+      marketshare         NUMERIC NOT NULL,
+      time                TIMESTAMPTZ NOT NULL DEFAULT now()
+      )
+    """)
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS pop_weighted_gini (
+      measurement_scope   VARCHAR NOT NULL,
+      market              VARCHAR NOT NULL,
+      gini                NUMERIC NOT NULL,
+      time                TIMESTAMPTZ NOT NULL DEFAULT now()
+      )
+    """)
+
+
+def create_indexes(cur: cursor):
+    '''
+    Migration: index the columns we look W3Techs data up by.
+    '''
+    # a market's marketshares in a time window (`fetch_rows`)
+    cur.execute("""
+      CREATE INDEX IF NOT EXISTS provider_marketshare_market_scope_time
+      ON provider_marketshare (market, measurement_scope, time)
+    """)
+    # a market's gini over time (Grafana)
+    cur.execute("""
+      CREATE INDEX IF NOT EXISTS pop_weighted_gini_market_scope_time
+      ON pop_weighted_gini (market, measurement_scope, time)
+    """)
+
+
+def create_page_table(cur: cursor):
+    '''
+    Migration: the pages we've ingested.
+    '''
+    cur.execute("""
+      CREATE TABLE IF NOT EXISTS w3techs_page (
+      market              VARCHAR PRIMARY KEY,
+      content_hash        CHAR(64) NOT NULL,
+      ingested_at         TIMESTAMPTZ NOT NULL
+      )
+    """)
+
+
+def add_page_scope(cur: cursor):
     '''
-    Create database tables for W3Techs data.
+    Migration: a page per (measurement scope, market), now that we collect more than one scope.
     '''
+    cur.execute("""
+      ALTER TABLE w3techs_page
+      ADD COLUMN IF NOT EXISTS measurement_scope VARCHAR NOT NULL DEFAULT 'all'
+    """)
+    cur.execute('ALTER TABLE w3techs_page DROP CONSTRAINT IF EXISTS w3techs_page_pkey')
+    cur.execute('ALTER TABLE w3techs_page ADD PRIMARY KEY (measurement_scope, market)')
+
 
-    # dummy data - just a demo
-    ProviderMarketshare(
-        'name', None, shared_types.Alpha2('CA'), 'all', 'ssl-certificate', 0.5, pd.Timestamp('2021-04-20')
-    ).create_table(cur, conn)
+migrations = [
+    schema.Migration(1, 'create provider_marketshare, pop_weighted_gini', create_base_tables),
+    schema.Migration(2, 'indexes for lookups by market, scope and time', create_indexes),
+    schema.Migration(3, 'create w3techs_page', create_page_table),
+    schema.Migration(4, 'add measurement_scope to w3techs_page', add_page_scope),
+]
+
+
+def migrate(cur: cursor, conn: connection) -> List[int]:
+    '''
+    Bring the W3Techs tables (and the shared ones) up to date. Returns the versions applied.
+    '''
+    shared_types.migrate(cur, conn)
+    return schema.migrate(cur, conn, 'w3techs', migrations)
 
-    # dummy data - just a demo
-    PopWeightedGini(
-        'all', 'ssl-certificate', 0.9, pd.Timestamp('2021-04-20')
-    ).create_table(cur, conn)
+
+def check_schema(cur: cursor) -> None:
+    '''
+    Raise `schema.SchemaOutOfDate` if the W3Techs tables (or the shared ones) need migrating.
+    '''
+    shared_types.check_schema(cur)
+    schema.check_schema_version(cur, 'w3techs', migrations)
+
+
+def partition_tables(cur: cursor, conn: connection):
+    '''
+    Optional: partition `provider_marketshare` by month (after `migrate`).
+    Run it again every so often to add partitions for the coming months.
+    '''
+    schema.partition_by_month(cur, conn, 'provider_marketshare', 'time')
+    create_indexes(cur)
+    conn.commit()
@@ -1,21 +1,44 @@
+import time
+import logging
 import requests
 import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from functools import lru_cache
 from os import path
 from bs4 import BeautifulSoup
+try:
+    import lxml.html
+except ImportError:
+    # optional: we fall back on BeautifulSoup's `html.parser`
+    lxml = None
 import src.shared.utils as shared_utils
+import src.shared.http_cache as http_cache
 import src.shared.types as shared_types
 
 # types
 from psycopg2.extensions import cursor
+from typing import Dict
+from typing import Hashable
+from typing import Iterator
+from typing import Mapping
 from typing import Optional
 from typing import List
+from typing import Tuple
+from typing import TypeVar
 from bs4.element import NavigableString
 from bs4.element import Tag
 from bs4.element import ResultSet
 
 from src.w3techs.types import ProviderMarketshare
+from src.w3techs.types import ProviderMarketshareFrame
 from src.w3techs.types import PopWeightedGini
+from src.w3techs.types import validate_measurement_scope
+
+
+logger = logging.getLogger("src.w3techs.utils")
 
 #
 # Scrape utilities
@@ -71,7 +94,7 @@ def get_marketshares_ssl(table: Tag) -> List[float]:
     return marketshares
 
 
-def extract_table(html: str, double_table: bool = False) -> pd.DataFrame:
+def extract_table_soup(html: str, double_table: bool = False) -> pd.DataFrame:
     # get request to w3techs; parse html
     table = get_table(html)
 
@@ -98,24 +121,155 @@ def extract_table(html: str, double_table: bool = False) -> pd.DataFrame:
     return providers
 
 
-def scrape_w3techs_table(w3techs: dict) -> pd.DataFrame:
-    # read w3techs object described in local config
+def has_class(name: str) -> str:
+    '''XPath predicate: the element's `class` includes `name`.'''
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+
+def extract_table_lxml(html: str, double_table: bool = False) -> pd.DataFrame:
+    '''
+    `extract_table_soup`, parsed and walked in C with lxml. Gives the same DataFrame.
+    '''
+    table = lxml.html.fromstring(html).xpath(f'//table[{has_class("bars")}]')[0]
+
+    # the first link directly in each header is a provider
+    providers = pd.DataFrame([
+        {'name': links[0].text, 'url': links[0].get('href')}
+        for links in (th.xpath('./a[@href]') for th in table.iter('th'))
+        if links
+    ])
+
+    if double_table:
+        # the percentage is in the second cell of each bar's row
+        marketshares = [p2f(bar.xpath('ancestor::tr[1]//td')[1].text)
+                        for bar in table.xpath(f'.//div[{has_class("bar2")}]')]
+    else:
+        # cells that start with a percentage
+        marketshares = [p2f(td.text) for td in table.iter('td')
+                        if td.text is not None and td.text.endswith('%')]
+
+    providers['marketshare'] = marketshares
+    return providers
+
+
+# ways to parse a W3Techs table; they all give the same DataFrame.
+table_parsers = {
+    'html.parser': extract_table_soup,
+    'lxml': extract_table_lxml,
+}
+DEFAULT_TABLE_PARSER = 'html.parser' if lxml is None else 'lxml'
+
+
+def extract_table(html: str, double_table: bool = False, parser: str = DEFAULT_TABLE_PARSER) -> pd.DataFrame:
+    return table_parsers[parser](html, double_table=double_table)
+
+
+# how many pages we fetch from W3Techs at once (be polite)
+W3TECHS_CONCURRENCY = 4
+# seconds to wait for W3Techs to connect, or to send the next bit of a page
+W3TECHS_TIMEOUT = 30
+# how many times we retry a page, and how long to wait before the first retry (doubling each time)
+W3TECHS_RETRIES = 3
+W3TECHS_BACKOFF = 1.0
+
+
+def fetch_w3techs_html(w3techs: dict, session: Optional[requests.Session] = None) -> http_cache.CachedResponse:
+    '''
+    Fetch a W3Techs page, through the HTTP cache.
+    '''
     w3techs_url = w3techs['url']
+    my_session = session if session is not None else requests.Session()
+    start = time.perf_counter()
+    resp = http_cache.cached_get(my_session, w3techs_url, timeout=W3TECHS_TIMEOUT)
+    elapsed = time.perf_counter() - start
+    if resp.not_modified:
+        logger.info(f'Revalidated {w3techs_url} in {elapsed:.2f}s (not modified).')
+    else:
+        logger.info(f'Fetched {w3techs_url} in {elapsed:.2f}s ({len(resp.content)} bytes).')
+    if session is None:
+        my_session.close()
+    return resp
+
+
+def is_double_table(w3techs: dict) -> bool:
+    # read w3techs object described in local config
     try:
-        is_double_table = w3techs['double_table']
+        return w3techs['double_table']
     except (KeyError):
-        is_double_table = False
+        return False
+
+
+def scrape_w3techs_table(w3techs: dict, session: Optional[requests.Session] = None) -> pd.DataFrame:
     # fetch the HTML
-    html = requests.get(w3techs_url).text
+    html = fetch_w3techs_html(w3techs, session).text
     # parse the HTML
-    return extract_table(html, double_table=is_double_table)
+    return extract_table(html, double_table=is_double_table(w3techs))
+
+
+def scrape_w3techs_page(w3techs: dict, session: Optional[requests.Session] = None,
+                        skip_hash: Optional[str] = None) -> Tuple[str, Optional[pd.DataFrame]]:
+    '''
+    Like `scrape_w3techs_table`, but also returns the hash of the page's content.
+    If that's `skip_hash`, the page isn't parsed, and the table is None.
+    '''
+    resp = fetch_w3techs_html(w3techs, session)
+    if resp.content_hash == skip_hash:
+        return resp.content_hash, None
+    return resp.content_hash, extract_table(resp.text, double_table=is_double_table(w3techs))
+
+
+def scoped_sources(sources: Dict[str, dict], scopes: Dict[str, str]) -> Dict[Tuple[str, str], dict]:
+    '''
+    A source for each (measurement scope, market): each of `sources` (by market),
+    with its URL for each of `scopes` (measurement scope -> what to append to the URL).
+    '''
+    return {(scope, market): {**w3techs, 'url': w3techs['url'] + suffix}
+            for scope, suffix in scopes.items()
+            for market, w3techs in sources.items()}
+
+
+# what sources are named by (e.g. market, or (measurement scope, market))
+SourceName = TypeVar('SourceName', bound=Hashable)
+
+
+def scrape_w3techs_tables(sources: Mapping[SourceName, dict],
+                          max_workers: int = W3TECHS_CONCURRENCY,
+                          unchanged: Optional[Mapping[SourceName, str]] = None
+                          ) -> Iterator[Tuple[SourceName, str, pd.DataFrame]]:
+    '''
+    Scrape many W3Techs tables concurrently, over one keep-alive session, yielding
+    (name, content hash, table) for each source as soon as it's parsed. (So in no particular order.)
+    Sources that fail (after retries) are logged and skipped.
+
+    `unchanged` maps sources to the content hash of a page we don't need again:
+    if a source's page still has that hash, it's skipped too.
+    '''
+    unchanged = unchanged or {}
+    with shared_utils.http_session(max_connections=max_workers, retries=W3TECHS_RETRIES,
+                                   backoff=W3TECHS_BACKOFF) as session, \
+            ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(scrape_w3techs_page, w3techs, session, unchanged.get(name)): name
+                   for name, w3techs in sources.items()}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                page_hash, df = future.result()
+            except Exception as e:
+                logger.error(f'Error scraping {name}: {e}')
+                continue
+            if df is None:
+                logger.info(f'{name} is unchanged since we last ingested it; skipping.')
+                continue
+            yield name, page_hash, df
+
 
 #
 # Data marshalling utilities
 #
 
 
-def extract_from_row(market: str, time: pd.Timestamp, df_row: pd.Series) -> ProviderMarketshare:
+def extract_from_row(market: str, time: pd.Timestamp, df_row: pd.Series,
+                     measurement_scope: str = 'all') -> ProviderMarketshare:
     '''
     Takes a row of a scraped dataframe and returns ProviderMarketshare.
     `market` and `time` are the first parameters because we partially apply them.
@@ -130,16 +284,99 @@ def extract_from_row(market: str, time: pd.Timestamp, df_row: pd.Series) -> Prov
     # Once data is in this type, it *should* be trustworthy.
     # See /design-notes.md for more detail on this pattern.
     return ProviderMarketshare(
-        str(name), str(url), juris, 'all', market, float(marketshare), time
+        str(name), str(url), juris, measurement_scope, market, float(marketshare), time
     )
 
 
+def extract_marketshares(market: str, time: pd.Timestamp, df: pd.DataFrame,
+                         measurement_scope: str = 'all') -> ProviderMarketshareFrame:
+    '''
+    `extract_from_row` for a whole scraped dataframe at once.
+    Rows that don't validate (e.g. a marketshare that isn't a number) are logged and left out,
+    rather than losing the whole table.
+    '''
+    assert(validate_measurement_scope(measurement_scope))
+    names = df['name'].map(str)
+    marketshares = pd.DataFrame({
+        'name': names,
+        'url': df['url'].map(str),
+        'jurisdiction_alpha2': shared_utils.get_countries(names),
+        'measurement_scope': measurement_scope,
+        'market': market,
+        'marketshare': pd.to_numeric(df['marketshare'], errors='coerce').astype(float),
+        'time': time,
+    }, columns=ProviderMarketshare.columns)
+    accepted, rejected = ProviderMarketshare.validate_batch(marketshares)
+    if len(rejected):
+        logger.warning(f'Rejected {len(rejected)} of {len(marketshares)} {market} ({measurement_scope}) marketshares: ' +
+                       shared_types.describe_rejected(rejected))
+        logger.debug(f'Rejected marketshares:\n{rejected}')
+    return ProviderMarketshareFrame(accepted)
+
+
 #
 # Population-weighted gini tools
 #
 dirname = path.dirname(__file__)
 pth = path.join(dirname, 'analysis', 'prop_net_users.csv')
-prop_net_users = pd.read_csv(pth).set_index('alpha2')
+# (`NA` is Namibia, not a missing value)
+prop_net_users = pd.read_csv(pth, keep_default_na=False, na_values=['']).set_index('alpha2')
+
+
+class PopulationShares():
+    '''
+    Each country's share of the world's Internet users, by year, laid out for weighting marketshares
+    with array operations: `alpha2s` maps alpha2 codes to columns, and `weights` has a row per year
+    (from `first_year` to `last_year`) of 1 / each country's share.
+
+    Years after `last_year` carry its shares forward (and years before `first_year` carry that year's back).
+    '''
+    def __init__(self, df: pd.DataFrame):
+        years = [int(year) for year in df.columns]
+        assert(years == list(range(years[0], years[0] + len(years))))
+        self.first_year = years[0]
+        self.last_year = years[-1]
+        self.alpha2s = pd.Index(df.index)
+        assert(self.alpha2s.is_unique)
+        # year-major
+        self.shares = np.ascontiguousarray(df.values.T, dtype=float)
+        # countries we have no share for weigh nothing
+        with np.errstate(divide='ignore'):
+            weights = 1 / self.shares
+        weights[~np.isfinite(weights)] = 0
+        self.weights = weights
+
+    def year_rows(self, years: np.ndarray) -> np.ndarray:
+        '''
+        The row of each of `years`, carrying the shares we have forward (or back).
+        '''
+        return np.clip(np.asarray(years) - self.first_year, 0, self.last_year - self.first_year)
+
+    def columns(self, alpha2s: np.ndarray) -> np.ndarray:
+        '''
+        The column of each of `alpha2s`, or -1 if we have no share for it.
+        '''
+        return self.alpha2s.get_indexer(alpha2s)
+
+    def weigh(self, rows: np.ndarray, alpha2s: np.ndarray, marketshares: np.ndarray,
+              years: np.ndarray) -> np.ndarray:
+        '''
+        Population-weighted marketshares: a row per year in `years`, and a column per country.
+        Each marketshare is scattered into its row (in `rows`) and its country's column (in `alpha2s`);
+        each (row, country) must appear only once.
+        Countries with no marketshare are 0, and marketshares of countries we don't know are left out.
+        '''
+        year_rows = self.year_rows(years)
+        columns = self.columns(alpha2s)
+        known = columns >= 0
+        rows = np.asarray(rows)[known]
+        columns = columns[known]
+        weighted = np.zeros((len(year_rows), len(self.alpha2s)))
+        weighted[rows, columns] = np.asarray(marketshares, dtype=float)[known] * self.weights[year_rows[rows], columns]
+        return weighted
+
+
+population_shares = PopulationShares(prop_net_users)
 
 
 def to_df(db_rows) -> pd.DataFrame:
@@ -172,6 +409,21 @@ def fetch_by_jurisdiction(cur: cursor, measurement_scope: str, market: str,  dat
     return rows
 
 
+# `gini` counts every value as at least this much (the formula breaks down with zeros)
+GINI_EPSILON = 0.0000001
+
+
+@lru_cache(maxsize=64)
+def gini_weights(n: int) -> np.ndarray:
+    '''
+    (2i - n - 1) for i in 1..n: the weight of the i-th smallest value in a Gini coefficient.
+    '''
+    weights = np.arange(1 - n, n, 2, dtype=float)
+    # shared between calls
+    weights.flags.writeable = False
+    return weights
+
+
 def gini(array: np.array) -> float:
     """
     Calculate the Gini coefficient of a numpy array.
@@ -182,20 +434,32 @@ def gini(array: np.array) -> float:
     # from:
     # http://www.statsdirect.com/help/default.htm#nonparametric_methods/gini.htm
     # All values are treated equally, arrays must be 1d:
-    array = array.flatten()
-    if np.amin(array) < 0:
-        # Values cannot be negative:
-        array -= np.amin(array)
-    # Values cannot be 0:
-    array += 0.0000001
+    return gini_rows(np.reshape(array, (1, -1)))[0]
+
+
+def gini_rows(matrix: np.ndarray, presorted: bool = False) -> np.ndarray:
+    '''
+    `gini` of each row of a 2-D array, all at once. Doesn't change `matrix`.
+
+    If `presorted`, each row must already be sorted (ascending), and the rows aren't copied at all.
+    '''
+    matrix = np.asarray(matrix, dtype=float)
+    assert(matrix.ndim == 2)
     # Values must be sorted:
-    array = np.sort(array)
-    # Index per array element:
-    index = np.arange(1, array.shape[0]+1)
+    ranked = matrix if presorted else np.sort(matrix, axis=1)
     # Number of array elements:
-    n = array.shape[0]
-    # Gini coefficient:
-    return ((np.sum((2 * index - n - 1) * array)) / (n * np.sum(array)))
+    n = ranked.shape[1]
+    # `gini` shifts the values so that they're positive (and not 0): up by the minimum if it's negative,
+    # then by `GINI_EPSILON`.
+    shift = np.maximum(-ranked[:, 0], 0) + GINI_EPSILON
+    # The weights are antisymmetric, so we pair the i-th smallest value with the i-th largest.
+    # The shift cancels out of their differences, which are never negative (so nothing cancels out
+    # of their sum, either).
+    half = n // 2
+    largest = ranked[:, ::-1][:, :half]
+    numerator = (largest - ranked[:, :half]) @ gini_weights(n)[::-1][:half]
+    # It only changes the denominator, so we add it there instead of to every value.
+    return numerator / (n * (ranked.sum(axis=1) + n * shift))
 
 
 def weighted_gini(marketshares: pd.Series, population_shares: pd.Series) -> float:
@@ -213,20 +477,143 @@ def population_weighted_gini(cur: cursor, measurement_scope: str, market: str, t
     if len(by_juris) == 0:
         return None
 
-    # TODO break out JUST this and test it with some mock data?
-    # get current % of Internet using population
-    relevant_year = str(time.year)
-    pop_share_df = prop_net_users[relevant_year]
-    # weight marketshare
-    merged = pd.DataFrame(pop_share_df).merge(by_juris,
-                                              left_index=True,
-                                              right_on='jurisdiction_alpha2',
-                                              how='left')
+    # weight marketshare by the % of Internet using population that year.
     # we include countries that do  NOT appear in our scraped data.
     # the intention here is to get the gini among ALL countries,
     # including those that provide no internet services.
-    g = weighted_gini(
-        merged['marketshare'],
-        merged[relevant_year],
+    weighted = population_shares.weigh(
+        np.zeros(len(by_juris), dtype=int),
+        by_juris.index,
+        by_juris['marketshare'].values,
+        np.array([time.year]),
     )
+    g = gini(weighted[0])
     return PopWeightedGini(measurement_scope, market, g, time)
+
+
+#
+# Recomputing past ginis
+#
+
+# marketshares that go into a gini: those scraped in the 24 hours up to it (as in `fetch_rows`)
+GINI_WINDOW = pd.Timedelta(hours=24)
+
+
+def fetch_history(cur: cursor, measurement_scopes: List[str], markets: List[str],
+                  since: pd.Timestamp, until: pd.Timestamp) -> pd.DataFrame:
+    '''
+    Every marketshare of `markets` in `measurement_scopes` scraped between `since` (inclusive)
+    and `until` (inclusive), in one columnar DataFrame.
+    '''
+    rows = shared_utils.read_frame(cur, '''
+        SELECT name, jurisdiction_alpha2, measurement_scope, market, marketshare, time FROM provider_marketshare
+        WHERE measurement_scope = ANY(%s)
+        AND market = ANY(%s)
+        AND time BETWEEN %s AND %s
+    ''', (list(measurement_scopes), list(markets), since, until),
+        dtype={'name': str, 'jurisdiction_alpha2': str, 'measurement_scope': str,
+               'market': str, 'marketshare': float})
+    rows['time'] = pd.to_datetime(rows['time'], utc=True)
+    return rows
+
+
+def gini_evaluations(history: pd.DataFrame, since: pd.Timestamp, until: pd.Timestamp) -> pd.DataFrame:
+    '''
+    When we compute each gini in `history` between `since` and `until` (exclusive):
+    for every (measurement scope, market) and every (UTC) day, just after its last scrape that day.
+    That's when `collect` computes them.
+    '''
+    in_range = history[(history['time'] >= since) & (history['time'] < until)]
+    day = in_range['time'].dt.floor('D').rename('day')
+    evaluations = in_range.groupby(['measurement_scope', 'market', day])['time'].max()
+    return evaluations.reset_index()[['measurement_scope', 'market', 'time']]
+
+
+def window_positions(history: pd.DataFrame, evaluations: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    The rows of `history` in each evaluation's `GINI_WINDOW`, as (positions in `history`,
+    position of the evaluation each belongs to). `history` must be sorted by time.
+    '''
+    window = GINI_WINDOW.to_timedelta64()
+    times = history['time'].values
+    ends = evaluations['time'].values
+    rows_of = history.groupby(['measurement_scope', 'market']).indices
+    positions, owners = [np.empty(0, dtype=int)], [np.empty(0, dtype=int)]
+    for key, evals in evaluations.groupby(['measurement_scope', 'market']).indices.items():
+        rows = rows_of.get(key)
+        if rows is None:
+            continue
+        # each window is a slice [lo, hi) of this market's (sorted) rows
+        lo = np.searchsorted(times[rows], ends[evals] - window, side='left')
+        hi = np.searchsorted(times[rows], ends[evals], side='right')
+        counts = hi - lo
+        # every position in every slice, without a python loop over them
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        positions.append(rows[np.repeat(lo, counts) + offsets])
+        owners.append(np.repeat(evals, counts))
+    return np.concatenate(positions), np.concatenate(owners)
+
+
+def compute_ginis(history: pd.DataFrame, evaluations: pd.DataFrame) -> pd.DataFrame:
+    '''
+    The population-weighted gini of each of `evaluations` (measurement_scope, market, time),
+    from the marketshares in `history`, all at once.
+    The same as `population_weighted_gini` at each time, but with no queries.
+    Evaluations with no marketshares (that have a jurisdiction) are left out.
+    '''
+    history = history.sort_values('time', kind='stable').reset_index(drop=True)
+    evaluations = evaluations.reset_index(drop=True)
+    positions, owners = window_positions(history, evaluations)
+    windows = history.iloc[positions][['name', 'jurisdiction_alpha2', 'marketshare']]
+    windows = windows.assign(evaluation=owners)
+    # as in `fetch_by_jurisdiction`: median of any repeated (name, jurisdiction),
+    medians = windows.groupby(['evaluation', 'name', 'jurisdiction_alpha2'])['marketshare'].median()
+    # then the sum in each jurisdiction
+    by_juris = medians.groupby(level=['evaluation', 'jurisdiction_alpha2']).sum()
+    found = by_juris.index.unique('evaluation').sort_values()
+    if len(found) == 0:
+        return evaluations.iloc[:0].assign(gini=pd.Series(dtype=float))
+    # a row per evaluation (weighted for its year), and a column per country,
+    # including those that do NOT appear in our scraped data
+    weighted = population_shares.weigh(
+        found.get_indexer(by_juris.index.get_level_values('evaluation')),
+        by_juris.index.get_level_values('jurisdiction_alpha2'),
+        by_juris.values,
+        evaluations['time'].dt.year.values[found],
+    )
+    return evaluations.iloc[found].assign(gini=gini_rows(weighted))
+
+
+def compute_ginis_parallel(history: pd.DataFrame, evaluations: pd.DataFrame, workers: int) -> pd.DataFrame:
+    '''
+    `compute_ginis`, split by time across `workers` processes.
+    '''
+    if workers <= 1 or len(evaluations) < 2:
+        return compute_ginis(history, evaluations)
+    evaluations = evaluations.sort_values('time', kind='stable').reset_index(drop=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for chunk in np.array_split(np.arange(len(evaluations)), min(workers, len(evaluations))):
+            chunk = evaluations.iloc[chunk]
+            # each worker only gets the marketshares its windows need
+            start, end = chunk['time'].min() - GINI_WINDOW, chunk['time'].max()
+            needed = history[(history['time'] >= start) & (history['time'] <= end)]
+            futures.append(executor.submit(compute_ginis, needed, chunk))
+        return pd.concat([f.result() for f in futures], ignore_index=True)
+
+
+def population_weighted_ginis(cur: cursor, measurement_scopes: List[str], markets: List[str],
+                              time: pd.Timestamp) -> List[PopWeightedGini]:
+    '''
+    `population_weighted_gini` for every (measurement scope, market), with one query and one pass
+    over all of them. `time` must have a timezone. Pairs with no marketshares are left out.
+
+    (For one scope's markets, pass just that scope: there's no separate function per scope,
+    since `collect` wants every scope's ginis, and one query for all of them beats one per scope.)
+    '''
+    history = fetch_history(cur, measurement_scopes, markets, time - GINI_WINDOW, time)
+    evaluations = pd.DataFrame([(scope, market, time) for scope in measurement_scopes for market in markets],
+                               columns=['measurement_scope', 'market', 'time'])
+    ginis = compute_ginis(history, evaluations)
+    return [PopWeightedGini(g.measurement_scope, g.market, g.gini, g.time)
+            for g in ginis.itertuples(index=False)]
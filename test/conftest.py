@@ -0,0 +1,32 @@
+# taaraxtak
+#
+# test
+# conftest.py - the config the tests run with.
+#
+# The code reads its settings from config.py, which each deployment makes from
+# config.example.py (see INSTALL.md). The tests don't use a deployment's: they
+# get this one instead, before any of `src` is imported.
+
+import sys
+import types
+import logging
+import tempfile
+from os import path
+
+
+config = {
+    # (tests start their own databases with `testing.postgresql`)
+    "postgres": {},
+    "tld_cache_dir": tempfile.mkdtemp(prefix='taaraxtak-tld-'),
+    # a made-up database, with only the IPs the tests look up
+    "geoip_database": path.join(path.dirname(__file__), 'geoip', 'test-country.mmdb'),
+    "http_cache_directory": tempfile.mkdtemp(prefix='taaraxtak-http-'),
+    "logging": {
+        "level": logging.DEBUG,
+        "handler": "terminal"
+    }
+}
+
+config_module = types.ModuleType('config')
+config_module.config = config  # type: ignore
+sys.modules['config'] = config_module
@@ -1,3 +1,8 @@
+import json
+import asyncio
+import socket
+import threading
+import time
 import psycopg2
 import testing.postgresql
 import pytest
@@ -6,9 +11,11 @@ from datetime import timedelta
 
 
 import src.ooni.utils as ooni_utils
+import src.ooni.collect as ooni_collect
 import src.ooni.types as ooni_types
 import src.shared.types as shared_types
 import src.shared.utils as shared_utils
+import src.shared.schema as schema
 
 
 # TODO make DRY with other test - test utils?
@@ -18,7 +25,8 @@ def postgresdb(request):
     postgresql = testing.postgresql.Postgresql()
     conn = psycopg2.connect(**postgresql.dsn())
     cur = conn.cursor()
-    ooni_types.create_tables(cur, conn)
+    ooni_types.migrate(cur, conn)
+    ooni_utils.ip_cache.clear()
 
     def teardown():
         postgresql.stop()
@@ -51,6 +59,83 @@ def test_get_hostname():
 #     IP(maybe_ip)
 
 
+def stub_resolver(records: dict, delay: float = 0):
+    '''A stub DNS resolver: hostname -> list of IPs. Counts the lookups it gets.'''
+    calls = []
+
+    async def lookup(hostname):
+        calls.append(hostname)
+        await asyncio.sleep(delay)
+        if hostname not in records:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+        return records[hostname]
+    return lookup, calls
+
+
+def test_resolve_many():
+    ooni_utils.dns_negative_cache.clear()
+    lookup, calls = stub_resolver({
+        'website.nl': ['212.78.221.95'],
+        'website.us': ['10.0.0.1', '35.163.72.93'],
+        'intranet.example': ['192.168.1.1'],
+    })
+    hostnames = ['website.nl', 'website.us', 'intranet.example', 'nxdomain.example', 'website.nl']
+    ips = ooni_utils.resolve_many(hostnames, lookup=lookup)
+    assert(ips == {
+        'website.nl': '212.78.221.95',
+        # we skip private IPs
+        'website.us': '35.163.72.93',
+        'intranet.example': None,
+        'nxdomain.example': None,
+    })
+    assert(len(calls) == 4)
+    # NXDOMAINs and private IPs are cached
+    ooni_utils.resolve_many(['intranet.example', 'nxdomain.example'], lookup=lookup)
+    assert(len(calls) == 4)
+
+
+def test_resolve_many_timeout():
+    ooni_utils.dns_negative_cache.clear()
+    lookup, calls = stub_resolver({'slow.example': ['35.163.72.93']}, delay=0.5)
+    ips = ooni_utils.resolve_many(['slow.example'], lookup=lookup, timeout=0.05)
+    assert(ips == {'slow.example': None})
+    # timeouts aren't cached
+    ooni_utils.resolve_many(['slow.example'], lookup=lookup, timeout=0.05)
+    assert(len(calls) == 2)
+
+
+def test_resolve_many_timeout_threads(monkeypatch):
+    ooni_utils.dns_negative_cache.clear()
+
+    def getaddrinfo(hostname, *args):
+        if hostname == 'slow.example':
+            time.sleep(0.3)
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('35.163.72.93', 0))]
+    monkeypatch.setattr(ooni_utils.socket, 'getaddrinfo', getaddrinfo)
+    threads = threading.active_count()
+    ips = ooni_utils.resolve_many(['slow.example', 'fast.example'], concurrency=1, timeout=0.1)
+    # a lookup queued behind one that timed out still gets its whole timeout
+    assert(ips == {'slow.example': None, 'fast.example': '35.163.72.93'})
+    # and no lookup threads are left behind
+    assert(threading.active_count() == threads)
+
+
+def test_resolve_many_concurrency():
+    in_flight = []
+    most_in_flight = []
+
+    async def lookup(hostname):
+        in_flight.append(hostname)
+        most_in_flight.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(hostname)
+        return ['35.163.72.93']
+    hostnames = [f'{i}.example' for i in range(20)]
+    ips = ooni_utils.resolve_many(hostnames, lookup=lookup, concurrency=3)
+    assert(len(ips) == 20)
+    assert(max(most_in_flight) == 3)
+
+
 def test_ip_to_alpha2():
     US_ip = '35.163.72.93'
     NL_ip = '212.78.221.95'
@@ -60,11 +145,23 @@ def test_ip_to_alpha2():
     assert(str(alpha2) == 'NL')
 
 
+def test_ips_to_alpha2():
+    US_ip = '35.163.72.93'
+    NL_ip = '212.78.221.95'
+    alpha2s = ooni_utils.ips_to_alpha2([US_ip, NL_ip, US_ip])
+    assert([str(a) for a in alpha2s] == ['US', 'NL', 'US'])
+    # the reader is opened once and reused
+    assert(ooni_utils.get_geoip_reader() is ooni_utils.get_geoip_reader())
+
+
 def test_IPHostnameMapping():
     my_ip = '198.35.26.96'
     t = shared_utils.now()
     # no error here
-    ooni_types.IPHostnameMapping(my_ip, 'wikipedia.org', t)
+    mapping = ooni_types.IPHostnameMapping(my_ip, 'wikipedia.org', t)
+    # a record without a `__dict__`
+    with pytest.raises(AttributeError):
+        mapping.extra = 'field'
     with pytest.raises(Exception):
         # error here
         ooni_types.IPHostnameMapping('xxx.xxx.xxx', 'wikipedia.org', t)
@@ -98,6 +195,22 @@ def test_cache_expiry(postgresdb):
     assert(ip is None)
 
 
+def test_ip_cache(postgresdb):
+    cur, conn = postgresdb
+    t = shared_utils.now()
+    ooni_types.IPHostnameMapping('212.78.221.95', 'website.nl', t).write_to_db(cur, conn)
+    ooni_types.IPHostnameMapping('35.163.72.93', 'website.us', t - timedelta(days=3)).write_to_db(cur, conn)
+    ooni_utils.prefetch_ips(cur, ['website.nl', 'website.us', 'website.nl'])
+    # the fresh IP comes from memory
+    assert(ooni_utils.ip_cache.get('website.nl') == '212.78.221.95')
+    # the stale one is marked, so we don't query the database for it again
+    assert(ooni_utils.ip_cache.get('website.us') == ooni_utils.NOT_IN_DB)
+    # once cached, lookups don't need the database at all
+    conn.close()
+    assert(ooni_utils.lookup_ip(cur, conn, 'website.nl') == '212.78.221.95')
+    assert(ooni_utils.ip_cache.stats()['hits'] == 3)
+
+
 def test_url_to_alpha2(postgresdb):
     # lookup ip when cache IS NOT VALID
     cur, conn = postgresdb
@@ -133,6 +246,71 @@ def test_is_in_future():
     assert(shared_utils.is_in_future(future) is True)
     past = shared_utils.now() - timedelta(days=5)
     assert(shared_utils.is_in_future(past) is False)
+    # compared to another time
+    assert(shared_utils.is_in_future(past, past - timedelta(days=1)) is True)
+
+
+def test_from_rows():
+    now = pd.Timestamp('2021-06-02 00:00:00+00:00')
+
+    def args(report_id, time):
+        return ('dns', shared_types.Alpha2('RU'), 'https://government.nl/', True, False, report_id,
+                shared_types.Alpha2('NL'), None, time)
+    tests = ooni_types.OONIWebConnectivityTest.from_rows([
+        args('report-1', pd.Timestamp('2021-06-01 12:00:00+00:00')),
+        args('report-2', pd.Timestamp('2021-06-03 00:00:00+00:00')),
+    ], now=now)
+    assert(tests[0].to_row() == ('dns', 'RU', 'https://government.nl/', True, False, 'report-1', 'NL', None,
+                                 pd.Timestamp('2021-06-01 12:00:00+00:00')))
+    # times after `now` become `now`
+    assert(tests[1].measurement_start_time == now)
+    # a record without a `__dict__`
+    with pytest.raises(AttributeError):
+        tests[0].extra = 'field'
+    with pytest.raises(AssertionError):
+        ooni_types.OONIWebConnectivityTest.from_rows([args('', now)])
+
+
+def test_validate_batch():
+    now = pd.Timestamp('2021-06-02 00:00:00+00:00')
+    t = pd.Timestamp('2021-06-01 12:00:00+00:00')
+
+    def row(report_id, **kwargs):
+        fields = dict(zip(ooni_types.OONIWebConnectivityTest.columns, (
+            'dns', 'RU', 'https://government.nl/', True, False, report_id, 'NL', None, t)))
+        return {**fields, **kwargs}
+    df = pd.DataFrame([
+        row('report-1'),
+        row('report-2', blocking_type=False),
+        row('report-3', probe_alpha2='RUS', anomaly='yes'),
+        row('report-4', confirmed=None),
+        row('report-5', measurement_start_time=pd.Timestamp('2021-06-03 00:00:00+00:00')),
+        row('', input_ip_alpha2=None),
+    ])
+    accepted, rejected = ooni_types.OONIWebConnectivityTest.validate_batch(df, now=now)
+    assert(accepted['report_id'].tolist() == ['report-1', 'report-5'])
+    assert(rejected['reason'].tolist() == ['blocking_type is False', "probe_alpha2 isn't an alpha2",
+                                           "confirmed isn't a bool", "report_id isn't a non-empty string"])
+    # the same tests as validating them one at a time
+    frame = ooni_types.OONIWebConnectivityTestFrame(accepted)
+    tests = ooni_types.OONIWebConnectivityTest.from_rows([
+        ('dns', shared_types.Alpha2('RU'), 'https://government.nl/', True, False, report_id,
+         shared_types.Alpha2('NL'), None, time)
+        for report_id, time in [('report-1', t), ('report-5', pd.Timestamp('2021-06-03 00:00:00+00:00'))]
+    ], now=now)
+    assert(list(frame.rows()) == [test.to_row() for test in tests])
+
+    mappings = pd.DataFrame({'hostname': ['wikipedia.org', 'example.com', ''],
+                             'ip': ['198.35.26.96', '10.0.0.1', '198.35.26.96'], 'time': [t] * 3})
+    accepted, rejected = ooni_types.IPHostnameMapping.validate_batch(mappings)
+    assert(accepted['hostname'].tolist() == ['wikipedia.org'])
+    assert(rejected['reason'].tolist() == ["ip isn't a public IP", "hostname isn't a non-empty string"])
+
+    checkpoints = pd.DataFrame({'window_start': [t, t, t], 'window_end': [now, t, now],
+                                'measurements': [3, 3, -1], 'completed_at': [now] * 3})
+    accepted, rejected = ooni_types.OONIBackfillCheckpoint.validate_batch(checkpoints)
+    assert(accepted.index.tolist() == [0])
+    assert(rejected['reason'].tolist() == ["window_start isn't before window_end", "measurements isn't a count"])
 
 
 def test_get_latest_reading_time(postgresdb):
@@ -152,3 +330,366 @@ def test_get_latest_reading_time(postgresdb):
     dummy.write_to_db(cur, conn)
     most_recent_reading = ooni_utils.get_latest_reading_time(cur)
     assert(most_recent_reading == my_time)
+
+
+def test_write_to_db_advances_watermark(postgresdb):
+    cur, conn = postgresdb
+    assert(ooni_utils.get_latest_reading_time(cur) is None)
+    ooni_utils.write_to_db(cur, conn, [connectivity_test('report-1')])
+    assert(ooni_utils.get_latest_reading_time(cur) == pd.Timestamp('2021-06-01 12:00:00+00:00'))
+    # it comes from the watermark, not the table
+    cur.execute('TRUNCATE ooni_web_connectivity_test')
+    conn.commit()
+    assert(ooni_utils.get_latest_reading_time(cur) == pd.Timestamp('2021-06-01 12:00:00+00:00'))
+    # nothing written, nothing moved
+    ooni_utils.write_to_db(cur, conn, [])
+    assert(ooni_utils.get_latest_reading_time(cur) == pd.Timestamp('2021-06-01 12:00:00+00:00'))
+
+
+def test_connection_pool():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        pool = ooni_utils.get_connection_pool(postgresql.dsn())
+        # the same process gets the same, long-lived pool
+        assert(ooni_utils.get_connection_pool(postgresql.dsn()) is pool)
+        pool.close()
+    finally:
+        postgresql.stop()
+
+
+def test_ingest_api_measurements():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        ooni_types.migrate(cur, conn)
+        ooni_utils.ip_cache.clear()
+        ooni_types.IPHostnameMapping('212.78.221.95', 'government.nl', shared_utils.now()).write_to_db(cur, conn)
+        measurement = {
+            'probe_cc': 'RU',
+            'input': 'https://government.nl/',
+            'anomaly': True,
+            'confirmed': False,
+            'report_id': 'example',
+            'measurement_start_time': '2021-06-01T00:00:00Z',
+            'scores': {'analysis': {'blocking_type': 'dns'}},
+        }
+        timer = shared_utils.StageTimer()
+        # malformed measurements are left out, without losing the rest
+        malformed = [{k: v for k, v in measurement.items() if k != 'input'},
+                     {**measurement, 'probe_cc': None},
+                     {**measurement, 'measurement_start_time': 'yesterday'}]
+        # (a URL we can't get a hostname from is kept, without its jurisdictions)
+        unresolvable = {**measurement, 'input': 'https://government.nl:port/'}
+        ingested = ooni_utils.ingest_api_measurements([measurement] * 3 + malformed + [unresolvable],
+                                                      postgresql.dsn(), chunk_size=2, timer=timer)
+        assert(len(ingested) == 4)
+        assert(list(timer.seconds.keys()) == ['resolve', 'marshall'])
+        *ingested, last = ingested
+        assert((last.input_ip_alpha2, last.tld_jurisdiction_alpha2) == (None, None))
+        for t in ingested:
+            assert(t.probe_alpha2 == 'RU')
+            assert(t.input_ip_alpha2 == 'NL')
+            assert(t.tld_jurisdiction_alpha2 == 'NL')
+            assert(t.blocking_type == 'dns')
+    finally:
+        postgresql.stop()
+
+
+class StubSession():
+    '''Stands in for `requests.Session`, serving canned API pages.'''
+    def __init__(self, pages: dict):
+        self.pages = pages
+        self.queries = []
+
+    def get(self, url, **kwargs):
+        query = url.split('api/v1/')[1]
+        self.queries.append(query)
+        page = self.pages[query]
+        if isinstance(page, Exception):
+            raise page
+
+        class Response():
+            status_code = 200
+            headers: dict = {}
+            content = json.dumps(page).encode()
+            encoding = 'utf-8'
+
+            def raise_for_status(self):
+                pass
+        return Response()
+
+
+def test_iter_api_pages(monkeypatch):
+    monkeypatch.setattr(ooni_utils, 'OONI_SLEEP_PAGINATE', 0)
+    session = StubSession({
+        'q': {'results': [1, 2], 'metadata': {'next_url': 'https://api.ooni.io/api/v1/q?offset=2'}},
+        'q?offset=2': {'results': [3, 4], 'metadata': {'next_url': 'https://api.ooni.io/api/v1/q?offset=4'}},
+        'q?offset=4': {'results': [5], 'metadata': {'next_url': None}},
+    })
+    pages = list(ooni_utils.iter_api_pages('q', session=session))
+    assert(pages == [[1, 2], [3, 4], [5]])
+    # stops after `max_queries` pages
+    pages = list(ooni_utils.iter_api_pages('q', max_queries=2, session=session))
+    assert(pages == [[1, 2], [3, 4]])
+    # on an error, we keep what we have
+    session.pages['q?offset=4'] = ValueError('bad JSON')
+    assert(ooni_utils.api_query('q', session=session) == [1, 2, 3, 4])
+
+
+def test_backfill_windows():
+    since = pd.Timestamp('2021-06-01 00:00:00+00:00')
+    until = pd.Timestamp('2021-06-01 15:00:00+00:00')
+    windows = ooni_utils.backfill_windows(since, until, timedelta(hours=6))
+    assert(len(windows) == 3)
+    assert(windows[0] == (since, since + timedelta(hours=6)))
+    # the last window is cut short
+    assert(windows[-1] == (since + timedelta(hours=12), until))
+    completed = [(since, since + timedelta(hours=12))]
+    assert([ooni_utils.is_backfilled(w, completed) for w in windows] == [True, True, False])
+    assert(ooni_utils.backfilled_through(windows, completed) == since + timedelta(hours=12))
+    assert(ooni_utils.backfilled_through(windows, completed[1:]) is None)
+
+
+def test_backfill(monkeypatch):
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        ooni_types.migrate(cur, conn)
+        ooni_utils.ip_cache.clear()
+        ooni_types.IPHostnameMapping('212.78.221.95', 'government.nl', shared_utils.now()).write_to_db(cur, conn)
+        queries = []
+
+        def iter_api_pages(query, **kwargs):
+            queries.append(query)
+            if len(queries) == 2:
+                raise ValueError('API is down')
+            yield [{
+                'probe_cc': 'RU',
+                'input': 'https://government.nl/',
+                'anomaly': True,
+                'confirmed': False,
+                'report_id': f'report-{len(queries)}',
+                'measurement_start_time': '2021-06-01T00:00:00Z',
+            }]
+        monkeypatch.setattr(ooni_utils, 'iter_api_pages', iter_api_pages)
+        since = pd.Timestamp('2021-06-01 00:00:00+00:00')
+        until = pd.Timestamp('2021-06-02 00:00:00+00:00')
+        ooni_collect.backfill(postgresql.dsn(), since, until, window=timedelta(hours=6), workers=1)
+        # one of four windows failed, so it wasn't written or checkpointed
+        cur.execute('SELECT count(*) from ooni_web_connectivity_test')
+        assert(cur.fetchone()[0] == 3)
+        assert(len(ooni_utils.completed_backfill_windows(cur, since, until)) == 3)
+        # so incremental collection resumes from the gap, not after the windows that came later
+        assert(ooni_utils.get_latest_reading_time(cur) == since + timedelta(hours=6))
+        # running it again only fetches the missing window
+        ooni_collect.backfill(postgresql.dsn(), since, until, window=timedelta(hours=6), workers=1)
+        assert(len(queries) == 5)
+        assert(len(ooni_utils.completed_backfill_windows(cur, since, until)) == 4)
+        assert(ooni_utils.get_latest_reading_time(cur) == until)
+        # a backfill that starts after the watermark leaves a gap, so doesn't move it
+        later = until + timedelta(days=1)
+        ooni_collect.backfill(postgresql.dsn(), later, later + timedelta(hours=6), window=timedelta(hours=6), workers=1)
+        assert(ooni_utils.get_latest_reading_time(cur) == until)
+    finally:
+        postgresql.stop()
+
+
+def test_jobs_need_migrations():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        # the shared tables are up to date, but the OONI ones aren't there
+        shared_types.migrate(cur, conn)
+        since = pd.Timestamp('2021-06-01 00:00:00+00:00')
+        with pytest.raises(schema.SchemaOutOfDate):
+            ooni_collect.backfill(postgresql.dsn(), since, since + timedelta(hours=6))
+        with pytest.raises(schema.SchemaOutOfDate):
+            ooni_collect.collect(postgresql.dsn())
+        # and neither made them
+        cur.execute("SELECT to_regclass('ooni_backfill_checkpoint')")
+        assert(cur.fetchone()[0] is None)
+    finally:
+        postgresql.stop()
+
+
+def connectivity_test(report_id: str, blocking_type='dns', input_ip_alpha2=shared_types.Alpha2('NL')):
+    return ooni_types.OONIWebConnectivityTest(
+        blocking_type,
+        shared_types.Alpha2('RU'),
+        'https://government.nl/',
+        True,
+        False,
+        report_id,
+        input_ip_alpha2,
+        shared_types.Alpha2('NL'),
+        pd.Timestamp('2021-06-01 12:00:00+00:00'))
+
+
+@pytest.mark.parametrize('method', ['copy', 'values'])
+def test_write_many(postgresdb, method):
+    cur, conn = postgresdb
+    tests = [
+        connectivity_test('report, "quoted"'),
+        connectivity_test('report-2', None, None),
+    ]
+    ooni_types.OONIWebConnectivityTest.write_many(cur, tests, method=method)
+    conn.commit()
+    cur.execute('SELECT blocking_type, report_id, input_ip_alpha2, measurement_start_time ' +
+                'from ooni_web_connectivity_test ORDER BY blocking_type')
+    rows = cur.fetchall()
+    assert(rows[0][:3] == ('dns', 'report, "quoted"', 'NL'))
+    assert(rows[0][3] == pd.Timestamp('2021-06-01 12:00:00+00:00'))
+    # None becomes NULL
+    assert(rows[1][:3] == (None, 'report-2', None))
+
+
+@pytest.mark.parametrize('method', ['copy', 'values'])
+def test_connectivity_test_frame(postgresdb, method):
+    cur, conn = postgresdb
+    tests = [
+        connectivity_test('report, "quoted"'),
+        connectivity_test('report-2', None, None),
+    ]
+    frame = ooni_types.OONIWebConnectivityTestFrame.from_tests(tests)
+    assert(len(frame) == 2)
+    assert(frame.newest() == pd.Timestamp('2021-06-01 12:00:00+00:00'))
+    assert([t.report_id for t in frame] == ['report, "quoted"', 'report-2'])
+    # the same rows as the tests
+    assert(list(frame.rows()) == [t.to_row() for t in tests])
+    frame.write_many(cur, method=method)
+    conn.commit()
+    cur.execute('SELECT blocking_type, report_id, input_ip_alpha2 from ooni_web_connectivity_test ORDER BY blocking_type')
+    assert(cur.fetchall() == [('dns', 'report, "quoted"', 'NL'), (None, 'report-2', None)])
+    empty = ooni_types.OONIWebConnectivityTestFrame.concat([])
+    assert(len(empty) == 0)
+    assert(empty.newest() is None)
+    with pytest.raises(AssertionError):
+        ooni_types.OONIWebConnectivityTestFrame(frame.df.drop(columns=['report_id']))
+
+
+@pytest.mark.parametrize('executor', ooni_utils.ooni_executors)
+def test_marshall_chunks(executor, monkeypatch):
+    resolution = ooni_utils.HostnameResolution('212.78.221.95', shared_types.Alpha2('NL'), None)
+    measurements = [{
+        'probe_cc': 'RU',
+        'input': 'https://government.nl/',
+        'anomaly': True,
+        'confirmed': False,
+        'report_id': f'report-{i}',
+        'measurement_start_time': '2021-06-01T00:00:00Z',
+        'scores': {'analysis': {'blocking_type': 'dns'}},
+    } for i in range(10)]
+    chunks = [[(m, resolution) for m in measurements[i:i + 3]] for i in range(0, 10, 3)]
+    marshalled = ooni_utils.marshall_chunks(chunks, executor, workers=2)
+    assert([len(frame) for frame, _ in marshalled] == [3, 3, 3, 1])
+    assert(all(rejected.empty for _, rejected in marshalled))
+    tests = ooni_types.OONIWebConnectivityTestFrame.concat([frame for frame, _ in marshalled])
+    # in order
+    assert([t.report_id for t in tests] == [f'report-{i}' for i in range(10)])
+    assert(list(tests.rows())[0] == ('dns', 'RU', 'https://government.nl/', True, False, 'report-0', 'NL', None,
+                                     pd.Timestamp('2021-06-01 00:00:00+00:00')))
+    with pytest.raises(ValueError):
+        ooni_utils.marshall_chunks(chunks, 'fibers', workers=2)
+    # by default, how they're marshalled comes from the config, when they are
+    monkeypatch.setitem(ooni_utils.config, 'ooni_executor', executor)
+    monkeypatch.setitem(ooni_utils.config, 'ooni_workers', 2)
+    assert([len(frame) for frame, _ in ooni_utils.marshall_chunks(chunks)] == [3, 3, 3, 1])
+    monkeypatch.setitem(ooni_utils.config, 'ooni_executor', 'fibers')
+    with pytest.raises(ValueError):
+        ooni_utils.marshall_chunks(chunks)
+
+
+@pytest.mark.parametrize('method', ['copy', 'values'])
+def test_write_many_skips_duplicates(postgresdb, method):
+    cur, conn = postgresdb
+    connectivity_test('report-1').write_to_db(cur, conn)
+    # writing the same test again does nothing
+    connectivity_test('report-1').write_to_db(cur, conn)
+    tests = [connectivity_test('report-1'), connectivity_test('report-2'), connectivity_test('report-2')]
+    ooni_types.OONIWebConnectivityTest.write_many(cur, tests, method=method)
+    # including in the same transaction
+    ooni_types.OONIWebConnectivityTest.write_many(cur, tests, method=method)
+    conn.commit()
+    cur.execute('SELECT report_id from ooni_web_connectivity_test ORDER BY report_id')
+    assert(cur.fetchall() == [('report-1',), ('report-2',)])
+
+
+def test_add_natural_key(postgresdb):
+    cur, conn = postgresdb
+    # a table from before the natural key
+    cur.execute('ALTER TABLE ooni_web_connectivity_test DROP CONSTRAINT ooni_web_connectivity_test_natural_key')
+    conn.commit()
+    for report_id in ['report-1', 'report-1', 'report-1', 'report-2']:
+        connectivity_test(report_id).write_to_db(cur, conn)
+    ooni_types.add_natural_key(cur)
+    conn.commit()
+    cur.execute('SELECT report_id from ooni_web_connectivity_test ORDER BY report_id')
+    assert(cur.fetchall() == [('report-1',), ('report-2',)])
+    connectivity_test('report-2').write_to_db(cur, conn)
+    cur.execute('SELECT count(*) from ooni_web_connectivity_test')
+    assert(cur.fetchone()[0] == 2)
+    # running it again is fine
+    ooni_types.add_natural_key(cur)
+    conn.commit()
+
+
+def test_migrate():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        # a database from before `schema_version`, with duplicates in it
+        ooni_types.create_base_tables(cur)
+        conn.commit()
+        for report_id in ['report-1', 'report-1']:
+            connectivity_test(report_id).write_to_db(cur, conn)
+        assert(ooni_types.migrate(cur, conn) == [1, 2, 3, 4, 5])
+        cur.execute('SELECT count(*) from ooni_web_connectivity_test')
+        assert(cur.fetchone()[0] == 1)
+        cur.execute("SELECT version FROM schema_version WHERE component = 'ooni' ORDER BY version")
+        assert(cur.fetchall() == [(1,), (2,), (3,), (4,), (5,)])
+        # the watermark starts at the newest measurement
+        watermark = shared_types.IngestionWatermark.read(cur, 'ooni')
+        assert(watermark.watermark == pd.Timestamp('2021-06-01 12:00:00+00:00'))
+        # nothing left to do
+        assert(ooni_types.migrate(cur, conn) == [])
+    finally:
+        postgresql.stop()
+
+
+def test_ddl_matches_migrations(postgresdb):
+    cur, conn = postgresdb
+    cur.execute('CREATE SCHEMA from_ddl; SET search_path TO from_ddl')
+    for table, ddl in [('ip_hostname_mapping', ooni_types.IPHostnameMapping.ddl),
+                       ('ooni_web_connectivity_test', ooni_types.OONIWebConnectivityTest.ddl),
+                       ('ooni_backfill_checkpoint', ooni_types.OONIBackfillCheckpoint.ddl)]:
+        cur.execute(ddl)
+        assert(schema.table_layout(cur, table, 'from_ddl') == schema.table_layout(cur, table))
+
+
+def test_partition_tables(postgresdb):
+    cur, conn = postgresdb
+    connectivity_test('report-1').write_to_db(cur, conn)
+    ooni_types.partition_tables(cur, conn)
+    cur.execute("SELECT relkind FROM pg_class WHERE relname = 'ooni_web_connectivity_test'")
+    assert(cur.fetchone()[0] == 'p')
+    # rows come along, into their month
+    cur.execute('SELECT report_id from ooni_web_connectivity_test_2021_06')
+    assert(cur.fetchall() == [('report-1',)])
+    # natural key still holds
+    ooni_types.OONIWebConnectivityTest.write_many(cur, [connectivity_test('report-1'), connectivity_test('report-2')])
+    conn.commit()
+    cur.execute('SELECT count(*) from ooni_web_connectivity_test')
+    assert(cur.fetchone()[0] == 2)
+    assert(ooni_utils.get_latest_reading_time(cur) == pd.Timestamp('2021-06-01 12:00:00+00:00'))
+    # running migrations again is fine
+    ooni_types.add_natural_key(cur)
+    ooni_types.partition_tables(cur, conn)
+    cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'ooni_web_connectivity_test'")
+    assert(set(cur.fetchall()) == {
+        ('ooni_web_connectivity_test_natural_key',),
+        ('ooni_web_connectivity_test_time',),
+    })
@@ -1,9 +1,18 @@
 import pytest
+import time
 import pytz
+import os
+import requests
+import pandas as pd
+import psycopg2
+import testing.postgresql
 from datetime import datetime
+from datetime import timedelta
 
 import src.shared.utils as shared_utils
 import src.shared.types as shared_types
+import src.shared.schema as schema
+import src.shared.http_cache as http_cache
 
 
 def test_is_nonempty_str():
@@ -31,3 +40,246 @@ def test_to_utc():
     t = tz.localize(datetime(2021, 5, 27, 21, 40, 17, 486566))
     t_utc = shared_utils.to_utc(t)
     assert(t_utc.hour == 4)
+
+
+def test_connection_pool():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        pool = shared_utils.ConnectionPool(postgresql.dsn(), maxconn=2)
+        for _ in range(5):
+            with pool.connection() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT 1')
+                assert(cur.fetchone()[0] == 1)
+        stats = pool.stats()
+        # one connection, reused for every checkout after the first
+        assert(stats == {'connections_opened': 1, 'checkouts': 5, 'reuses': 4})
+        pool.close()
+    finally:
+        postgresql.stop()
+
+
+def test_migrate():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+
+        def broken(cur):
+            cur.execute('CREATE TABLE half_done (x INTEGER)')
+            raise ValueError('oops')
+
+        migrations = [
+            schema.Migration(1, 'create foo', lambda cur: cur.execute('CREATE TABLE foo (x INTEGER)')),
+            schema.Migration(2, 'index foo', lambda cur: cur.execute('CREATE INDEX foo_x ON foo (x)')),
+        ]
+        assert(schema.migrate(cur, conn, 'test', migrations) == [1, 2])
+        assert(schema.migrate(cur, conn, 'test', migrations) == [])
+        assert(schema.schema_version(cur, 'test') == 2)
+        assert(schema.schema_version(cur, 'other') == 0)
+        schema.check_schema_version(cur, 'test', migrations)
+        with pytest.raises(schema.SchemaOutOfDate):
+            schema.check_schema_version(cur, 'other', migrations)
+        # a failed migration leaves nothing behind
+        with pytest.raises(ValueError):
+            schema.migrate(cur, conn, 'test', migrations + [schema.Migration(3, 'broken', broken)])
+        assert(schema.schema_version(cur, 'test') == 2)
+        cur.execute("SELECT to_regclass('half_done')")
+        assert(cur.fetchone()[0] is None)
+    finally:
+        postgresql.stop()
+
+
+def test_ddl_matches_migrations():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        # without a schema_version table, nothing's been migrated
+        with pytest.raises(schema.SchemaOutOfDate):
+            shared_types.check_schema(cur)
+        shared_types.migrate(cur, conn)
+        shared_types.check_schema(cur)
+        cur.execute('CREATE SCHEMA from_ddl; SET search_path TO from_ddl')
+        cur.execute(shared_types.IngestionWatermark.ddl)
+        assert(schema.table_layout(cur, 'ingestion_watermark', 'from_ddl') ==
+               schema.table_layout(cur, 'ingestion_watermark'))
+    finally:
+        postgresql.stop()
+
+
+def test_read_frame():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        cur.execute('CREATE TABLE foo (alpha2 VARCHAR, share NUMERIC)')
+        shared_utils.write_rows(cur, 'foo', ['alpha2', 'share'], [('NA', 0.5), (None, 0.25), ('NL', None)])
+        df = shared_utils.read_frame(cur, 'SELECT alpha2, share FROM foo WHERE share > %s OR share IS NULL', (0.3,))
+        assert(list(df.columns) == ['alpha2', 'share'])
+        # Namibia isn't a missing value
+        assert(df['alpha2'].tolist() == ['NA', 'NL'])
+        assert(df['share'].isna().tolist() == [False, True])
+    finally:
+        postgresql.stop()
+
+
+def test_ingestion_watermark():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        assert(shared_types.migrate(cur, conn) == [1])
+        assert(shared_types.IngestionWatermark.read(cur, 'test') is None)
+        t = pd.Timestamp('2021-06-01 12:00:00+00:00')
+        shared_types.IngestionWatermark('test', t, t).write_to_db(cur, conn)
+        # watermarks never go back, but the update time does move
+        later = t + pd.Timedelta(hours=1)
+        shared_types.IngestionWatermark('test', t - pd.Timedelta(days=1), later).write_to_db(cur, conn)
+        watermark = shared_types.IngestionWatermark.read(cur, 'test')
+        assert(watermark.watermark == t)
+        assert(watermark.updated_at == later)
+    finally:
+        postgresql.stop()
+
+
+def test_validate_batch():
+    t = pd.Timestamp('2021-06-01 12:00:00+00:00')
+    df = pd.DataFrame({
+        'collector': ['ooni', '', None, 'w3techs'],
+        'watermark': [t, t, 'yesterday', t],
+        'updated_at': [t, t, t, None],
+    })
+    accepted, rejected = shared_types.IngestionWatermark.validate_batch(df)
+    assert(accepted['collector'].tolist() == ['ooni'])
+    # each rejected row keeps its place in the batch, and the first rule it broke
+    assert(rejected.index.tolist() == [1, 2, 3])
+    assert(rejected['reason'].tolist() == ["collector isn't a non-empty string",
+                                           "collector isn't a non-empty string",
+                                           "updated_at isn't a time"])
+    assert(shared_types.describe_rejected(rejected) ==
+           "2 (collector isn't a non-empty string), 1 (updated_at isn't a time)")
+    # the same rules as one at a time
+    for _, row in accepted.iterrows():
+        shared_types.IngestionWatermark(*row)
+    accepted, rejected = shared_types.Alpha2.validate_batch(pd.DataFrame({'country_code': ['NL', 'NLD', 'NA']}))
+    assert(accepted['country_code'].tolist() == ['NL', 'NA'])
+    assert(rejected['country_code'].tolist() == ['NLD'])
+    with pytest.raises(AssertionError):
+        shared_types.Alpha2.validate_batch(pd.DataFrame({'alpha2': ['NL']}))
+
+
+class VersionedSession():
+    '''Stands in for `requests.Session`: each URL has a body and a version (its ETag).'''
+    def __init__(self):
+        self.bodies: dict = {}
+        self.gets = 0
+
+    def get(self, url, headers=None, **kwargs):
+        self.gets += 1
+        body, etag = self.bodies[url]
+        resp = requests.Response()
+        resp.url = url
+        resp.encoding = 'utf-8'
+        if etag:
+            resp.headers['ETag'] = etag
+        if etag and (headers or {}).get('If-None-Match') == etag:
+            resp.status_code = 304
+            resp._content = b''
+        else:
+            resp.status_code = 200
+            resp._content = body
+        return resp
+
+
+def test_http_cache(tmp_path):
+    cache = http_cache.HTTPCache(str(tmp_path), max_bytes=4000)
+    session = VersionedSession()
+    session.bodies['http://a'] = (b'a' * 10000, '"1"')
+    first = cache.get(session, 'http://a')
+    assert(first.not_modified is False)
+    # stored compressed
+    assert(sum(f.stat().st_size for f in tmp_path.iterdir()) < 1000)
+    again = cache.get(session, 'http://a')
+    assert(again.not_modified is True)
+    assert(again.content == first.content)
+    assert(again.content_hash == first.content_hash)
+    # a new version is downloaded
+    session.bodies['http://a'] = (b'b' * 10000, '"2"')
+    changed = cache.get(session, 'http://a')
+    assert(changed.not_modified is False)
+    assert(changed.text == 'b' * 10000)
+    # replacing a response doesn't count the old one's bytes too
+    assert(cache._bytes == sum(f.stat().st_size for f in tmp_path.iterdir()))
+    # responses without validators aren't stored
+    session.bodies['http://b'] = (b'b', None)
+    cache.get(session, 'http://b')
+    assert(cache._load('http://b') is None)
+    # the least recently used responses are evicted
+    for i in range(5):
+        session.bodies[f'http://random/{i}'] = (os.urandom(1000), '"1"')
+        cache.get(session, f'http://random/{i}')
+        time.sleep(0.01)
+    assert(sum(f.stat().st_size for f in tmp_path.iterdir()) <= 4000)
+    assert(cache._load('http://a') is None)
+    assert(cache._load('http://random/4') is not None)
+
+
+def test_http_cache_evicted_before_304(tmp_path):
+    cache = http_cache.HTTPCache(str(tmp_path))
+    session = VersionedSession()
+    session.bodies['http://a'] = (b'a', '"1"')
+    cache.get(session, 'http://a')
+    get = session.get
+
+    def evict_then_get(url, headers=None, **kwargs):
+        # evicted between loading it and the server saying it's still current
+        for f in tmp_path.iterdir():
+            f.unlink()
+        return get(url, headers=headers, **kwargs)
+    session.get = evict_then_get  # type: ignore
+    again = cache.get(session, 'http://a')
+    # so it's fetched again, in full
+    assert(again.not_modified is False)
+    assert(again.content == b'a')
+    assert(session.gets == 3)
+
+
+def test_lru_cache():
+    cache = shared_utils.LRUCache(maxsize=2)
+    later = shared_utils.now() + timedelta(days=1)
+    cache.put('a', 1, later)
+    cache.put('b', 2, later)
+    assert(cache.get('a') == 1)
+    # 'b' is now least recently used, so it gets evicted
+    cache.put('c', 3, later)
+    assert(cache.get('b') is None)
+    assert(cache.get('c') == 3)
+    # expired entries are misses
+    cache.put('d', 4, shared_utils.now() - timedelta(seconds=1))
+    assert(cache.get('d', 'missing') == 'missing')
+    assert('d' not in cache)
+    assert(len(cache) == 1)
+    assert(cache.stats() == {'hits': 2, 'misses': 2, 'size': 1})
+
+
+def test_stage_timer():
+    timer = shared_utils.StageTimer()
+    for _ in range(2):
+        with timer.stage('sleep'):
+            time.sleep(0.05)
+    with pytest.raises(ValueError):
+        with timer.stage('fail'):
+            raise ValueError('oops')
+    assert(list(timer.seconds.keys()) == ['sleep', 'fail'])
+    assert(timer.seconds['sleep'] >= 0.1)
+    assert(str(timer).startswith('sleep 0.1'))
+
+
+def test_rate_limiter():
+    limiter = shared_utils.RateLimiter(0.05)
+    start = time.monotonic()
+    for _ in range(4):
+        limiter.wait()
+    # the first call goes right away; each one after waits its turn
+    assert(time.monotonic() - start >= 0.15)
@@ -1,15 +1,26 @@
 import src.w3techs.utils as utils
 import src.w3techs.types as types
 import src.shared.types as shared_types
+import src.shared.schema as schema
 import src.w3techs.collect as collect
+import src.shared.http_cache as http_cache
 
 import pandas as pd
+from os import path
 import numpy as np
+import threading
+import time
+import socketserver
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
 
 import psycopg2
 import testing.postgresql
 
 import pytest
+import hypothesis.extra.numpy as hnp
+import hypothesis.strategies as st
+from hypothesis import given
 
 
 @pytest.fixture(scope='function')
@@ -18,7 +29,7 @@ def postgresdb(request):
     postgresql = testing.postgresql.Postgresql()
     conn = psycopg2.connect(**postgresql.dsn())
     cur = conn.cursor()
-    types.create_tables(cur, conn)
+    types.migrate(cur, conn)
 
     def teardown():
         postgresql.stop()
@@ -56,6 +67,256 @@ def test_double_table():
     assert(len(df) == 12)
 
 
+def test_extract_marketshares(postgresdb):
+    cur, conn = postgresdb
+    html = read_html('./test/w3techs-html/ex-double-table.html')
+    df = utils.extract_table(html, True)
+    t = pd.Timestamp('2021-04-20')
+    marketshares = utils.extract_marketshares('ssl-certificate', t, df)
+    assert(len(marketshares) == 12)
+    # the same as extracting them one by one
+    one_by_one = [utils.extract_from_row('ssl-certificate', t, row).to_row() for _, row in df.iterrows()]
+    assert(list(marketshares.rows()) == one_by_one)
+    # in another measurement scope
+    top = utils.extract_marketshares('ssl-certificate', t, df, measurement_scope='top_1k')
+    assert(set(top.df['measurement_scope']) == {'top_1k'})
+    with pytest.raises(AssertionError):
+        utils.extract_marketshares('ssl-certificate', t, df, measurement_scope='top_5')
+
+    marketshares.write_many(cur)
+    conn.commit()
+    cur.execute('SELECT count(*) FROM provider_marketshare')
+    assert(cur.fetchone()[0] == 12)
+
+
+def test_provider_marketshare_frame_validates():
+    df = pd.DataFrame({
+        'name': ['Foo'], 'url': [None], 'jurisdiction_alpha2': ['NL'], 'measurement_scope': ['all'],
+        'market': ['ssl-certificate'], 'marketshare': [0.5], 'time': [pd.Timestamp('2021-04-20')],
+    })
+    assert(len(types.ProviderMarketshareFrame(df)) == 1)
+    for column, bad in [('name', ''), ('jurisdiction_alpha2', 'NLD'), ('measurement_scope', 'some'),
+                        ('marketshare', 1.5)]:
+        with pytest.raises(AssertionError):
+            types.ProviderMarketshareFrame(df.assign(**{column: [bad]}))
+
+
+def test_validate_batch():
+    t = pd.Timestamp('2021-04-20')
+    df = pd.DataFrame({
+        'name': ['Foo', '', 'Bar', 'Baz'], 'url': [None, None, 'https://bar.com', None],
+        'jurisdiction_alpha2': ['NL', 'NL', 'NLD', None], 'measurement_scope': ['all', 'all', 'all', 'top_1k'],
+        'market': ['ssl-certificate'] * 4, 'marketshare': [0.5, 0.1, 0.2, 0.3], 'time': [t] * 4,
+    })
+    accepted, rejected = types.ProviderMarketshare.validate_batch(df)
+    assert(accepted['name'].tolist() == ['Foo', 'Baz'])
+    assert(rejected['reason'].tolist() == ["name isn't a non-empty string", "jurisdiction_alpha2 isn't an alpha2"])
+    assert(len(types.ProviderMarketshareFrame(accepted)) == 2)
+    ginis = pd.DataFrame({'measurement_scope': ['all', 'some'], 'market': ['dns-server'] * 2,
+                          'gini': [0.9, 0.9], 'time': [t] * 2})
+    assert(types.PopWeightedGini.validate_batch(ginis).rejected['reason'].tolist() ==
+           ["measurement_scope isn't a measurement scope"])
+    pages = pd.DataFrame({'measurement_scope': ['all', 'all'], 'market': ['dns-server'] * 2,
+                          'content_hash': ['a' * 64, 'a' * 63], 'ingested_at': [t] * 2})
+    assert(types.W3TechsPage.validate_batch(pages).accepted.index.tolist() == [0])
+
+
+def test_floats_0_1():
+    t = pd.Timestamp('2021-04-20')
+    # each of these used to pass one of `is_float_0_1` and `are_floats_0_1`, but not the other
+    values = [0.5, np.float64(0.5), 1, '0.5', float('nan'), True, 1.5]
+    assert([types.is_float_0_1(v) for v in values] == [True, True, False, False, False, False, False])
+    assert(types.are_floats_0_1(pd.Series(values, dtype=object)).tolist() ==
+           [types.is_float_0_1(v) for v in values])
+    assert(types.are_floats_0_1(pd.Series([0.5, float('nan'), 1.5])).tolist() == [True, False, False])
+    # so a row is accepted one at a time if, and only if, it's accepted in a batch
+    df = pd.DataFrame({
+        'name': ['Foo'] * 3, 'url': [None] * 3, 'jurisdiction_alpha2': ['NL'] * 3, 'measurement_scope': ['all'] * 3,
+        'market': ['ssl-certificate'] * 3, 'marketshare': pd.Series([0.5, 1, '0.5'], dtype=object), 'time': [t] * 3,
+    })
+    accepted, rejected = types.ProviderMarketshare.validate_batch(df)
+    assert(accepted.index.tolist() == [0])
+    assert(rejected['reason'].tolist() == ["marketshare isn't between 0 and 1"] * 2)
+    for i, share in df['marketshare'].items():
+        args = ('Foo', None, shared_types.Alpha2('NL'), 'all', 'ssl-certificate', share, t)
+        if i in accepted.index:
+            types.ProviderMarketshare(*args)
+        else:
+            with pytest.raises(AssertionError):
+                types.ProviderMarketshare(*args)
+    ginis = pd.DataFrame({'measurement_scope': ['all'] * 2, 'market': ['dns-server'] * 2,
+                          'gini': [np.float64(0.9), float('nan')], 'time': [t] * 2})
+    assert(types.PopWeightedGini.validate_batch(ginis).accepted.index.tolist() == [0])
+    types.PopWeightedGini('all', 'dns-server', np.float64(0.9), t)
+    with pytest.raises(AssertionError):
+        types.PopWeightedGini('all', 'dns-server', float('nan'), t)
+
+
+def test_extract_marketshares_skips_bad_rows():
+    html = read_html('./test/w3techs-html/ex-double-table.html')
+    df = utils.extract_table(html, True)
+    df.loc[0, 'marketshare'] = 'n/a'
+    df.loc[1, 'marketshare'] = 1.5
+    marketshares = utils.extract_marketshares('ssl-certificate', pd.Timestamp('2021-04-20'), df)
+    # the rest of the table is still there
+    assert(len(marketshares) == 10)
+    assert(marketshares.df['name'].tolist() == df['name'].iloc[2:].map(str).tolist())
+
+
+# the pages saved in `w3techs-html`, and whether each has two tables:
+# the examples, and any saved page of one of `w3techs_sources` (`<source>.html`)
+saved_pages = {
+    'ex-single-table.html': False,
+    'ex-double-table.html': True,
+    **{f'{source}.html': w3techs.get('double_table', False)
+       for source, w3techs in collect.w3techs_sources.items()
+       if path.exists(f'./test/w3techs-html/{source}.html')},
+}
+
+
+@pytest.mark.parametrize('parser', utils.table_parsers.keys())
+@pytest.mark.parametrize('page', saved_pages.keys())
+def test_table_parsers(page, parser):
+    if parser == 'lxml':
+        pytest.importorskip('lxml')
+    html = read_html(f'./test/w3techs-html/{page}')
+    double_table = saved_pages[page]
+    expected = utils.extract_table_soup(html, double_table=double_table)
+    df = utils.extract_table(html, double_table=double_table, parser=parser)
+    pd.testing.assert_frame_equal(df, expected)
+
+
+class W3TechsHandler(BaseHTTPRequestHandler):
+    '''
+    Serves the saved pages in `w3techs-html`, slowly, with ETags.
+    `/flaky/<page>` fails the first time it's asked for.
+    '''
+    protocol_version = 'HTTP/1.1'
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+    requests: list = []
+    not_modified = 0
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.requests.append(self.path)
+            cls.active += 1
+            cls.max_active = max(cls.max_active, cls.active)
+        time.sleep(0.1)
+        with cls.lock:
+            cls.active -= 1
+        # the page named in the path (whatever its scope)
+        pth = './test/w3techs-html/' + next((p for p in self.path.split('/') if p.endswith('.html')), '')
+        etag = None
+        if self.path.startswith('/flaky/') and cls.requests.count(self.path) == 1:
+            status, body = 503, b''
+        elif path.exists(pth):
+            status, body = 200, open(pth, 'rb').read()
+            etag = f'"{hash(body)}"'
+            if self.headers.get('If-None-Match') == etag:
+                cls.not_modified += 1
+                status, body = 304, b''
+        else:
+            status, body = 404, b''
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    '''A thread per request (like `http.server.ThreadingHTTPServer`, which is new in Python 3.7).'''
+    daemon_threads = True
+
+
+@pytest.fixture(scope='function')
+def w3techs_server(request, tmp_path, monkeypatch):
+    W3TechsHandler.requests = []
+    W3TechsHandler.max_active = 0
+    W3TechsHandler.not_modified = 0
+    # a fresh HTTP cache
+    monkeypatch.setattr(http_cache, '_http_cache', http_cache.HTTPCache(str(tmp_path)))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), W3TechsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    request.addfinalizer(server.shutdown)
+    return f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def test_scrape_w3techs_tables(w3techs_server, monkeypatch):
+    monkeypatch.setattr(utils, 'W3TECHS_BACKOFF', 0)
+    sources = {
+        'single': {'url': f'{w3techs_server}/ex-single-table.html'},
+        'double': {'url': f'{w3techs_server}/ex-double-table.html', 'double_table': True},
+        'flaky': {'url': f'{w3techs_server}/flaky/ex-single-table.html'},
+        'missing': {'url': f'{w3techs_server}/missing.html'},
+    }
+    tables = {name: (page_hash, df) for name, page_hash, df in utils.scrape_w3techs_tables(sources, max_workers=2)}
+    # the missing page is skipped; the flaky one is retried
+    assert({name: len(df) for name, (_, df) in tables.items()} == {'single': 102, 'double': 12, 'flaky': 102})
+    assert(W3TechsHandler.requests.count('/flaky/ex-single-table.html') == 2)
+    assert(W3TechsHandler.max_active <= 2)
+    assert(W3TechsHandler.not_modified == 0)
+
+    # again: pages are revalidated rather than downloaded,
+    # and the ones we say we have already are skipped
+    unchanged = {'single': tables['single'][0], 'double': 'something else'}
+    again = {name: df for name, _, df in utils.scrape_w3techs_tables(sources, max_workers=2, unchanged=unchanged)}
+    assert(W3TechsHandler.not_modified == 3)
+    assert(set(again.keys()) == {'double', 'flaky'})
+    pd.testing.assert_frame_equal(again['double'], tables['double'][1])
+
+
+def test_unchanged_pages_are_skipped(postgresdb, w3techs_server, monkeypatch):
+    cur, conn = postgresdb
+    sources = {
+        'web-hosting': {'url': f'{w3techs_server}/ex-single-table.html'},
+        'ssl-certificate': {'url': f'{w3techs_server}/ex-double-table.html', 'double_table': True},
+    }
+    monkeypatch.setattr(collect, 'w3techs_sources', sources)
+    # (the test server serves the same page whatever its scope)
+    monkeypatch.setattr(collect, 'w3techs_scopes', {'all': '', 'top_1k': '/top1k'})
+    monkeypatch.setattr(collect, 'included_markets', ['web-hosting'])
+    db_config = {k: v for k, v in conn.get_dsn_parameters().items() if k in ['dbname', 'user', 'host', 'port']}
+    collect.collect(db_config)
+    cur.execute('SELECT measurement_scope, count(*) FROM provider_marketshare GROUP BY 1 ORDER BY 1')
+    assert(cur.fetchall() == [('all', 114), ('top_1k', 114)])
+    cur.execute('SELECT measurement_scope, market FROM w3techs_page ORDER BY 1, 2')
+    assert(cur.fetchall() == [('all', 'ssl-certificate'), ('all', 'web-hosting'),
+                              ('top_1k', 'ssl-certificate'), ('top_1k', 'web-hosting')])
+    # a gini for each scope
+    cur.execute('SELECT measurement_scope, market FROM pop_weighted_gini ORDER BY 1')
+    assert(cur.fetchall() == [('all', 'web-hosting'), ('top_1k', 'web-hosting')])
+    # nothing changed, so nothing more is written
+    collect.collect(db_config)
+    cur.execute('SELECT count(*) FROM provider_marketshare')
+    assert(cur.fetchone()[0] == 228)
+    # until it's been a while
+    cur.execute("UPDATE w3techs_page SET ingested_at = ingested_at - interval '1 day'")
+    conn.commit()
+    collect.collect(db_config)
+    cur.execute('SELECT count(*) FROM provider_marketshare')
+    assert(cur.fetchone()[0] == 456)
+
+
+def test_scoped_sources():
+    sources = {
+        'web-hosting': {'url': 'https://w3techs.com/technologies/overview/web_hosting'},
+        'proxy': {'url': 'https://w3techs.com/technologies/overview/proxy', 'double_table': True},
+    }
+    scoped = utils.scoped_sources(sources, {'all': '', 'top_1k': '/top1k'})
+    assert(len(scoped) == 4)
+    assert(scoped[('top_1k', 'proxy')] == {'url': 'https://w3techs.com/technologies/overview/proxy/top1k',
+                                           'double_table': True})
+    assert(scoped[('all', 'web-hosting')] == sources['web-hosting'])
+
+
 #
 #  types tests
 #
@@ -76,6 +337,89 @@ def test_provider_marketshare_type(postgresdb):
     cur.execute('SELECT * FROM provider_marketshare')
     item = cur.fetchone()
     assert(item[0] == 'Foo')
+    # a record without a `__dict__`
+    with pytest.raises(AttributeError):
+        ex_ms.extra = 'field'
+
+
+@pytest.mark.parametrize('method', ['copy', 'values'])
+def test_provider_marketshare_write_many(postgresdb, method):
+    cur, conn = postgresdb
+    rows = [
+        types.ProviderMarketshare(
+            'Foo', None, shared_types.Alpha2('NL'), 'all', 'ssl-certificate', 0.5, pd.Timestamp('2021-04-20')
+        ),
+        types.ProviderMarketshare(
+            'Bar, Inc.', 'https://bar.com', None, 'all', 'ssl-certificate', 0.25, pd.Timestamp('2021-04-20')
+        ),
+    ]
+    types.ProviderMarketshare.write_many(cur, rows, method=method)
+    conn.commit()
+
+    cur.execute('SELECT name, url, jurisdiction_alpha2, marketshare FROM provider_marketshare ORDER BY name')
+    items = cur.fetchall()
+    assert(items[0][:3] == ('Bar, Inc.', 'https://bar.com', None))
+    assert(float(items[0][3]) == 0.25)
+    assert(items[1][:3] == ('Foo', None, 'NL'))
+
+
+def test_jobs_need_migrations():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        # a database from before `w3techs_page`
+        schema.migrate(cur, conn, 'w3techs', types.migrations[:2])
+        with pytest.raises(schema.SchemaOutOfDate):
+            collect.collect(postgresql.dsn())
+        types.migrate(cur, conn)
+        types.check_schema(cur)
+    finally:
+        postgresql.stop()
+
+
+def test_add_page_scope():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        # a database from before scopes
+        schema.migrate(cur, conn, 'w3techs', types.migrations[:3])
+        cur.execute("INSERT INTO w3techs_page VALUES ('proxy', %s, now())", ('a' * 64,))
+        conn.commit()
+        assert(types.migrate(cur, conn) == [4])
+        assert(types.W3TechsPage.hashes_since(cur, pd.Timestamp('2021-01-01', tz='UTC')) == {('all', 'proxy'): 'a' * 64})
+        types.W3TechsPage('top_1k', 'proxy', 'b' * 64, pd.Timestamp.utcnow()).write_to_db(cur, conn)
+        types.W3TechsPage('all', 'proxy', 'c' * 64, pd.Timestamp.utcnow()).write_to_db(cur, conn)
+        assert(types.W3TechsPage.hashes_since(cur, pd.Timestamp('2021-01-01', tz='UTC')) ==
+               {('all', 'proxy'): 'c' * 64, ('top_1k', 'proxy'): 'b' * 64})
+    finally:
+        postgresql.stop()
+
+
+def test_ddl_matches_migrations(postgresdb):
+    cur, conn = postgresdb
+    cur.execute('CREATE SCHEMA from_ddl; SET search_path TO from_ddl')
+    for table, ddl in [('provider_marketshare', types.ProviderMarketshare.ddl),
+                       ('pop_weighted_gini', types.PopWeightedGini.ddl),
+                       ('w3techs_page', types.W3TechsPage.ddl)]:
+        cur.execute(ddl)
+        assert(schema.table_layout(cur, table, 'from_ddl') == schema.table_layout(cur, table))
+
+
+def test_partition_tables(postgresdb):
+    cur, conn = postgresdb
+    row = types.ProviderMarketshare(
+        'Foo', None, shared_types.Alpha2('NL'), 'all', 'ssl-certificate', 0.5, pd.Timestamp('2021-04-20')
+    )
+    row.write_to_db(cur, conn)
+    types.partition_tables(cur, conn)
+    cur.execute('SELECT name FROM provider_marketshare_2021_04')
+    assert(cur.fetchall() == [('Foo',)])
+    types.ProviderMarketshare.write_many(cur, [row])
+    conn.commit()
+    cur.execute('SELECT count(*) FROM provider_marketshare')
+    assert(cur.fetchone()[0] == 2)
 
 
 def test_pop_weighted_gini_type(postgresdb):
@@ -90,6 +434,9 @@ def test_pop_weighted_gini_type(postgresdb):
     cur.execute('SELECT * FROM pop_weighted_gini')
     item = cur.fetchone()
     assert(item[1] == 'ssl-certificate')
+    # a record without a `__dict__`
+    with pytest.raises(AttributeError):
+        ex_g.extra = 'field'
 
 #
 #  utils tests
@@ -104,6 +451,24 @@ def test_sum_proportions():
         assert(1 - tot < 0.02)
 
 
+def test_population_shares():
+    shares = utils.population_shares
+    assert(shares.first_year == 2015)
+    assert(shares.last_year == 2021)
+    columns = shares.columns(['NA', 'NL', 'XX'])
+    # (`NA` is Namibia)
+    assert(columns[0] >= 0 and columns[1] >= 0)
+    assert(columns[2] == -1)
+    # years we have no shares for use the nearest we do
+    assert(shares.year_rows([2014, 2015, 2021, 2023]).tolist() == [0, 0, 6, 6])
+    # the same weights as dividing by the year's column (with missing values as 0)
+    weighted = shares.weigh([0, 0, 1, 0], ['US', 'NL', 'US', 'XX'], [0.5, 0.25, 0.1, 0.9], [2019, 2024])
+    expected = pd.Series({'US': 0.5, 'NL': 0.25}).reindex(utils.prop_net_users.index) / utils.prop_net_users['2019']
+    assert(np.allclose(weighted[0], expected.fillna(0).values))
+    assert(weighted[1].sum() == weighted[1][shares.columns(['US'])[0]])
+    assert(np.isclose(weighted[1].sum(), 0.1 / utils.prop_net_users.loc['US', '2021']))
+
+
 def test_gini_fn():
     # when everyone has the same amount, gini should be 1
     assert(
@@ -153,11 +518,159 @@ def test_compute_pop_weighted_gini(postgresdb):
     # should result in a gini of 0.99
     assert(round(res.gini, 2) == 0.99)
 
+
+def reference_gini(array: np.array) -> float:
+    '''`gini` as we first wrote it (from https://github.com/oliviaguest/gini/).'''
+    array = np.array(array, dtype=float).flatten()
+    if np.amin(array) < 0:
+        array -= np.amin(array)
+    array += 0.0000001
+    array = np.sort(array)
+    index = np.arange(1, array.shape[0]+1)
+    n = array.shape[0]
+    return ((np.sum((2 * index - n - 1) * array)) / (n * np.sum(array)))
+
+
+def test_gini_rows():
+    matrix = np.array([[0.25, 0.25, 0.25, 0.25], [0, 0, 0, 1], [-1, 0.5, 2, 0]])
+    before = matrix.copy()
+    ginis = utils.gini_rows(matrix)
+    assert(np.allclose(ginis, [reference_gini(row) for row in matrix]))
+    # its input is left alone
+    assert((matrix == before).all())
+    array = np.array([0.5, -1, 2])
+    utils.gini(array)
+    assert((array == [0.5, -1, 2]).all())
+
+
+samples = hnp.arrays(
+    float,
+    hnp.array_shapes(min_dims=2, max_dims=2, min_side=1, max_side=20),
+    elements=st.floats(-1e3, 1e3, allow_nan=False))
+
+
+@given(samples)
+def test_gini_rows_matches_reference(matrix):
+    before = matrix.copy()
+    expected = [reference_gini(row) for row in matrix]
+    assert(np.allclose(utils.gini_rows(matrix), expected, rtol=1e-6, atol=1e-9))
+    assert(np.array_equal(matrix, before))
+    # sorted rows give the same ginis, with or without sorting them again
+    ranked = np.sort(matrix, axis=1)
+    assert(np.allclose(utils.gini_rows(ranked, presorted=True), expected, rtol=1e-6, atol=1e-9))
+    assert(np.allclose(utils.gini(matrix[0]), expected[0], rtol=1e-6, atol=1e-9))
+
+
+@given(samples)
+def test_gini_rows_properties(matrix):
+    ginis = utils.gini_rows(matrix)
+    # a row's gini doesn't depend on its order, or on the other rows
+    assert(np.allclose(ginis, utils.gini_rows(matrix[:, ::-1])))
+    assert(np.allclose(ginis[::-1], utils.gini_rows(matrix[::-1])))
+    # and it's between 0 and 1
+    assert(((ginis > -1e-9) & (ginis < 1)).all())
+
+
+def write_history(cur, conn):
+    '''Three days of marketshares in two markets, scraped at 09:00 (UTC) each day.'''
+    days = pd.date_range('2021-04-19 09:00:00+00:00', periods=3, freq='D')
+    for i, t in enumerate(days):
+        rows = [
+            ('web-hosting', 'Foo', 'NL', 0.1 * (i + 1)),
+            ('web-hosting', 'Baz', 'DE', 0.2),
+            ('web-hosting', 'Qux', None, 0.4),
+            ('ssl-certificate', 'Foo', 'NL', 0.5),
+            ('ssl-certificate', 'Bar', 'US', 0.1 * (i + 2)),
+        ]
+        for market, name, alpha2, share in rows:
+            juris = None if alpha2 is None else shared_types.Alpha2(alpha2)
+            types.ProviderMarketshare(name, None, juris, 'all', market, share, t).write_to_db(cur, conn)
+    # a second scrape on the last day, less than 24 hours after the one before
+    t = pd.Timestamp('2021-04-21 08:00:00+00:00')
+    types.ProviderMarketshare('Foo', None, shared_types.Alpha2('NL'), 'all', 'web-hosting', 0.9, t).write_to_db(cur, conn)
+    return days
+
+
+def test_population_weighted_ginis(postgresdb):
+    cur, conn = postgresdb
+    t = pd.Timestamp('2021-04-20 09:00:00+00:00')
+    rows = [
+        ('all', 'web-hosting', 'Foo', 'NL', 0.1),
+        ('all', 'web-hosting', 'Baz', 'DE', 0.2),
+        ('top_1k', 'web-hosting', 'Foo', 'NL', 0.6),
+        ('top_1k', 'ssl-certificate', 'Bar', 'US', 0.5),
+    ]
+    for scope, market, name, alpha2, share in rows:
+        types.ProviderMarketshare(name, None, shared_types.Alpha2(alpha2), scope, market, share, t).write_to_db(cur, conn)
+    ginis = utils.population_weighted_ginis(cur, ['all', 'top_1k'], ['web-hosting', 'ssl-certificate'], t)
+    assert([(g.measurement_scope, g.market) for g in ginis] ==
+           [('all', 'web-hosting'), ('top_1k', 'web-hosting'), ('top_1k', 'ssl-certificate')])
+    # the same as one by one
+    for g in ginis:
+        one = utils.population_weighted_gini(cur, g.measurement_scope, g.market, t)
+        assert(np.isclose(g.gini, one.gini))
+    assert(utils.population_weighted_ginis(cur, ['all'], [], t) == [])
+
+
+def test_compute_ginis(postgresdb):
+    cur, conn = postgresdb
+    write_history(cur, conn)
+    since = pd.Timestamp('2021-04-19 00:00:00+00:00')
+    until = pd.Timestamp('2021-04-22 00:00:00+00:00')
+    history = utils.fetch_history(cur, ['all'], ['web-hosting', 'ssl-certificate'], since - utils.GINI_WINDOW, until)
+    assert(len(history) == 16)
+    assert(history['jurisdiction_alpha2'].isna().sum() == 3)
+    evaluations = utils.gini_evaluations(history, since, until)
+    # one per market per day
+    assert(len(evaluations) == 6)
+    ginis = utils.compute_ginis(history, evaluations)
+    assert(len(ginis) == 6)
+    # the same as computing them one by one
+    for g in ginis.itertuples():
+        one = utils.population_weighted_gini(cur, 'all', g.market, g.time)
+        assert(np.isclose(g.gini, one.gini))
+    # and in parallel
+    parallel = utils.compute_ginis_parallel(history, evaluations, workers=2)
+    merged = ginis.merge(parallel, on=['measurement_scope', 'market', 'time'])
+    assert(len(merged) == 6)
+    assert(np.allclose(merged['gini_x'], merged['gini_y']))
+    # nothing to compute
+    assert(len(utils.compute_ginis(history, evaluations.iloc[:0])) == 0)
+
+
+def test_recompute_gini():
+    postgresql = testing.postgresql.Postgresql()
+    try:
+        conn = psycopg2.connect(**postgresql.dsn())
+        cur = conn.cursor()
+        types.migrate(cur, conn)
+        days = write_history(cur, conn)
+        # stale ginis, one of them outside the range we recompute
+        for t in days:
+            types.PopWeightedGini('all', 'web-hosting', 0.5, t).write_to_db(cur, conn)
+        since = pd.Timestamp('2021-04-20 00:00:00+00:00')
+        until = pd.Timestamp('2021-04-22 00:00:00+00:00')
+        collect.recompute_gini(postgresql.dsn(), since, until, workers=2)
+        cur.execute('SELECT market, gini, time FROM pop_weighted_gini ORDER BY time, market')
+        rows = cur.fetchall()
+        assert(len(rows) == 5)
+        assert(float(rows[0][1]) == 0.5)
+        for market, g, t in rows[1:]:
+            one = utils.population_weighted_gini(cur, 'all', market, pd.Timestamp(t))
+            assert(np.isclose(float(g), one.gini))
+        # running it again changes nothing
+        collect.recompute_gini(postgresql.dsn(), since, until, workers=1)
+        cur.execute('SELECT market, gini, time FROM pop_weighted_gini ORDER BY time, market')
+        assert(cur.fetchall() == rows)
+    finally:
+        postgresql.stop()
+
+
 # NOTE: This test scrapes actual data from the web. Run with care.
 def test_collect():
     postgresql = testing.postgresql.Postgresql()
     test_db_config = postgresql.dsn()
     conn = psycopg2.connect(**postgresql.dsn())
     cur = conn.cursor()
-    types.create_tables(cur, conn)
+    types.migrate(cur, conn)
     collect.collect(test_db_config)